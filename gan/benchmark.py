@@ -0,0 +1,181 @@
+"""
+Micro-benchmarks of the training graph and the scoring code. Run from the gan directory:
+
+    python benchmark.py checkpointing -architecture snresnet -output_size 128 -batch_sizes 16 32 64
+    python benchmark.py fid -codes_g samples-codes.npy -codes_r cifar10-codes.npy
+    python benchmark.py three_sample -n 2048 10000
+"""
+from __future__ import print_function
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import tensorflow as tf
+
+import compute_scores as cs
+from core import mmd
+from core.ops import squared_norm_jacobian
+from core.architecture import get_networks
+
+
+def smmd_discriminator_step(Discriminator, batch_size, output_size, df_dim, kernel, checkpoint, scaling=True):
+    discriminator = Discriminator(dim=df_dim, o_dim=1, use_batch_norm=False, with_sn=True,
+                                  with_learnable_sn_scale=True, checkpoint_blocks=checkpoint)
+    shape = [batch_size, 3, output_size, output_size]
+    images = tf.random_uniform(shape)
+    G = tf.random_uniform(shape)
+    d_images = discriminator(images, batch_size, update_collection=None)
+    d_G = discriminator(G, batch_size, update_collection="NO_OPS")
+
+    # discriminator loss of SMMD, with the second-order scaling term, or of MMD
+    g_loss = mmd.mmd2(getattr(mmd, '_%s_kernel' % kernel)(d_G, d_images))
+    d_loss = -g_loss
+    if scaling:
+        norm2_jac = tf.reduce_mean(squared_norm_jacobian(d_images, images))
+        d_loss /= 10. * norm2_jac + 1.
+    d_vars = [var for var in tf.trainable_variables() if 'd_' in var.name]
+    return tf.train.AdamOptimizer(1e-4).minimize(d_loss, var_list=d_vars)
+
+
+def traced_peak_bytes(sess, op):
+    "Peak bytes in use by the allocators during a traced run of `op`, for devices without MaxBytesInUse."
+    run_metadata = tf.RunMetadata()
+    sess.run(op, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+             run_metadata=run_metadata)
+    return max([m.allocator_bytes_in_use for device in run_metadata.step_stats.dev_stats
+                for node in device.node_stats for m in node.memory] or [0])
+
+
+def checkpointing(args):
+    Discriminator = get_networks(args.architecture)[1]
+    on_gpu = 'gpu' in args.device.lower()
+    print('%10s  %10s  %12s  %12s' % ('batch', 'checkpoint', 'peak MB', 'step ms'))
+    for batch_size in args.batch_sizes:
+        for checkpoint in [False, True]:
+            tf.reset_default_graph()
+            with tf.device(args.device):
+                train_op = smmd_discriminator_step(Discriminator, batch_size, args.output_size,
+                                                   args.df_dim, args.kernel, checkpoint, args.scaling)
+                max_bytes = tf.contrib.memory_stats.MaxBytesInUse() if on_gpu else None
+            config = tf.ConfigProto(allow_soft_placement=True)
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                try:
+                    for _ in range(args.warmup):
+                        sess.run(train_op)
+                    start = time.time()
+                    for _ in range(args.steps):
+                        sess.run(train_op)
+                    step_time = (time.time() - start) / args.steps
+                    peak = (sess.run(max_bytes) if on_gpu else traced_peak_bytes(sess, train_op)) / 2.**20
+                    print('%10d  %10s  %12.1f  %12.1f' % (batch_size, checkpoint, peak, 1000 * step_time))
+                except tf.errors.ResourceExhaustedError:
+                    print('%10d  %10s  %12s  %12s' % (batch_size, checkpoint, 'OOM', '-'))
+
+
+def fid(args):
+    if args.codes_g and args.codes_r:
+        codes_g, codes_r = np.load(args.codes_g), np.load(args.codes_r)
+    else:
+        # correlated random codes, non-negative like the Inception pool_3 features
+        rng = np.random.RandomState(0)
+        mix = rng.randn(args.dim, args.dim) / np.sqrt(args.dim)
+        codes_r = np.maximum(rng.randn(args.n, args.dim).dot(mix), 0).astype(np.float32)
+        codes_g = np.maximum(rng.randn(args.n, args.dim).dot(mix) + .1, 0).astype(np.float32)
+    split_args = {'splits': 1, 'split_method': 'openai'}
+
+    start = time.time()
+    reference = cs.fid_score(codes_g, codes_r, method='sqrtm', output=sys.stderr, **split_args)[0]
+    t_sqrtm = time.time() - start
+
+    start = time.time()
+    engine = cs.FIDEngine.from_codes(codes_r, n_threads=args.blas_threads)
+    t_setup = time.time() - start
+    start = time.time()
+    for _ in range(args.repeats):
+        score = engine.score(codes_g, output=sys.stderr, **split_args)[0]
+    t_eigh = (time.time() - start) / args.repeats
+
+    rel = abs(score - reference) / abs(reference)
+    print('sqrtm:  FID %.6f  %8.2f s' % (reference, t_sqrtm))
+    print('eigh:   FID %.6f  %8.2f s per score (+ %.2f s reference setup)' % (score, t_eigh, t_setup))
+    print('relative difference: %.2e' % rel)
+    if rel > 1e-4:
+        print('FID engine does not match sqrtm.')
+        sys.exit(1)
+
+
+def three_sample(args):
+    rng = np.random.RandomState(0)
+    print('%8s  %10s  %10s  %10s  %10s  %10s' % ('n', 'full s', 'full MB', 'tiled s', 'tiled MB', 'rel diff'))
+    for n in args.n:
+        X = np.maximum(rng.randn(n, args.dim), 0).astype(np.float32)
+        Y = np.maximum(rng.randn(n, args.dim) + .1, 0).astype(np.float32)
+        dim = float(args.dim)
+
+        def full():
+            K_XY = (np.dot(X, Y.transpose()) / dim + 1) ** 3
+            K_YY = (np.dot(Y, Y.transpose()) / dim + 1) ** 3
+            return mmd._np_get_sums(K_XY, K_YY)
+
+        def tiled():
+            return mmd._np_polynomial_sums(X / dim, Y, args.block_size)
+
+        results = []
+        for f in ([tiled] if n > args.max_full else [full, tiled]):
+            tracemalloc.start()
+            start = time.time()
+            sums = f()
+            results.append((sums, time.time() - start, tracemalloc.get_traced_memory()[1] / 2.**20))
+            tracemalloc.stop()
+        if len(results) == 1:
+            (_, t, mb), = results
+            print('%8d  %10s  %10s  %10.2f  %10.1f  %10s' % (n, '-', '-', t, mb, '-'))
+            continue
+        (s_full, t_full, mb_full), (s_tiled, t_tiled, mb_tiled) = results
+        rel = max(np.max(np.abs(np.asarray(a, dtype=np.float64) - b) / np.max(np.abs(a)))
+                  for a, b in zip(s_full, s_tiled))
+        print('%8d  %10.2f  %10.1f  %10.2f  %10.1f  %10.2e' % (n, t_full, mb_full, t_tiled, mb_tiled, rel))
+
+
+parser = argparse.ArgumentParser(description='Benchmarks of the training and scoring code.')
+subparsers = parser.add_subparsers(dest='benchmark')
+
+parser_ckpt = subparsers.add_parser('checkpointing', help='peak memory vs step time of the SMMD '
+                                    'discriminator step with and without residual block checkpointing')
+parser_ckpt.add_argument('-architecture', default='snresnet', type=str, help='[%(default)s]')
+parser_ckpt.add_argument('-output_size', default=64, type=int, help='[%(default)s]')
+parser_ckpt.add_argument('-df_dim', default=64, type=int, help='[%(default)s]')
+parser_ckpt.add_argument('-kernel', default='rbf', type=str, help='[%(default)s]')
+parser_ckpt.add_argument('-batch_sizes', default=[16, 32, 64], type=int, nargs='+', help='[%(default)s]')
+parser_ckpt.add_argument('-scaling', default=1, type=int, help='SMMD scaling term, 0 for the plain MMD loss [%(default)s]')
+parser_ckpt.add_argument('-device', default='/gpu:0', type=str, help='[%(default)s]')
+parser_ckpt.add_argument('-warmup', default=3, type=int, help='[%(default)s]')
+parser_ckpt.add_argument('-steps', default=10, type=int, help='[%(default)s]')
+parser_ckpt.set_defaults(func=checkpointing)
+
+parser_fid = subparsers.add_parser('fid', help='FIDEngine against scipy sqrtm; random codes unless '
+                                   '-codes_g and -codes_r are given')
+parser_fid.add_argument('-codes_g', default=None, type=str, help='generated codes .npy')
+parser_fid.add_argument('-codes_r', default=None, type=str, help='reference codes .npy')
+parser_fid.add_argument('-n', default=10000, type=int, help='[%(default)s]')
+parser_fid.add_argument('-dim', default=2048, type=int, help='[%(default)s]')
+parser_fid.add_argument('-repeats', default=3, type=int, help='[%(default)s]')
+parser_fid.add_argument('-blas_threads', default=None, type=int, help='[all]')
+parser_fid.set_defaults(func=fid)
+
+parser_3s = subparsers.add_parser('three_sample', help='tiled kernel sums of the 3-sample test '
+                                  'against full Gram matrices, on random codes')
+parser_3s.add_argument('-n', default=[2048, 10000], type=int, nargs='+', help='samples per side [%(default)s]')
+parser_3s.add_argument('-dim', default=2048, type=int, help='[%(default)s]')
+parser_3s.add_argument('-block_size', default=1024, type=int, help='[%(default)s]')
+parser_3s.add_argument('-max_full', default=10000, type=int,
+                       help='largest n for which the full Gram matrices are built [%(default)s]')
+parser_3s.set_defaults(func=three_sample)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
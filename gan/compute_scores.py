@@ -1,10 +1,12 @@
 from __future__ import division, print_function
 
-import os.path, sys, tarfile
+import csv, os.path, sys, tarfile, threading, time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from glob import glob
 import numpy as np
 from scipy import linalg
-from six.moves import range, urllib
-from sklearn.metrics.pairwise import polynomial_kernel
+from six.moves import queue, range, urllib
 import tensorflow as tf
 from tqdm import tqdm
 
@@ -21,46 +23,248 @@ class TqdmUpTo(tqdm):
 
 
 from tensorflow.contrib.gan import eval as tfgan_eval
-class Inception(object):
-    def __init__(self,sess):
-        self.softmax_dim = 1008
-        self.coder_dim = 2048
 
+
+# Feature extractors are built from frozen GraphDefs, parsed once per process
+# and cached on disk, either in an existing graph (e.g. on the generator
+# output) or in a graph and session of their own.
+CACHE_DIR = os.environ.get('SCORES_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'scaled-mmd-gan'))
+CACHE_VERSION = 2  # bumped when the frozen graphs change
+EXTRACTORS = {}
+_graph_defs = {}
+_isolated = {}
+
+ExtractorSpec = namedtuple('ExtractorSpec', [
+    'make_graph_def', 'build', 'coder_dim', 'softmax_dim', 'channels', 'from_unit'])
+
+
+def register_extractor(name, make_graph_def, coder_dim, softmax_dim, channels, from_unit):
+    '''
+    Decorator registering `build(graph_def, images)` -> (coder, softmax).
+    make_graph_def returns the frozen GraphDef, called only on a cache miss;
+    from_unit maps images in [0, 1] to the input range of the extractor.
+    '''
+    def register(build):
+        EXTRACTORS[name] = ExtractorSpec(make_graph_def, build, coder_dim,
+                                         softmax_dim, channels, from_unit)
+        return build
+    return register
+
+
+def cached_graph_def(name):
+    if name not in _graph_defs:
+        path = os.path.join(CACHE_DIR, '%s-v%d.pb' % (name, CACHE_VERSION))
+        if os.path.exists(path):
+            graph_def = tf.GraphDef()
+            with open(path, 'rb') as f:
+                graph_def.ParseFromString(f.read())
+        else:
+            graph_def = EXTRACTORS[name].make_graph_def()
+            if not os.path.exists(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(graph_def.SerializeToString())
+            os.rename(tmp, path)  # atomic, other processes may be caching it too
+            print('[*] Frozen %s graph cached in <%s>' % (name, path))
+        _graph_defs[name] = graph_def
+    return _graph_defs[name]
+
+
+class Extractor(object):
+    def __init__(self, name, sess=None, images=None, isolated=False):
+        '''
+        images: optional NHWC tensor with values in [0, 1], e.g. the generator
+        output, featurized in-graph; otherwise images in the input range of the
+        extractor are fed through self.input.
+        isolated: build in a new graph and session, keeping the graph of `sess`
+        small, or with 'process' in a worker process of its own, whose session
+        is proxied by self.sess; see isolated_extractor.
+        '''
+        spec = EXTRACTORS[name]
+        self.name = name
+        self.softmax_dim = spec.softmax_dim
+        self.coder_dim = spec.coder_dim
+
+        if isolated:
+            assert images is None, 'An isolated extractor is fed from the host'
+        if isolated == 'process':
+            self.sess = ExtractorProcess(name)
+            self.input, self.coder, self.softmax = 'input', 'coder', 'softmax'
+            return
+        if isolated:
+            graph = tf.Graph()
+            config = tf.ConfigProto(allow_soft_placement=True)
+            config.gpu_options.allow_growth = True
+            sess = tf.Session(graph=graph, config=config)
         self.sess = sess
 
-        self.input = tf.placeholder(tf.float32, shape=(None, None, None, 3))
-        proced = tfgan_eval.preprocess_image(self.input)
-        self.coder, self.softmax = tfgan_eval.run_inception(
-            proced, output_tensor=['pool_3:0', 'logits:0'])
+        with sess.graph.as_default():
+            if images is None:
+                self.input = tf.placeholder(tf.float32, shape=(None, None, None, spec.channels))
+                inp = self.input
+            else:
+                self.input = None
+                inp = spec.from_unit(tf.cast(images, tf.float32))
+            self.coder, self.softmax = spec.build(cached_graph_def(name), inp)
         assert self.coder.get_shape()[1].value == self.coder_dim
         assert self.softmax.get_shape()[1].value == self.softmax_dim
 
 
-class LeNet(object):
-    def __init__(self,sess):
-        MODEL_DIR = 'lenet/saved_model'
-        self.softmax_dim = 10
-        self.coder_dim = 512
+def _extractor_worker(name, conn):
+    "Serves ExtractorProcess: runs the requested outputs of the extractor on each batch received."
+    try:
+        model = Extractor(name, isolated=True)
+    except Exception:
+        import traceback
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ready', None))
+    outputs = {'coder': model.coder, 'softmax': model.softmax}
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        fetches, images = request
+        try:
+            out = model.sess.run([outputs[f] for f in fetches], {model.input: images})
+            conn.send(('ok', out))
+        except Exception:
+            import traceback
+            conn.send(('error', traceback.format_exc()))
+    model.sess.close()
+
+
+class ExtractorProcess(object):
+    '''
+    Session-like proxy of an extractor running in a worker process, so that
+    neither its graph nor its device memory are in the training process.
+    run(fetches, {'input': images}) returns the 'coder' and/or 'softmax'
+    outputs of the images.
+    '''
+    def __init__(self, name):
+        import multiprocessing
+        # CUDA does not survive a fork, and python 2 only forks
+        ctx = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') \
+            else multiprocessing
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_extractor_worker, args=(name, child))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self._receive()
+
+    def _receive(self):
+        try:
+            status, value = self.conn.recv()
+        except EOFError:
+            raise RuntimeError('The extractor process exited (code %s)' % self.process.exitcode)
+        if status == 'error':
+            raise RuntimeError('In the extractor process:\n' + value)
+        return value
+
+    def run(self, fetches, feed_dict):
+        single = isinstance(fetches, str)
+        names = [fetches] if single else list(fetches)
+        with self.lock:
+            self.conn.send((names, np.asarray(feed_dict['input'], dtype=np.float32)))
+            out = self._receive()
+        return out[0] if single else type(fetches)(out)
+
+    def close(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+            self.process.join()
+        self.conn.close()
+
+
+def _inception_graph_def():
+    url = getattr(tfgan_eval, 'INCEPTION_URL',
+                  'http://download.tensorflow.org/models/frozen_inception_v1_2015_12_05.tar.gz')
+    graph = getattr(tfgan_eval, 'INCEPTION_FROZEN_GRAPH', 'inceptionv1_for_inception_score.pb')
+    return tfgan_eval.get_graph_def_from_url_tarball(url, graph)
+
+
+@register_extractor('inception', _inception_graph_def, coder_dim=2048, softmax_dim=1008,
+                    channels=3, from_unit=lambda x: tf.clip_by_value(255. * x, 0., 255.))
+def _build_inception(graph_def, images):
+    proced = tfgan_eval.preprocess_image(images)
+    return tfgan_eval.run_inception(proced, graph_def=graph_def,
+                                    output_tensor=['pool_3:0', 'logits:0'])
+
+
+class Inception(Extractor):
+    def __init__(self, sess=None, images=None, isolated=False):
+        super(Inception, self).__init__('inception', sess, images, isolated)
+
+
+LENET_DIR = 'lenet/saved_model'
+
+
+def _lenet_graph_def():
+    '''
+    Frozen inference graph of the LeNet saved model: its serving graph, or
+    the training one stripped of its training nodes when it was only saved
+    with the training tag.
+    '''
+    from tensorflow.core.protobuf import saved_model_pb2
+    saved_model = saved_model_pb2.SavedModel()
+    with open(os.path.join(LENET_DIR, 'saved_model.pb'), 'rb') as f:
+        saved_model.ParseFromString(f.read())
+    tags = set(tag for meta_graph in saved_model.meta_graphs
+               for tag in meta_graph.meta_info_def.tags)
+    if tf.saved_model.tag_constants.SERVING in tags:
+        tag = tf.saved_model.tag_constants.SERVING
+    else:
+        tag = tf.saved_model.tag_constants.TRAINING
+        print('[!] No serving graph in <%s>, freezing the training one' % LENET_DIR)
+    outputs = ['Relu_5', 'Softmax_1']
+    graph = tf.Graph()
+    with tf.Session(graph=graph) as sess:
+        tf.saved_model.loader.load(sess, [tag], LENET_DIR)
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, graph.as_graph_def(), outputs)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=outputs)
+    return tf.graph_util.extract_sub_graph(graph_def, outputs)
 
-        #self.sess = sess = tf.Session()
-        self.sess = sess
-        tf.saved_model.loader.load(
-            sess, [tf.saved_model.tag_constants.TRAINING], MODEL_DIR)
-        g = sess.graph
 
-        self.softmax = g.get_tensor_by_name('Softmax_1:0')
-        self.coder = g.get_tensor_by_name('Relu_5:0')
+@register_extractor('lenet', _lenet_graph_def, coder_dim=512, softmax_dim=10,
+                    channels=1, from_unit=lambda x: tf.clip_by_value(x - .5, -.5, .5))
+def _build_lenet(graph_def, images):
+    return tf.import_graph_def(graph_def, input_map={'Placeholder_2:0': images},
+                               return_elements=['Relu_5:0', 'Softmax_1:0'], name='lenet')
 
-        assert self.coder.get_shape()[1].value == self.coder_dim
-        assert self.softmax.get_shape()[1].value == self.softmax_dim
-        self.input = 'Placeholder_2:0'
+
+class LeNet(Extractor):
+    def __init__(self, sess=None, images=None, isolated=False):
+        super(LeNet, self).__init__('lenet', sess, images, isolated)
+
+
+def isolated_extractor(name, process=False):
+    '''
+    The extractor `name` in a graph and session of its own, or in a worker
+    process of its own, built once per process.
+    '''
+    isolated = 'process' if process else True
+    if (name, isolated) not in _isolated:
+        cls = {'inception': Inception, 'lenet': LeNet}.get(name)
+        _isolated[name, isolated] = cls(isolated=isolated) if cls else Extractor(name, isolated=isolated)
+    return _isolated[name, isolated]
 
 
 def featurize(images, model, batch_size=100, transformer=np.asarray,
               get_preds=True, get_codes=False, output=sys.stdout, 
-              out_preds=None, out_codes=None):
+              out_preds=None, out_codes=None, journal=None, prefetch=2,
+              flush_every=50):
     '''
     images: a list of numpy arrays with values in [0, 255]
+
+    The next batches are read and transformed in a thread while the model
+    runs. With a journal path, the batches of out_preds/out_codes (e.g.
+    memmaps) are recorded there once flushed, and batches already recorded
+    and not NaN are skipped, so that an interrupted run can be resumed.
     '''
     sub = transformer(images[:10])
     assert(sub.ndim == 4)
@@ -101,28 +305,169 @@ def featurize(images, model, batch_size=100, transformer=np.asarray,
             codes.fill(np.nan)
         ret += (codes,)
 
-    # with model.sess:
+    starts = list(range(0, n, batch_size))
+    done = set()
+    if journal is not None:
+        done = _read_journal(journal, ret, batch_size)
+        if done:
+            print('Resuming: {} of {} batches already featurized'.format(len(done), len(starts)),
+                  file=output)
+    todo = [start for start in starts if start not in done]
+
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for start in todo:
+                if stop.is_set():
+                    return
+                end = min(start + batch_size, n)
+                inp = transformer(images[start:end])
+                if not inp.flags.owndata:  # read memmapped inputs here
+                    inp = np.array(inp)
+                batches.put((start, end, inp))
+        except Exception as e:
+            batches.put(e)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    log = open(journal, 'a') if journal is not None else None
+    pending = []
+    try:
+        # with model.sess:
+        with TqdmUpTo(unit='img', unit_scale=True, total=n, file=output) as t:
+            t.update(sum(min(start + batch_size, n) - start for start in done))
+            for _ in todo:
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                start, end, inp = batch
+
+                if end - start != batch_size:
+                    pad = batch_size - (end - start)
+                    extra = np.zeros((pad,) + inp.shape[1:], dtype=inp.dtype)
+                    inp = np.r_[inp, extra]
+                    w = slice(0, end - start)
+                else:
+                    w = slice(None)
+
+                out = model.sess.run(to_get, {model.input: inp})
+                if get_preds:
+                    preds[start:end] = out[0][w]
+                if get_codes:
+                    codes[start:end] = out[-1][w]
+                t.update(end - start)
+                if log is not None:
+                    pending.append(start)
+                    if len(pending) >= flush_every:
+                        _write_journal(log, ret, pending)
+    finally:
+        if log is not None:
+            _write_journal(log, ret, pending)
+            log.close()
+        stop.set()
+        while producer.is_alive():  # unblock a pending put
+            try:
+                batches.get_nowait()
+            except queue.Empty:
+                pass
+            producer.join(.1)
+    return ret
+
+
+def _read_journal(path, outs, batch_size):
+    "Starts of the journaled batches whose outputs are all set."
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        starts = set(int(line) for line in f if line.strip())
+    return set(start for start in starts
+               if not any(np.isnan(out[start:start + batch_size]).any() for out in outs))
+
+
+def _write_journal(log, outs, starts):
+    for out in outs:
+        if hasattr(out, 'flush'):
+            out.flush()
+    log.write(''.join('%d\n' % start for start in starts))
+    log.flush()
+    os.fsync(log.fileno())
+    del starts[:]
+
+
+def featurize_batches(batches, n, model, get_preds=True, get_codes=False,
+                      output=sys.stdout):
+    '''
+    Like featurize, for an iterable of transformed image batches; only the
+    first n images are featurized and only the outputs are kept.
+    '''
+    preds = np.empty((n, model.softmax_dim), dtype=np.float32) if get_preds else None
+    codes = np.empty((n, model.coder_dim), dtype=np.float32) if get_codes else None
+    to_get = ()
+    if get_preds:
+        to_get += (model.softmax,)
+    if get_codes:
+        to_get += (model.coder,)
+
+    # LeNet takes fixed size batches
+    fixed = 64 if isinstance(model, LeNet) else None
+
+    def model_batches():
+        for batch in batches:
+            size = fixed or len(batch)
+            for s in range(0, len(batch), size):
+                inp = batch[s:s + size]
+                if fixed and len(inp) < fixed:
+                    extra = np.zeros((fixed - len(inp),) + inp.shape[1:], dtype=inp.dtype)
+                    yield np.r_[inp, extra], len(inp)
+                else:
+                    yield inp, len(inp)
+
+    start = 0
     with TqdmUpTo(unit='img', unit_scale=True, total=n, file=output) as t:
-        for start in range(0, n, batch_size):
+        for inp, valid in model_batches():
+            end = min(start + valid, n)
+            out = model.sess.run(to_get, {model.input: inp})
+            if get_preds:
+                preds[start:end] = out[0][:end - start]
+            if get_codes:
+                codes[start:end] = out[-1][:end - start]
+            start = end
             t.update_to(start)
-            end = min(start + batch_size, n)
-            inp = transformer(images[start:end])
-
-            if end - start != batch_size:
-                pad = batch_size - (end - start)
-                extra = np.zeros((pad,) + inp.shape[1:], dtype=inp.dtype)
-                inp = np.r_[inp, extra]
-                w = slice(0, end - start)
-            else:
-                w = slice(None)
+            if start == n:
+                break
+    assert start == n, 'Only %d of %d images featurized' % (start, n)
+    return tuple(r for r in (preds, codes) if r is not None)
 
-            out = model.sess.run(to_get, {model.input: inp})
+
+def featurize_in_graph(n, model, get_preds=True, get_codes=False, output=sys.stdout):
+    '''
+    Like featurize, for a model built on an image tensor: evaluates it until
+    n images are featurized; only the outputs are fetched.
+    '''
+    assert model.input is None, 'The model is not built on an image tensor'
+    preds = np.empty((n, model.softmax_dim), dtype=np.float32) if get_preds else None
+    codes = np.empty((n, model.coder_dim), dtype=np.float32) if get_codes else None
+    to_get = ()
+    if get_preds:
+        to_get += (model.softmax,)
+    if get_codes:
+        to_get += (model.coder,)
+
+    start = 0
+    with TqdmUpTo(unit='img', unit_scale=True, total=n, file=output) as t:
+        while start < n:
+            out = model.sess.run(to_get)
+            end = min(start + len(out[0]), n)
             if get_preds:
-                preds[start:end] = out[0][w]
+                preds[start:end] = out[0][:end - start]
             if get_codes:
-                codes[start:end] = out[-1][w]
-        t.update_to(n)
-    return ret
+                codes[start:end] = out[-1][:end - start]
+            start = end
+            t.update_to(start)
+    return tuple(r for r in (preds, codes) if r is not None)
 
 
 def get_splits(n, splits=10, split_method='openai'):
@@ -135,35 +480,75 @@ def get_splits(n, splits=10, split_method='openai'):
         raise ValueError("bad split_method {}".format(split_method))
 
 
-def inception_score(preds, **split_args):
-    split_inds = get_splits(preds.shape[0], **split_args)
-    scores = np.zeros(len(split_inds))
-    for i, inds in enumerate(split_inds):
-        part = preds[inds]
-        kl = part * (np.log(part) - np.log(np.mean(part, 0, keepdims=True)))
-        kl = np.mean(np.sum(kl, 1))
-        scores[i] = np.exp(kl)
-    return scores
+def get_split_weights(n, splits=10, split_method='openai'):
+    '''
+    Number of times each sample appears in each split, as a (splits, n) array;
+    bootstrap draws are the same as get_splits'.
+    '''
+    weights = np.zeros((splits, n))
+    if split_method == 'openai':
+        for i, s in enumerate(get_splits(n, splits, split_method)):
+            weights[i, s] = 1
+    elif split_method == 'bootstrap':
+        for i in range(splits):
+            weights[i] = np.bincount(np.random.choice(n, n), minlength=n)
+    else:
+        raise ValueError("bad split_method {}".format(split_method))
+    return weights
 
 
-def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout, **split_args):
-    splits_g = get_splits(codes_g.shape[0], **split_args)
-    splits_r = get_splits(codes_r.shape[0], **split_args)
-    assert len(splits_g) == len(splits_r)
-    d = codes_g.shape[1]
-    assert codes_r.shape[1] == d
+def weighted_mean_cov(codes, weights, buf=None):
+    '''
+    Yields the mean and covariance of each resample of `codes` described by
+    the rows of `weights`, without gathering the resampled codes. `buf` is
+    an (n, d) float64 work array, reused across splits.
+    '''
+    if buf is None:
+        buf = np.empty(codes.shape, dtype=policy.stats_dtype)
+    mn = codes.mean(axis=0, dtype=np.float64).astype(buf.dtype)
+    for w in weights:
+        N = w.sum()
+        np.subtract(codes, mn, out=buf)  # centered for accuracy
+        mn_c = w.dot(buf) / N
+        np.multiply(buf, np.sqrt(w)[:, None], out=buf)
+        cov = buf.T.dot(buf)
+        cov -= N * np.outer(mn_c, mn_c)
+        cov /= N - 1
+        yield mn + mn_c, cov
 
-    scores = np.zeros(len(splits_g))
-    with tqdm(splits_g, desc='FID', file=output) as bar:
-        for i, (w_g, w_r) in enumerate(zip(bar, splits_r)):
-            part_g = codes_g[w_g]
-            part_r = codes_r[w_r]
 
-            mn_g = part_g.mean(axis=0)
-            mn_r = part_r.mean(axis=0)
+def inception_score(preds, **split_args):
+    weights = get_split_weights(preds.shape[0], **split_args)
+    N = weights.sum(axis=1)
+    # all splits at once: KL(p(y|x) || p(y)) = sum p log p - sum p log p(y)
+    neg_ent = np.sum(preds * np.log(preds), axis=1)
+    log_marginals = np.log(weights.dot(preds) / N[:, None])
+    cross = preds.dot(log_marginals.T)
+    kl = (weights.dot(neg_ent) - np.sum(weights * cross.T, axis=1)) / N
+    return np.exp(kl)
+
+
+def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout, method='eigh',
+              **split_args):
+    '''
+    method: 'eigh' for the symmetric eigendecomposition of FIDEngine,
+            'sqrtm' for scipy's sqrtm of the non-symmetric product
+    '''
+    weights_g = get_split_weights(codes_g.shape[0], **split_args)
+    weights_r = get_split_weights(codes_r.shape[0], **split_args)
+    assert len(weights_g) == len(weights_r)
+    d = codes_g.shape[1]
+    assert codes_r.shape[1] == d
 
-            cov_g = np.cov(part_g, rowvar=False)
-            cov_r = np.cov(part_r, rowvar=False)
+    scores = np.zeros(len(weights_g))
+    stats_r = weighted_mean_cov(codes_r, weights_r)
+    with tqdm(weighted_mean_cov(codes_g, weights_g), total=len(weights_g),
+              desc='FID', file=output) as bar:
+        for i, ((mn_g, cov_g), (mn_r, cov_r)) in enumerate(zip(bar, stats_r)):
+            if method == 'eigh':
+                scores[i] = FIDEngine(mn_r, cov_r).distance(mn_g, cov_g)
+                bar.set_postfix({'mean': scores[:i+1].mean()})
+                continue
 
             covmean, _ = linalg.sqrtm(cov_g.dot(cov_r), disp=False)
             if not np.isfinite(covmean).all():
@@ -172,30 +557,206 @@ def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout, **split_args):
                 covmean = linalg.sqrtm(cov_g.dot(cov_r))
 
             scores[i] = np.sum((mn_g - mn_r) ** 2) + (
-                np.trace(cov_g) + np.trace(cov_r) - 2 * np.trace(covmean))
+                np.trace(cov_g) + np.trace(cov_r) - 2 * np.trace(covmean).real)
             bar.set_postfix({'mean': scores[:i+1].mean()})
     return scores
 
 
+@contextmanager
+def blas_threads(n=None, openmp=None):
+    '''
+    Limits the BLAS/LAPACK (and OpenMP) threads inside the context; needs
+    threadpoolctl. The limits are process-wide.
+    '''
+    limits = dict((api, k) for api, k in [('blas', n), ('openmp', openmp)] if k)
+    if not limits:
+        yield
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        print('WARNING! threadpoolctl not installed, BLAS threads not limited.')
+        yield
+        return
+    with threadpool_limits(limits=limits):
+        yield
+
+
+class NumericPolicy(object):
+    '''
+    Dtypes and thread pools of the scoring code. Kernel matrices are built
+    in kernel_dtype and their sums accumulated in float64; means,
+    covariances and their eigendecompositions use stats_dtype. Inputs
+    already in the chosen dtype are not copied.
+    '''
+    def __init__(self, kernel_dtype=np.float32, stats_dtype=np.float64,
+                 blas_threads=None, openmp_threads=None):
+        self.kernel_dtype = np.dtype(kernel_dtype)
+        self.stats_dtype = np.dtype(stats_dtype)
+        self.blas_threads = blas_threads or None
+        self.openmp_threads = openmp_threads or None
+
+    def limits(self):
+        return blas_threads(self.blas_threads, self.openmp_threads)
+
+    def kernel_input(self, X):
+        return np.asarray(X, dtype=self.kernel_dtype)
+
+
+policy = NumericPolicy()
+
+
+def set_policy(**kwargs):
+    "Replaces the numeric policy of the scoring code; see NumericPolicy."
+    global policy
+    policy = NumericPolicy(**kwargs)
+    return policy
+
+
+class FIDEngine(object):
+    '''
+    FID against fixed reference statistics. With A = sqrt(cov_r) computed
+    once, tr sqrtm(cov_g cov_r) = tr sqrtm(A cov_g A); the latter matrix is
+    symmetric PSD, so only its eigenvalues are needed.
+    '''
+    def __init__(self, mean_r, cov_r, sqrt_cov_r=None, dtype=None,
+                 n_threads=None):
+        self.dtype = dtype = dtype or policy.stats_dtype
+        self.n_threads = n_threads
+        self.mean_r = np.asarray(mean_r, dtype=dtype)
+        self.cov_r = np.asarray(cov_r, dtype=dtype)
+        self.trace_r = np.trace(self.cov_r)
+        if sqrt_cov_r is None:
+            with blas_threads(n_threads):
+                w, V = linalg.eigh(self.cov_r)
+                sqrt_cov_r = (V * np.sqrt(np.maximum(w, 0))).dot(V.T)
+        self.sqrt_cov_r = np.asarray(sqrt_cov_r, dtype=dtype)
+
+    @classmethod
+    def from_codes(cls, codes_r, **kwargs):
+        return cls(codes_r.mean(axis=0, dtype=np.float64),
+                   np.cov(codes_r, rowvar=False), **kwargs)
+
+    def distance(self, mn_g, cov_g):
+        A = self.sqrt_cov_r
+        cov_g = np.asarray(cov_g, dtype=self.dtype)
+        with blas_threads(self.n_threads):
+            M = A.dot(cov_g).dot(A)
+            eigvals = linalg.eigvalsh(M, overwrite_a=True, check_finite=False)
+        tr_covmean = np.sqrt(np.maximum(eigvals, 0)).sum()
+        return (np.sum((np.asarray(mn_g, dtype=self.dtype) - self.mean_r) ** 2)
+                + np.trace(cov_g) + self.trace_r - 2 * tr_covmean)
+
+    def score(self, codes_g, output=sys.stdout, **split_args):
+        weights = get_split_weights(codes_g.shape[0], **split_args)
+        scores = np.zeros(len(weights))
+        with tqdm(weighted_mean_cov(codes_g, weights), total=len(weights),
+                  desc='FID', file=output) as bar:
+            for i, (mn_g, cov_g) in enumerate(bar):
+                scores[i] = self.distance(mn_g, cov_g)
+                bar.set_postfix({'mean': scores[:i+1].mean()})
+        return scores
+
+
+class KIDStopping(object):
+    '''
+    Sequential stopping rule of the subset KID estimates: stops once the
+    standard error of their mean, sqrt(mean(var) / k) after k subsets, is
+    below target_se, or once time_budget seconds have passed. `var` are the
+    variances of the subset estimates, i.e. at var_at_m=subset_size.
+    '''
+    def __init__(self, target_se=None, time_budget=None, min_subsets=2):
+        self.target_se = target_se
+        self.time_budget = time_budget
+        self.min_subsets = min_subsets
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.se = np.nan
+
+    def __call__(self, vars):
+        k = len(vars)
+        self.se = np.sqrt(max(vars.mean(), 0) / k)
+        if k < self.min_subsets:
+            return False
+        if self.target_se and self.se < self.target_se:
+            return True
+        return bool(self.time_budget) and (time.time() - self.start > self.time_budget)
+
+    def report(self, n_used, n_max, output=sys.stdout):
+        print('KID: %d of at most %d subsets used, standard error %.3g'
+              % (n_used, n_max, self.se), file=output)
+
+
 def polynomial_mmd_averages(codes_g, codes_r, n_subsets=50, subset_size=1000,
-                            ret_var=True, output=sys.stdout, **kernel_args):
+                            ret_var=True, output=sys.stdout, batch_size=10,
+                            stopping=None, **kernel_args):
+    '''
+    The kernels of `batch_size` subsets are computed at once by batched
+    matmuls; the subsets are drawn as if computed one by one.
+
+    With a KIDStopping rule, n_subsets is an upper bound and the returned
+    arrays hold the estimates of the subsets actually used.
+    '''
     m = min(codes_g.shape[0], codes_r.shape[0])
     mmds = np.zeros(n_subsets)
-    if ret_var:
+    need_var = ret_var or (stopping is not None)
+    if need_var:
         vars = np.zeros(n_subsets)
+        stop_vars = np.zeros(n_subsets)
     choice = np.random.choice
-
-    with tqdm(range(n_subsets), desc='MMD', file=output) as bar:
-        for i in bar:
-            g = codes_g[choice(len(codes_g), subset_size, replace=False)]
-            r = codes_r[choice(len(codes_r), subset_size, replace=False)]
-            o = polynomial_mmd(g, r,  var_at_m=m, ret_var=ret_var,**kernel_args)
-            if ret_var:
-                mmds[i], vars[i] = o
-            else:
-                mmds[i] = o
-            bar.set_postfix({'mean': mmds[:i+1].mean()})
-    return (mmds, vars) if ret_var else mmds
+    inds = [(choice(len(codes_g), subset_size, replace=False),
+             choice(len(codes_r), subset_size, replace=False))
+            for _ in range(n_subsets)]
+    batch_size = min(batch_size, n_subsets)
+    g = np.empty((batch_size, subset_size, codes_g.shape[1]), dtype=codes_g.dtype)
+    r = np.empty((batch_size, subset_size, codes_r.shape[1]), dtype=codes_r.dtype)
+    if stopping is not None:
+        stopping.reset()
+
+    used = n_subsets
+    with tqdm(total=n_subsets, desc='MMD', file=output) as bar:
+        for start in range(0, n_subsets, batch_size):
+            batch = inds[start:start + batch_size]
+            b = len(batch)
+            np.take(codes_g, np.stack([i for i, _ in batch]), axis=0, out=g[:b])
+            np.take(codes_r, np.stack([j for _, j in batch]), axis=0, out=r[:b])
+            K_XX = polynomial_kernel_batch(g[:b], **kernel_args)
+            K_YY = polynomial_kernel_batch(r[:b], **kernel_args)
+            K_XY = polynomial_kernel_batch(g[:b], r[:b], **kernel_args)
+            for k in range(b):
+                o = _mmd2_and_variance(K_XX[k], K_XY[k], K_YY[k],
+                                       var_at_m=(m, subset_size), ret_var=need_var)
+                if need_var:
+                    mmds[start + k], (vars[start + k], stop_vars[start + k]) = o
+                else:
+                    mmds[start + k] = o
+            bar.update(b)
+            bar.set_postfix({'mean': mmds[:start + b].mean()})
+            if (stopping is not None) and stopping(stop_vars[:start + b]):
+                used = start + b
+                break
+    if stopping is not None:
+        stopping.report(used, n_subsets, output=output)
+    return (mmds[:used], vars[:used]) if ret_var else mmds[:used]
+
+
+def polynomial_kernel_batch(X, Y=None, degree=3, gamma=None, coef0=1):
+    '''
+    sklearn's polynomial_kernel over a leading batch dimension:
+    X is (b, m, d) and Y is (b, n, d); returns (b, m, n).
+    '''
+    if Y is None:
+        Y = X
+    if gamma is None:
+        gamma = 1.0 / X.shape[-1]
+    X, Y = policy.kernel_input(X), policy.kernel_input(Y)
+    K = np.matmul(X, np.swapaxes(Y, -1, -2))
+    K *= gamma
+    K += coef0
+    K **= degree
+    return K
 
 
 def polynomial_mmd(codes_g, codes_r, degree=3, gamma=None, coef0=1,
@@ -205,9 +766,9 @@ def polynomial_mmd(codes_g, codes_r, degree=3, gamma=None, coef0=1,
     X = codes_g
     Y = codes_r
 
-    K_XX = polynomial_kernel(X, degree=degree, gamma=gamma, coef0=coef0)
-    K_YY = polynomial_kernel(Y, degree=degree, gamma=gamma, coef0=coef0)
-    K_XY = polynomial_kernel(X, Y, degree=degree, gamma=gamma, coef0=coef0)
+    K_XX = polynomial_kernel_batch(X, degree=degree, gamma=gamma, coef0=coef0)
+    K_YY = polynomial_kernel_batch(Y, degree=degree, gamma=gamma, coef0=coef0)
+    K_XY = polynomial_kernel_batch(X, Y, degree=degree, gamma=gamma, coef0=coef0)
 
     return _mmd2_and_variance(K_XX, K_XY, K_YY,
                               var_at_m=var_at_m, ret_var=ret_var)
@@ -215,7 +776,30 @@ def polynomial_mmd(codes_g, codes_r, degree=3, gamma=None, coef0=1,
 
 def _sqn(arr):
     flat = np.ravel(arr)
-    return flat.dot(flat)
+    if flat.dtype == np.float64:
+        return flat.dot(flat)
+    # accumulated in float64 through einsum's buffering, without a copy
+    return np.einsum('i,i->', flat, flat, dtype=np.float64)
+
+
+def _kernel_sums(K, unit_diagonal=False, ret_var=True):
+    """
+    Sums of a within-sample kernel matrix K_XX used by the MMD estimators;
+    they only depend on one of the samples and can be cached.
+    """
+    m = K.shape[0]
+    if unit_diagonal:
+        diag = 1
+        sum_diag = sum_diag2 = m
+    else:
+        diag = np.diagonal(K)
+        sum_diag = diag.sum(dtype=np.float64)
+        sum_diag2 = _sqn(diag)
+    Kt_sums = K.sum(axis=1, dtype=np.float64) - diag
+    sums = {'sum_diag': sum_diag, 'Kt_sums': Kt_sums, 'Kt_sum': Kt_sums.sum()}
+    if ret_var:
+        sums['Kt_2_sum'] = _sqn(K) - sum_diag2
+    return sums
 
 
 def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
@@ -228,37 +812,32 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
     assert K_XX.shape == (m, m)
     assert K_XY.shape == (m, m)
     assert K_YY.shape == (m, m)
-    if var_at_m is None:
-        var_at_m = m
 
     # Get the various sums of kernels that we'll use
     # Kts drop the diagonal, but we don't need to compute them explicitly
-    if unit_diagonal:
-        diag_X = diag_Y = 1
-        sum_diag_X = sum_diag_Y = m
-        sum_diag2_X = sum_diag2_Y = m
-    else:
-        diag_X = np.diagonal(K_XX)
-        diag_Y = np.diagonal(K_YY)
+    return _mmd2_and_variance_from_sums(
+        _kernel_sums(K_XX, unit_diagonal, ret_var), K_XY,
+        _kernel_sums(K_YY, unit_diagonal, ret_var),
+        mmd_est=mmd_est, var_at_m=var_at_m, ret_var=ret_var)
 
-        sum_diag_X = diag_X.sum()
-        sum_diag_Y = diag_Y.sum()
 
-        sum_diag2_X = _sqn(diag_X)
-        sum_diag2_Y = _sqn(diag_Y)
+def _mmd2_and_variance_from_sums(sums_X, K_XY, sums_Y, mmd_est='unbiased',
+                                 var_at_m=None, ret_var=True):
+    m = K_XY.shape[0]
+    assert K_XY.shape == (m, m)
+    if var_at_m is None:
+        var_at_m = m
 
-    Kt_XX_sums = K_XX.sum(axis=1) - diag_X
-    Kt_YY_sums = K_YY.sum(axis=1) - diag_Y
-    K_XY_sums_0 = K_XY.sum(axis=0)
-    K_XY_sums_1 = K_XY.sum(axis=1)
+    Kt_XX_sums, Kt_YY_sums = sums_X['Kt_sums'], sums_Y['Kt_sums']
+    K_XY_sums_0 = K_XY.sum(axis=0, dtype=np.float64)
+    K_XY_sums_1 = K_XY.sum(axis=1, dtype=np.float64)
 
-    Kt_XX_sum = Kt_XX_sums.sum()
-    Kt_YY_sum = Kt_YY_sums.sum()
+    Kt_XX_sum, Kt_YY_sum = sums_X['Kt_sum'], sums_Y['Kt_sum']
     K_XY_sum = K_XY_sums_0.sum()
 
     if mmd_est == 'biased':
-        mmd2 = ((Kt_XX_sum + sum_diag_X) / (m * m)
-                + (Kt_YY_sum + sum_diag_Y) / (m * m)
+        mmd2 = ((Kt_XX_sum + sums_X['sum_diag']) / (m * m)
+                + (Kt_YY_sum + sums_Y['sum_diag']) / (m * m)
                 - 2 * K_XY_sum / (m * m))
     else:
         assert mmd_est in {'unbiased', 'u-statistic'}
@@ -271,8 +850,8 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
     if not ret_var:
         return mmd2
 
-    Kt_XX_2_sum = _sqn(K_XX) - sum_diag2_X
-    Kt_YY_2_sum = _sqn(K_YY) - sum_diag2_Y
+    Kt_XX_2_sum = sums_X['Kt_2_sum']
+    Kt_YY_2_sum = sums_Y['Kt_2_sum']
     K_XY_2_sum = _sqn(K_XY)
 
     dot_XX_XY = Kt_XX_sums.dot(K_XY_sums_1)
@@ -298,19 +877,33 @@ def _mmd2_and_variance(K_XX, K_XY, K_YY, unit_diagonal=False,
         - 4 / (m * m * m1) * (dot_XX_XY + dot_YY_YX)
         + 4 / (m**3 * m1) * (Kt_XX_sum + Kt_YY_sum) * K_XY_sum
     )
-    var_est = (4 * (var_at_m - 2) / (var_at_m * (var_at_m - 1)) * zeta1_est
-               + 2 / (var_at_m * (var_at_m - 1)) * zeta2_est)
-
-    return mmd2, var_est
+    var_at = lambda n: (4 * (n - 2) / (n * (n - 1)) * zeta1_est
+                        + 2 / (n * (n - 1)) * zeta2_est)
+    if isinstance(var_at_m, tuple):
+        return mmd2, tuple(var_at(n) for n in var_at_m)
+    return mmd2, var_at(var_at_m)
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('samples')
+    parser.add_argument('samples',
+                        help='samples .npy file, or a (quoted) glob of them')
     parser.add_argument('reference_feats', nargs='?')
     parser.add_argument('--output', '-o')
 
+    parser.add_argument('--samples-from',
+                        help='file listing further samples files, one per line')
+    parser.add_argument('--results',
+                        help='.csv or .npz table of the scores of each samples '
+                             'file; needed with several samples files')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes the samples files are '
+                             'sharded across')
+    parser.add_argument('--worker-gpus', type=lambda x: x.split(','),
+                        default=None, help='comma-separated GPUs, assigned to '
+                                           'the workers in turn')
+
     parser.add_argument('--reference-subset', default=slice(None),
                         type=lambda x: slice(*(int(s) if s else None
                                                for s in x.split(':'))))
@@ -328,6 +921,10 @@ def main():
     g.add_argument('--save-preds')
     g.add_argument('--load-preds')
 
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue an interrupted featurization into the '
+                             'existing --save-codes/--save-preds files')
+
     g = parser.add_mutually_exclusive_group()
     g.add_argument('--do-inception', action='store_true', default=True)
     g.add_argument('--no-inception', action='store_false', dest='do_inception')
@@ -345,15 +942,36 @@ def main():
 
     parser.add_argument('--mmd-subsets', type=int, default=100)
     parser.add_argument('--mmd-subset-size', type=int, default=1000)
+    parser.add_argument('--mmd-batch', type=int, default=10,
+                        help='number of subsets whose kernels are computed at once')
     g = parser.add_mutually_exclusive_group()
     g.add_argument('--mmd-var', action='store_true', default=False)
     g.add_argument('--no-mmd-var', action='store_false', dest='mmd_var')
 
+    parser.add_argument('--mmd-target-se', type=float, default=None,
+                        help='stop drawing MMD subsets once the standard '
+                             'error of the mean estimate is below this; '
+                             '--mmd-subsets is then the maximum')
+    parser.add_argument('--mmd-time-budget', type=float, default=None,
+                        help='stop drawing MMD subsets after this many seconds')
+
+    parser.add_argument('--ref-stats',
+                        help='cache file of the reference statistics; computed '
+                             'from REFERENCE_FEATS if missing or stale')
+
+    parser.add_argument('--kernel-dtype', choices=['float32', 'float64'],
+                        default='float32',
+                        help='dtype of the MMD kernel matrices; their sums '
+                             'are accumulated in float64')
+    parser.add_argument('--blas-threads', type=int, default=None)
+    parser.add_argument('--openmp-threads', type=int, default=None)
+
     parser.add_argument('--splits', type=int, default=10)
     parser.add_argument('--split-method', choices=['openai', 'bootstrap'],
                         default='bootstrap')
 
     args = parser.parse_args()
+    set_policy_from_args(args)
 
     if args.do_fid and args.reference_feats is None:
         parser.error("Need REFERENCE_FEATS if you're doing FID")
@@ -365,13 +983,78 @@ def main():
         if d and not os.path.exists(d):
             os.makedirs(d)
 
+    paths = sorted(glob(args.samples)) or [args.samples]
+    if args.samples_from:
+        with open(args.samples_from) as f:
+            paths += [line.strip() for line in f if line.strip()]
+
+    if len(paths) > 1 or args.results:
+        if not args.results:
+            parser.error("Need --results to score several samples files")
+        for opt in ['output', 'save_codes', 'load_codes', 'save_preds', 'load_preds', 'resume']:
+            if getattr(args, opt):
+                parser.error("--{} needs a single samples file".format(opt.replace('_', '-')))
+        check_path(args.results)
+        if args.workers > 1:
+            rows = score_files_parallel(paths, args)
+        else:
+            rows = score_files(paths, args)
+        write_results(args.results, rows)
+        print('Scores of {} samples files written to {}'.format(len(rows), args.results))
+        return
+
     if args.output:
         check_path(args.output)
 
     samples = np.load(args.samples, mmap_mode='r')
+    model = get_model(args.model)
+    transformer = get_transformer(args.model, samples)
+    ref_feats, ref_stats = load_reference(args, samples.shape[1])
+
+    def open_output(pth, dim):
+        shape = (samples.shape[0], dim)
+        if args.resume and os.path.exists(pth):
+            out = np.lib.format.open_memmap(pth, mode='r+')
+            if out.shape != shape or out.dtype != np.float32:
+                parser.error("Can't resume into {}: bad shape or dtype".format(pth))
+            return out
+        check_path(pth)
+        out = np.lib.format.open_memmap(pth, mode='w+', dtype=np.float32, shape=shape)
+        out.fill(np.nan)
+        return out
+
+    out_kw = {}
+    if args.save_codes:
+        out_kw['out_codes'] = open_output(args.save_codes, model.coder_dim)
+    if args.save_preds:
+        out_kw['out_preds'] = open_output(args.save_preds, model.softmax_dim)
+    if args.resume:
+        if not out_kw:
+            parser.error("--resume needs --save-codes or --save-preds")
+        out_kw['journal'] = (args.save_codes or args.save_preds) + '.journal'
+
+    with policy.limits():
+        output = score_samples(samples, model, transformer, args, ref_feats,
+                               ref_stats, **out_kw)
+    output['args'] = args
 
-    if args.model == 'inception':
-        model = Inception()
+    if args.output:
+        np.savez(args.output, **output)
+
+
+def set_policy_from_args(args):
+    return set_policy(kernel_dtype=args.kernel_dtype, blas_threads=args.blas_threads,
+                      openmp_threads=args.openmp_threads)
+
+
+def get_model(name):
+    if name not in EXTRACTORS:
+        raise ValueError("bad model {}".format(name))
+    return isolated_extractor(name)
+
+
+def get_transformer(name, samples):
+    if name == 'inception':
         if samples.dtype == np.uint8:
             transformer = np.asarray
         elif samples.dtype == np.float32:
@@ -380,8 +1063,7 @@ def main():
             transformer = lambda x: x * 255
         else:
             raise TypeError("don't know how to handle {}".format(samples.dtype))
-    elif args.model == 'lenet':
-        model = LeNet()
+    elif name == 'lenet':
         if samples.dtype == np.uint8:
             def transformer(x):
                 return (np.asarray(x, dtype=np.float32) - (255 / 2.)) / 255
@@ -392,24 +1074,31 @@ def main():
         else:
             raise TypeError("don't know how to handle {}".format(samples.dtype))
     else:
-        raise ValueError("bad model {}".format(args.model))
+        raise ValueError("bad model {}".format(name))
+    return transformer
+
 
+def load_reference(args, resolution):
+    ref_feats = ref_stats = None
     if args.reference_feats:
         ref_feats = np.load(args.reference_feats, mmap_mode='r')[
                 args.reference_subset]
 
-    out_kw = {}
-    if args.save_codes:
-        check_path(args.save_codes)
-        out_kw['out_codes'] = np.lib.format.open_memmap(
-            args.save_codes, mode='w+', dtype=np.float32,
-            shape=(samples.shape[0], model.coder_dim))
-    if args.save_preds:
-        check_path(args.save_preds)
-        out_kw['out_preds'] = np.lib.format.open_memmap(
-            args.save_preds, mode='w+', dtype=np.float32,
-            shape=(samples.shape[0], model.softmax_dim))
-
+    if args.ref_stats and args.reference_feats:
+        import refstats
+        key = refstats.stats_key(
+            os.path.basename(args.reference_feats), resolution,
+            args.model, ref_feats.shape[0])
+        ref_stats = refstats.load_or_compute(
+            args.ref_stats, ref_feats, key,
+            refstats.dataset_version(args.reference_feats),
+            n_subsets=args.mmd_subsets, subset_size=args.mmd_subset_size,
+            degree=args.mmd_degree, gamma=args.mmd_gamma, coef0=args.mmd_coef0)
+    return ref_feats, ref_stats
+
+
+def score_samples(samples, model, transformer, args, ref_feats=None,
+                  ref_stats=None, **out_kw):
     need_preds = args.do_inception or args.save_preds
     need_codes = args.do_fid or args.do_mmd or args.save_codes
 
@@ -440,7 +1129,7 @@ def main():
 
     split_args = {'splits': args.splits, 'split_method': args.split_method}
 
-    output = {'args': args}
+    output = {}
 
     if args.do_inception:
         output['inception'] = scores = inception_score(preds, **split_args)
@@ -449,17 +1138,28 @@ def main():
         print("Inception scores:", scores, sep='\n')
 
     if args.do_fid:
-        output['fid'] = scores = fid_score(codes, ref_feats, **split_args)
+        if ref_stats is not None:
+            output['fid'] = scores = ref_stats.fid(codes, **split_args)
+        else:
+            output['fid'] = scores = fid_score(codes, ref_feats, **split_args)
         print("FID mean:", np.mean(scores))
         print("FID std:", np.std(scores))
         print("FID scores:", scores, sep='\n')
         print()
 
     if args.do_mmd:
-        ret = polynomial_mmd_averages(
-            codes, ref_feats, degree=args.mmd_degree, gamma=args.mmd_gamma,
-            coef0=args.mmd_coef0, ret_var=args.mmd_var,
-            n_subsets=args.mmd_subsets, subset_size=args.mmd_subset_size)
+        stopping = None
+        if args.mmd_target_se or args.mmd_time_budget:
+            stopping = KIDStopping(args.mmd_target_se, args.mmd_time_budget)
+        if ref_stats is not None:
+            ret = ref_stats.kid(codes, ret_var=args.mmd_var, batch_size=args.mmd_batch,
+                                stopping=stopping)
+        else:
+            ret = polynomial_mmd_averages(
+                codes, ref_feats, degree=args.mmd_degree, gamma=args.mmd_gamma,
+                coef0=args.mmd_coef0, ret_var=args.mmd_var,
+                n_subsets=args.mmd_subsets, subset_size=args.mmd_subset_size,
+                batch_size=args.mmd_batch, stopping=stopping)
         if args.mmd_var:
             output['mmd2'], output['mmd2_var'] = mmd2s, vars = ret
         else:
@@ -474,8 +1174,106 @@ def main():
             print("Var[MMD^2] estimates:", vars, sep='\n')
             print()
 
-    if args.output:
-        np.savez(args.output, **output)
+    return output
+
+
+def prefetched(paths, load=np.load):
+    '''
+    Yields (path, load(path)) for each path; the next file is loaded in a
+    thread while the current one is processed.
+    '''
+    loaded = queue.Queue(maxsize=1)
+
+    def produce():
+        for path in paths:
+            try:
+                loaded.put((path, load(path)))
+            except Exception as e:
+                loaded.put((path, e))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    for _ in paths:
+        path, item = loaded.get()
+        if isinstance(item, Exception):
+            raise item
+        yield path, item
+
+
+def score_files(paths, args):
+    '''
+    Scores each samples file with a single model and reference; returns a
+    row of summary scores per file.
+    '''
+    model = get_model(args.model)
+    ref_feats = ref_stats = None
+    rows = []
+    for path, samples in prefetched(paths):
+        print('Scoring {}'.format(path))
+        if not rows:
+            ref_feats, ref_stats = load_reference(args, samples.shape[1])
+        with policy.limits():
+            output = score_samples(samples, model, get_transformer(args.model, samples),
+                                   args, ref_feats, ref_stats)
+        row = OrderedDict([('samples', path), ('n', samples.shape[0])])
+        for name in ['inception', 'fid', 'mmd2']:
+            if name in output:
+                row[name + '_mean'] = np.mean(output[name])
+                row[name + '_std'] = np.std(output[name])
+        if 'mmd2' in output:
+            row['mmd2_subsets'] = len(output['mmd2'])
+        rows.append(row)
+    return rows
+
+
+def _score_shard(job):
+    paths, args, gpu = job
+    if gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+    set_policy_from_args(args)
+    return score_files(paths, args)
+
+
+def score_files_parallel(paths, args):
+    '''
+    score_files with the files sharded across args.workers processes, each
+    loading its own model; rows are returned in the order of paths.
+    '''
+    import multiprocessing
+    n = min(args.workers, len(paths))
+    gpus = args.worker_gpus or [None]
+    jobs = [(paths[i::n], args, gpus[i % len(gpus)]) for i in range(n)]
+    # spawned workers, as the parent has already imported TensorFlow; python 2
+    # can only fork, which is fine as long as the parent has no session
+    if hasattr(multiprocessing, 'get_context'):
+        pool = multiprocessing.get_context('spawn').Pool(n)
+    else:
+        pool = multiprocessing.Pool(n)
+    try:
+        shards = pool.map(_score_shard, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    rows = [None] * len(paths)
+    for i, shard in enumerate(shards):
+        rows[i::n] = shard
+    return rows
+
+
+def write_results(path, rows):
+    columns = []
+    for row in rows:
+        columns += [c for c in row if c not in columns]
+    if path.endswith('.csv'):
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([row.get(c, '') for c in columns])
+    else:
+        np.savez(path, **dict((c, np.array([row.get(c, np.nan) for row in rows]))
+                              for c in columns))
 
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@ from functools import partial
 import tensorflow as tf
 
 from core.snops import batch_norm, conv2d, deconv2d, linear, lrelu, linear_one_hot
+from core.precision import cast, cast_like
 from utils.misc import conv_sizes
 # Generators
 
@@ -17,7 +18,7 @@ from utils.misc import conv_sizes
 class Generator(object):
     def __init__(self, dim, c_dim, output_size, use_batch_norm, prefix='g_',
                  with_sn=False, scale=1.0, with_learnable_sn_scale=False,
-                 format='NCHW', is_train=True):
+                 format='NCHW', is_train=True, dtype=tf.float32):
         self.used = False
         self.use_batch_norm = use_batch_norm
         self.dim = dim
@@ -29,6 +30,7 @@ class Generator(object):
         self.with_learnable_sn_scale = with_learnable_sn_scale
         self.format = format
         self.is_train = is_train
+        self.dtype = dtype
 
         self.g_bn0 = self.make_bn(0)
         self.g_bn1 = self.make_bn(1)
@@ -50,7 +52,9 @@ class Generator(object):
             if self.used:
                 scope.reuse_variables()
             self.used = True
-            return self.network(seed, batch_size, update_collection)
+            # activations run in self.dtype, outputs are always float32
+            output = self.network(cast(seed, self.dtype), batch_size, update_collection)
+            return cast(output, tf.float32)
 
     def network(self, seed, batch_size, update_collection):
         pass
@@ -72,7 +76,8 @@ class CondGenerator(Generator):
             if self.used:
                 scope.reuse_variables()
             self.used = True
-            return self.network(seed, y, batch_size, update_collection)
+            output = self.network(cast(seed, self.dtype), y, batch_size, update_collection)
+            return cast(output, tf.float32)
 
 
 class CondSNResNetGenerator(CondGenerator):
@@ -242,7 +247,7 @@ class SNGANGenerator(Generator):
 class Discriminator(object):
     def __init__(self, dim, o_dim, use_batch_norm, prefix='d_',
                  with_sn=False, scale=1.0, with_learnable_sn_scale=False,
-                 format='NCHW', is_train=True):
+                 format='NCHW', is_train=True, dtype=tf.float32, checkpoint_blocks=False):
         self.dim = dim
         self.o_dim = o_dim
         self.prefix = prefix
@@ -253,6 +258,9 @@ class Discriminator(object):
         self.with_learnable_sn_scale = with_learnable_sn_scale
         self.format = format
         self.is_train = is_train
+        self.dtype = dtype
+        # recompute residual block activations in the backward pass
+        self.checkpoint_blocks = checkpoint_blocks
 
         self.d_bn0 = self.make_bn(0)
         self.d_bn1 = self.make_bn(1)
@@ -277,7 +285,9 @@ class Discriminator(object):
             if self.used:
                 scope.reuse_variables()
             self.used = True
-            layers = self.network(image, batch_size, update_collection)
+            layers = self.network(cast(image, self.dtype), batch_size, update_collection)
+            # features are fed to the kernels in float32
+            layers = dict([(key, cast(val, tf.float32)) for key, val in layers.items()])
             if return_layers:
                 return layers
             return layers['hF']
@@ -296,7 +306,8 @@ class CondDiscriminator(Discriminator):
             if self.used:
                 scope.reuse_variables()
             self.used = True
-            layers = self.network(seed, batch_size, update_collection, y)
+            layers = self.network(cast(seed, self.dtype), batch_size, update_collection, y)
+            layers = dict([(key, cast(val, tf.float32)) for key, val in layers.items()])
             if return_layers:
                 return layers
             return layers['hF']
@@ -310,24 +321,25 @@ class CondProjectionSNResNetDiscriminator(CondDiscriminator):
         h0 = lrelu(ops.conv2d.Conv2D(self.prefix + 'h0_conv', 3, self.dim,
                                      3, image, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale))
         h1 = block.ResidualBlock(self.prefix + 'res1', self.dim,
-                                 2 * self.dim, 3, h0, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 2 * self.dim, 3, h0, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         h2 = block.ResidualBlock(self.prefix + 'res2', 2 * self.dim,
-                                 4 * self.dim, 3, h1, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 4 * self.dim, 3, h1, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         h3 = block.ResidualBlock(self.prefix + 'res3', 4 * self.dim,
-                                 8 * self.dim, 3, h2, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 8 * self.dim, 3, h2, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         h4 = block.ResidualBlock(self.prefix + 'res4', 8 * self.dim,
-                                 16 * self.dim, 3, h3, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 16 * self.dim, 3, h3, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         if image.get_shape().as_list()[2] == 64:
             h4_bis = h4
         else:
             h4_bis = block.ResidualBlock(self.prefix + 'res4_bis', 16 * self.dim,
-                                         16 * self.dim, 3, h4, resample=None, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                         16 * self.dim, 3, h4, resample=None, checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
 
         h4_bis = lrelu(h4_bis)
         h4_bis = tf.reduce_sum(h4_bis, axis=[2, 3])
         hF = linear(h4_bis, self.o_dim, self.prefix + 'h5_lin', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         if not y is None:
             w_y = linear_one_hot(y, self.o_dim, self.num_classes, name=self.prefix+"Linear_one_hot", update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+            w_y = cast(w_y, hF.dtype)
 
             hF += tf.reduce_sum(w_y*hF, axis=1, keepdims=True)
 
@@ -377,13 +389,13 @@ class ResNetDiscriminator(Discriminator):
         h0 = lrelu(ops.conv2d.Conv2D(self.prefix + 'h0_conv', 3, self.dim,
                                      3, image))
         h1 = block.ResidualBlock(self.prefix + 'res1', self.dim,
-                                 2 * self.dim, 3, h0, resample='down')
+                                 2 * self.dim, 3, h0, resample='down', checkpoint=self.checkpoint_blocks)
         h2 = block.ResidualBlock(self.prefix + 'res2', 2 * self.dim,
-                                 4 * self.dim, 3, h1, resample='down')
+                                 4 * self.dim, 3, h1, resample='down', checkpoint=self.checkpoint_blocks)
         h3 = block.ResidualBlock(self.prefix + 'res3', 4 * self.dim,
-                                 8 * self.dim, 3, h2, resample='down')
+                                 8 * self.dim, 3, h2, resample='down', checkpoint=self.checkpoint_blocks)
         h4 = block.ResidualBlock(self.prefix + 'res4', 8 * self.dim,
-                                 8 * self.dim, 3, h3, resample='down')
+                                 8 * self.dim, 3, h3, resample='down', checkpoint=self.checkpoint_blocks)
         h4 = tf.reshape(h4, [-1, 4 * 4 * 8 * self.dim])
         hF = linear(h4, self.o_dim, self.prefix + 'h5_lin')
         return {'h0': h0, 'h1': h1, 'h2': h2, 'h3': h3, 'h4': h4, 'hF': hF}
@@ -393,14 +405,15 @@ class InjectiveDiscriminator(Discriminator):
     def __init__(self, net):
         self.net = net
         self.scale_id_layer = 1.
-        super(InjectiveDiscriminator, self).__init__(net.dim, net.o_dim, net.use_batch_norm, prefix=net.prefix)
+        super(InjectiveDiscriminator, self).__init__(net.dim, net.o_dim, net.use_batch_norm, prefix=net.prefix,
+                                                     format=net.format, dtype=net.dtype)
 
     def network(self, image, batch_size, update_collection):
         layers = self.net.network(image, batch_size)
         id_layer_0 = tf.reshape(image, [batch_size, -1])
         init_value = 1./(id_layer_0.get_shape().as_list()[-1])
         self.scale_id_layer = tf.get_variable(name=self.prefix+'scale_id_layer', shape=[1], initializer=tf.constant_initializer(init_value), trainable=True, dtype=tf.float32)
-        id_layer = id_layer_0*self.scale_id_layer
+        id_layer = id_layer_0*cast_like(self.scale_id_layer, id_layer_0)
         hF = tf.concat([layers['hF'], id_layer], 1)
         layers['hF'] = hF
         return layers
@@ -429,18 +442,18 @@ class SNResNetDiscriminator(Discriminator):
         h0 = lrelu(ops.conv2d.Conv2D(self.prefix + 'h0_conv', 3, self.dim,
                                      3, image, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale))
         h1 = block.ResidualBlock(self.prefix + 'res1', self.dim,
-                                 2 * self.dim, 3, h0, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 2 * self.dim, 3, h0, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         h2 = block.ResidualBlock(self.prefix + 'res2', 2 * self.dim,
-                                 4 * self.dim, 3, h1, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 4 * self.dim, 3, h1, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         h3 = block.ResidualBlock(self.prefix + 'res3', 4 * self.dim,
-                                 8 * self.dim, 3, h2, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 8 * self.dim, 3, h2, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         h4 = block.ResidualBlock(self.prefix + 'res4', 8 * self.dim,
-                                 16 * self.dim, 3, h3, resample='down', update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                 16 * self.dim, 3, h3, resample='down', checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
         if image.get_shape().as_list()[2] == 64:
             h4_bis = h4
         else:
             h4_bis = block.ResidualBlock(self.prefix + 'res4_bis', 16 * self.dim,
-                                         16 * self.dim, 3, h4, resample=None, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
+                                         16 * self.dim, 3, h4, resample=None, checkpoint=self.checkpoint_blocks, update_collection=update_collection, with_sn=self.with_sn, with_learnable_sn_scale=self.with_learnable_sn_scale)
 
         h4_bis = lrelu(h4_bis)
         h4_bis = tf.reduce_sum(h4_bis, axis=[2, 3])
@@ -0,0 +1,276 @@
+"""
+Generator-only inference export.
+
+The generator is rebuilt in a fresh graph from the run config, without the
+input pipeline, discriminator, losses or optimizers, restored from a
+checkpoint of the run and frozen into a GraphDef: variables become
+constants and unused nodes are pruned. The batch size is dynamic.
+
+The batch norm moving statistics of the DCGAN and SNGAN generators are
+folded into the weights and biases of the linear and deconvolution layers
+(see fold_generator): the exported graph is the same generator built
+without batch norm, and is checked against the unfolded one before being
+written. The moving statistics of checkpoints written before the generator
+batch norm updates were run during training are still at their initial
+values, which is reported. The batch norms of the ResNet generators follow
+a ReLU and always use the batch statistics, so they are exported unfolded.
+
+    python main.py ... -export_generator export/cifar10
+
+writes export/cifar10.pb and export/cifar10.json; GeneratorSampler loads
+them without the dataset or the training code. As in training, the graph is
+NCHW and needs a GPU.
+"""
+from __future__ import division, print_function
+import os
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from .architecture import get_networks, DCGANGenerator, DCGAN5Generator, SNGANGenerator
+from .model import architecture_output_size, run_description
+
+FOLDABLE = (DCGANGenerator, DCGAN5Generator, SNGANGenerator)
+FOLD_TOLERANCE = 1e-4
+
+TRANSFORMS = [
+    'strip_unused_nodes',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'sort_by_execution_order',
+]
+
+
+def checkpoint_path(config):
+    "The checkpoint -ckpt_name of the run (a name in its checkpoint dir, or a path), or its latest one."
+    checkpoint_dir = os.path.join(config.out_dir, config.checkpoint_dir, config.name,
+                                  config.suffix + run_description(config))
+    if config.ckpt_name:
+        return os.path.join(checkpoint_dir, config.ckpt_name)
+    ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise IOError('No checkpoint found in %s' % checkpoint_dir)
+    return os.path.join(checkpoint_dir, os.path.basename(ckpt.model_checkpoint_path))
+
+
+def foldable(config):
+    return issubclass(get_networks(config.architecture)[0], FOLDABLE)
+
+
+def fold_generator(values, prefix='g_', format='NCHW', epsilon=1e-5):
+    '''
+    Folds the batch norm moving statistics of a snops generator into its
+    layers. `values` maps the names of the generator variables to their
+    values; returns the values of the variables of the same generator built
+    without batch norm. The batch norm g_bn<i> follows the layer g_h<i>
+    (g_h0_lin for i = 0).
+    '''
+    layers = {}
+    for name, value in values.items():
+        parts = name.split('/')
+        if len(parts) == 3:  # not optimizer slots
+            layers.setdefault(parts[1], {})[parts[2]] = value
+    folded = {}
+    for layer, v in sorted(layers.items()):
+        if layer.startswith(prefix + 'bn'):
+            continue
+        if 'u' in v:  # the generators are built without spectral normalization
+            raise ValueError('Cannot fold the spectrally normalized layer %s' % layer)
+        if 'Matrix' in v:
+            w_name, b_name, channel_axis = 'Matrix', 'bias', 1
+        elif 'w' in v:
+            w_name, b_name, channel_axis = 'w', 'biases', 2  # [k_h, k_w, out, in]
+        else:
+            raise ValueError('Cannot fold the generator layer %s' % layer)
+        w, b = v[w_name].astype(np.float64), v[b_name].astype(np.float64)
+        bn = layers.get(prefix + 'bn' + layer[len(prefix) + 1:].split('_')[0])
+        if bn is not None:
+            scale = bn['gamma'] / np.sqrt(bn['moving_variance'].astype(np.float64) + epsilon)
+            shift = bn['beta'] - bn['moving_mean'] * scale
+            if len(b) != len(scale):  # linear layer reshaped to an image
+                repeat = len(b) // len(scale)
+                scale, shift = ((np.repeat(x, repeat) if format == 'NCHW' else np.tile(x, repeat))
+                                for x in (scale, shift))
+            shape = [1] * w.ndim
+            shape[channel_axis] = -1
+            w = w * scale.reshape(shape)
+            b = b * scale + shift
+        folded['/'.join(['generator', layer, w_name])] = w.astype(np.float32)
+        folded['/'.join(['generator', layer, b_name])] = b.astype(np.float32)
+    return folded
+
+
+def build_generator(config, num_classes=1000, folded=False):
+    '''
+    Inference generator with a [None, z_dim] `z` input, and `y` for
+    conditional runs; returns the inputs and NHWC samples. The folded
+    generator has no batch norm.
+    '''
+    Generator = get_networks(config.architecture)[0]
+    gen_kw = {
+        'dim': config.gf_dim,
+        'c_dim': config.c_dim,
+        'output_size': architecture_output_size(config),
+        'use_batch_norm': config.batch_norm and not folded,
+        'format': 'NCHW',
+        'is_train': False,
+    }
+    inputs = {}
+    z = tf.placeholder(tf.float32, [None, config.z_dim], name='z')
+    inputs['z'] = z
+    batch_size = tf.shape(z)[0]
+    if config.with_labels:
+        gen_kw['num_classes'] = num_classes
+        y = tf.placeholder(tf.int32, [None], name='y')
+        inputs['y'] = y
+        G = Generator(**gen_kw)(z, y, batch_size, update_collection="NO_OPS")
+    else:
+        G = Generator(**gen_kw)(z, batch_size, update_collection="NO_OPS")
+    samples = tf.transpose(G, [0, 2, 3, 1], name='samples')
+    samples_uint8 = tf.cast(tf.round(255. * tf.clip_by_value(samples, 0., 1.)), tf.uint8,
+                            name='samples_uint8')
+    return inputs, {'samples': samples, 'samples_uint8': samples_uint8}
+
+
+def freeze_generator(config, checkpoint, fold=False, transforms=TRANSFORMS):
+    "Frozen and transformed GraphDef of the generator restored from `checkpoint`; returns it with its inputs and outputs."
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs, outputs = build_generator(config, folded=fold)
+        variables = tf.global_variables()
+        with tf.Session() as sess:
+            if fold:
+                reader = tf.train.NewCheckpointReader(checkpoint)
+                values = fold_generator(dict(
+                    (name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map()
+                    if name.startswith('generator/')))
+                for var in variables:
+                    var.load(values[var.op.name], sess)
+            else:
+                tf.train.Saver(variables).restore(sess, checkpoint)
+            output_nodes = [t.op.name for t in outputs.values()]
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), output_nodes)
+    input_nodes = [t.op.name for t in inputs.values()]
+    graph_def = TransformGraph(graph_def, input_nodes, output_nodes, transforms)
+    names = lambda d: dict((k, t.name) for k, t in d.items())
+    return graph_def, names(inputs), names(outputs)
+
+
+def initial_batch_norms(checkpoint, scope='generator'):
+    "The batch norms of `checkpoint` whose moving statistics were never updated."
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    names = reader.get_variable_to_shape_map()
+    return sorted(name[:-len('/moving_mean')] for name in names
+                  if name.startswith(scope + '/') and name.endswith('/moving_mean')
+                  and not reader.get_tensor(name).any()
+                  and (reader.get_tensor(name[:-len('mean')] + 'variance') == 1).all())
+
+
+def max_difference(graph_def, reference, inputs, output, z_dim, n=64, num_classes=0):
+    "Largest absolute difference between the `output` of two frozen generators on the same inputs."
+    feed = {inputs['z']: np.random.uniform(-1., 1., size=(n, z_dim)).astype(np.float32)}
+    if 'y' in inputs:
+        feed[inputs['y']] = np.random.randint(num_classes, size=n).astype(np.int32)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='folded')
+        tf.import_graph_def(reference, name='reference')
+        get = lambda scope, name: graph.get_tensor_by_name(scope + '/' + name)
+        with tf.Session() as sess:
+            a, b = sess.run([get('folded', output), get('reference', output)],
+                            dict((get(scope, k), v) for k, v in feed.items()
+                                 for scope in ['folded', 'reference']))
+    return float(np.abs(a - b).max())
+
+
+def export_generator(config, path, checkpoint=None, fold=True):
+    checkpoint = checkpoint or checkpoint_path(config)
+    fold = fold and foldable(config)
+    initial = initial_batch_norms(checkpoint)
+    if initial:
+        print('[!] The moving statistics of %s were never updated, the exported generator '
+              'will not match the training one' % ', '.join(initial))
+    graph_def, inputs, outputs = freeze_generator(config, checkpoint, fold=fold)
+    error = None
+    if fold:
+        reference = freeze_generator(config, checkpoint)[0]
+        error = max_difference(graph_def, reference, inputs, outputs['samples'], config.z_dim,
+                               num_classes=1000 if config.with_labels else 0)
+        print('[*] Folded generator differs from the unfolded one by at most %g' % error)
+        if error > FOLD_TOLERANCE:
+            raise ValueError('Folded generator differs from the unfolded one by %g' % error)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path + '.pb', 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta = {
+        'checkpoint': checkpoint,
+        'architecture': config.architecture,
+        'z_dim': config.z_dim,
+        'output_size': architecture_output_size(config),
+        'c_dim': config.c_dim,
+        'with_labels': config.with_labels,
+        'num_classes': 1000 if config.with_labels else 0,
+        'inputs': inputs,
+        'outputs': outputs,
+        'nodes': len(graph_def.node),
+        'folded': fold,
+        'fold_error': error,
+    }
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    print('[*] Generator of <%s> exported to <%s.pb> (%d nodes)' % (checkpoint, path, len(graph_def.node)))
+    return meta
+
+
+class GeneratorSampler(object):
+    '''
+    Samples from an exported generator, in a graph and session of its own.
+    z is drawn uniformly in [-1, 1] as in training, labels uniformly.
+    '''
+    def __init__(self, path, config=None):
+        start = time.time()
+        with open(path + '.json') as f:
+            self.meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(path + '.pb', 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        if config is None:
+            config = tf.ConfigProto(allow_soft_placement=True)
+            config.gpu_options.allow_growth = True
+        self.sess = tf.Session(graph=self.graph, config=config)
+        get = self.graph.get_tensor_by_name
+        self.inputs = dict((k, get(v)) for k, v in self.meta['inputs'].items())
+        self.outputs = dict((k, get(v)) for k, v in self.meta['outputs'].items())
+        self.load_time = time.time() - start
+
+    def inputs_feed(self, n, rng=np.random):
+        feed = {self.inputs['z']: rng.uniform(-1., 1., size=(n, self.meta['z_dim'])).astype(np.float32)}
+        if 'y' in self.inputs:
+            feed[self.inputs['y']] = rng.randint(self.meta['num_classes'], size=n).astype(np.int32)
+        return feed
+
+    def generate(self, z, y=None, uint8=True):
+        "The NHWC samples of z (and y), as uint8 or in [0, 1]."
+        feed = {self.inputs['z']: z}
+        if 'y' in self.inputs:
+            feed[self.inputs['y']] = y
+        return self.sess.run(self.outputs['samples_uint8' if uint8 else 'samples'], feed)
+
+    def sample(self, n, uint8=False, rng=np.random):
+        "n NHWC samples, in [0, 1] or as uint8."
+        output = self.outputs['samples_uint8' if uint8 else 'samples']
+        return self.sess.run(output, self.inputs_feed(n, rng))
+
+    def batches(self, n, batch_size=256, uint8=False, rng=np.random):
+        for start in range(0, n, batch_size):
+            yield self.sample(min(batch_size, n - start), uint8=uint8, rng=rng)
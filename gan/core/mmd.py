@@ -2,6 +2,7 @@
 MMD functions implemented in tensorflow.
 '''
 from __future__ import division
+from collections import deque
 
 import tensorflow as tf
 import numpy as np
@@ -424,14 +425,9 @@ def _get_sums(K_XY, K_YY, const_diagonal=False):
     return Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum
 
 
-def np_diff_polynomial_mmd2_and_ratio_with_saving(X, Y, saved_sums_for_Z):
-    dim = float(X.shape[1])
-    # TODO: could definitely do this faster
-    K_XY = (np.dot(X, Y.transpose()) / dim + 1) ** 3
-    K_YY = (np.dot(Y, Y.transpose()) / dim + 1) ** 3
-    m = float(K_YY.shape[0])
-
-    Y_related_sums = _np_get_sums(K_XY, K_YY)
+def np_diff_polynomial_mmd2_and_ratio_with_saving(X, Y, saved_sums_for_Z, block_size=1024):
+    m = float(Y.shape[0])
+    Y_related_sums = _np_polynomial_sums(X / float(X.shape[1]), Y, block_size)
 
     if saved_sums_for_Z is None:
         return Y_related_sums
@@ -529,9 +525,123 @@ def _np_get_sums(K_XY, K_YY, const_diagonal=False):
     K_XY_sums_0 = K_XY.sum(axis=0)
     K_XY_sums_1 = K_XY.sum(axis=1)
 
-    # TODO: turn these into dot products?
-    # should figure out if that's faster or not on GPU / with theano...
-    Kt_YY_2_sum = (K_YY ** 2).sum() - sum_diag2_Y
-    K_XY_2_sum = (K_XY ** 2).sum()
+    Kt_YY_2_sum = _np_sq_sum(K_YY) - sum_diag2_Y
+    K_XY_2_sum = _np_sq_sum(K_XY)
+
+    return Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum
+
+
+def _np_sq_sum(K, rows=128):
+    "Sum of the squares of K, accumulated in float64 a few rows at a time."
+    if K.dtype == np.float64:
+        flat = K.ravel()  # a view for contiguous blocks
+        return float(np.dot(flat, flat))
+    total = 0.
+    for start in range(0, K.shape[0], rows):
+        chunk = K[start:start + rows].astype(np.float64).ravel()
+        total += np.dot(chunk, chunk)
+    return float(total)
+
+
+def _np_polynomial_sums(X, Y, block_size=1024):
+    '''
+    The sums of _np_get_sums for the cubic kernel (<x, y> / dim + 1) ** 3,
+    with X already divided by dim. The kernels are computed block by block
+    in a single buffer of block_size ** 2, so memory does not grow with the
+    number of samples; K_YY blocks below the diagonal are not computed.
+    '''
+    # np.dot into the buffer needs both operands of its dtype
+    dtype = np.result_type(X, Y)
+    X, Y = np.asarray(X, dtype=dtype), np.asarray(Y, dtype=dtype)
+    Y_scaled = Y / np.asarray(Y.shape[1], dtype=dtype)
+    buf = np.empty(block_size * block_size, dtype=dtype)
+
+    def kernel(A, B):
+        K = buf[:len(A) * len(B)].reshape(len(A), len(B))
+        np.dot(A, B.T, out=K)
+        K += 1
+        np.power(K, 3, out=K)
+        return K
+
+    n_y = Y.shape[0]
+    Kt_YY_sums = np.zeros(n_y, dtype=np.float64)
+    Kt_YY_2_sum = 0.
+    for i in range(0, n_y, block_size):
+        rows = slice(i, i + block_size)
+        for j in range(i, n_y, block_size):
+            cols = slice(j, j + block_size)
+            K = kernel(Y_scaled[rows], Y[cols])
+            Kt_YY_sums[rows] += K.sum(axis=1, dtype=np.float64)
+            if i == j:
+                diag = np.diag(K).astype(np.float64)
+                Kt_YY_sums[rows] -= diag
+                Kt_YY_2_sum += _np_sq_sum(K) - np.dot(diag, diag)
+            else:
+                Kt_YY_sums[cols] += K.sum(axis=0, dtype=np.float64)
+                Kt_YY_2_sum += 2 * _np_sq_sum(K)
+
+    K_XY_sums_0 = np.zeros(n_y, dtype=np.float64)
+    K_XY_sums_1 = np.zeros(X.shape[0], dtype=np.float64)
+    K_XY_2_sum = 0.
+    for i in range(0, X.shape[0], block_size):
+        rows = slice(i, i + block_size)
+        for j in range(0, n_y, block_size):
+            cols = slice(j, j + block_size)
+            K = kernel(X[rows], Y[cols])
+            K_XY_sums_0[cols] += K.sum(axis=0, dtype=np.float64)
+            K_XY_sums_1[rows] += K.sum(axis=1, dtype=np.float64)
+            K_XY_2_sum += _np_sq_sum(K)
 
     return Kt_YY_sums, Kt_YY_2_sum, K_XY_sums_0, K_XY_sums_1, K_XY_2_sum
+
+
+class ThreeSampleState(object):
+    '''
+    State of the 3-sample test LR scheduler: the fixed reference codes X,
+    prescaled by the 1 / dim of the cubic polynomial kernel, and a ring
+    buffer of the kernel sums of the last `n` generated samples. The kernels
+    are computed in blocks of `block_size`, see _np_polynomial_sums.
+    '''
+    n_sums = 5
+
+    def __init__(self, X, n, block_size=1024):
+        self.X = (X / float(X.shape[1])).astype(X.dtype)
+        self.sums = deque(maxlen=n)
+        self.chances = 0
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.sums)
+
+    def full(self):
+        return len(self.sums) == self.sums.maxlen
+
+    def get_sums(self, Y):
+        "Sums of the kernels of Y, as returned by _np_get_sums."
+        return _np_polynomial_sums(self.X, Y, self.block_size)
+
+    def test(self, Y):
+        "MMD^2 difference and ratio of Y against the oldest saved sample, and the sums of Y."
+        Y_related_sums = self.get_sums(Y)
+        mmd2_diff, ratio = _np_diff_mmd2_and_ratio_from_sums(
+            Y_related_sums, self.sums[0], float(Y.shape[0]))
+        return mmd2_diff, ratio, Y_related_sums
+
+    def append(self, sums):
+        self.sums.append(sums)
+
+    def keep_last(self, k):
+        self.sums = deque(list(self.sums)[-k:] if k > 0 else [], maxlen=self.sums.maxlen)
+
+    def state_dict(self):
+        state = {'chances': np.array(self.chances), 'n_saved': np.array(len(self.sums))}
+        for i, sums in enumerate(self.sums):
+            for j, s in enumerate(sums):
+                state['sums_%d_%d' % (i, j)] = np.asarray(s)
+        return state
+
+    def load_state_dict(self, state):
+        self.chances = int(state['chances'])
+        self.sums.clear()
+        for i in range(int(state['n_saved'])):
+            self.sums.append(tuple(state['sums_%d_%d' % (i, j)] for j in range(self.n_sums)))
@@ -3,13 +3,48 @@ import os
 import sys
 import time
 import pprint
+from glob import glob
 
 import numpy as np
-from . import mmd
+from . import mmd, precision, sampling
 from .ops import safer_norm, tf, squared_norm_jacobian
 from .architecture import get_networks
 from .pipeline import get_pipeline
-from utils import timer, scorer, misc
+from utils import timer, scorer, misc, profiler
+import selection
+
+
+def architecture_output_size(config):
+    if config.architecture == 'dc128':
+        return 128
+    elif config.architecture in ['dc64', 'dcgan64']:
+        return 64
+    return config.output_size
+
+
+def run_description(config):
+    "Name of the run's directories, from its config."
+    discriminator_desc = '_dc'
+    if config.learning_rate_D in [config.learning_rate, -1]:
+        lr = 'lr%.8f' % config.learning_rate
+    else:
+        lr = 'lr%.8fG%fD' % (config.learning_rate, config.learning_rate_D)
+    arch = '%dx%d' % (config.gf_dim, config.df_dim)
+
+    description = ("%s%s_%s%s_%sd%d-%d-%d_%s_%s_%s" % (
+                   config.dataset, arch,
+                   config.architecture, discriminator_desc,
+                   config.model + '-' + config.kernel,
+                   config.dsteps,
+                   config.start_dsteps, config.gsteps, config.batch_size,
+                   architecture_output_size(config), lr))
+    if config.dof_dim > 1:
+        description += '_dof{}'.format(config.dof_dim)
+    if config.batch_norm:
+        description += '_bn'
+    if config.precision != 'float32':
+        description += '_' + config.precision
+    return description
 
 
 class MMD_GAN(object):
@@ -25,10 +60,7 @@ class MMD_GAN(object):
         self.format = 'NCHW'
         self.timer = timer.Timer()
         self.dataset = config.dataset
-        if config.architecture == 'dc128':
-            config.output_size = 128
-        elif config.architecture in ['dc64', 'dcgan64']:
-            config.output_size = 64
+        config.output_size = architecture_output_size(config)
         output_size = config.output_size
 
         self.sess = sess
@@ -52,27 +84,24 @@ class MMD_GAN(object):
         self.c_dim = config.c_dim
         self.input_dim = self.output_size*self.output_size*self.c_dim
 
-        discriminator_desc = '_dc'
-        if self.config.learning_rate_D == self.config.learning_rate:
-            lr = 'lr%.8f' % self.config.learning_rate
-        else:
-            lr = 'lr%.8fG%fD' % (self.config.learning_rate, self.config.learning_rate_D)
-        arch = '%dx%d' % (self.config.gf_dim, self.config.df_dim)
-
-        self.description = ("%s%s_%s%s_%sd%d-%d-%d_%s_%s_%s" % (
-                            self.dataset, arch,
-                            self.config.architecture, discriminator_desc,
-                            self.config.model + '-' + self.config.kernel,
-                            self.config.dsteps,
-                            self.config.start_dsteps, self.config.gsteps, self.batch_size,
-                            self.output_size, lr))
-        if self.config.dof_dim > 1:
-            self.description += '_dof{}'.format(self.config.dof_dim)
-        if self.config.batch_norm:
-            self.description += '_bn'
+        self.description = run_description(self.config)
+        self.compute_dtype = precision.get_dtype(self.config.precision)
+        # Logical batches are forwarded and backpropagated in micro-batches
+        self.accumulate_grads = self.config.is_train and self.config.grad_accum_steps > 1
+        if self.accumulate_grads and self.config.multi_gpu and self.config.global_mmd:
+            raise ValueError('Gradient accumulation cannot be combined with global_mmd')
+        if self.accumulate_grads and self.config.model.lower() not in ['mmd', 'smmd', 'swgan', 'gan']:
+            # the other losses add discriminator passes on the full batch
+            raise ValueError('Gradient accumulation is only supported by the mmd, smmd, swgan and gan models')
+        if self.config.multi_gpu and self.config.global_mmd and \
+                self.config.model.lower() not in ['mmd', 'smmd', 'swgan']:
+            # the other losses rebuild their discriminator passes on the gathered batch
+            raise ValueError('global_mmd is only supported by the mmd, smmd and swgan models')
 
         self.max_to_keep = 5
         self._ensure_dirs()
+        self.profiler = profiler.Profiler(config.profile, config.profile_window, config.trace_start,
+                                          config.trace_steps, log_dir=self.log_dir)
         self.with_labels = config.with_labels
         if self.with_labels:
             self.num_classes = 1000
@@ -88,7 +117,8 @@ class MMD_GAN(object):
             sys.stdout = self.log_file
             sys.stderr = self.log_file
         if config.compute_scores:
-            self.scorer = scorer.Scorer(self.sess, self.dataset, config.MMD_lr_scheduler, stdout=stdout)
+            self.scorer = scorer.Scorer(self.sess, self.dataset, config.MMD_lr_scheduler, stdout=stdout,
+                                        isolated='process' if config.score_process else config.score_isolated)
         print('Execution start time: %s' % time.ctime())
         pprint.PrettyPrinter().pprint(vars(self.config))
         #if self.config.multi_gpu:
@@ -138,6 +168,9 @@ class MMD_GAN(object):
             is_cpu_ps = False
             self.consolidation_device = '/gpu:0'
             self.config.num_gpus = 1
+        # With several towers, the kernel loss can be computed once on the
+        # features of the whole global batch instead of averaging per-tower MMDs
+        self.gather_towers = self.config.multi_gpu and self.config.global_mmd
         cpu_master_worker = '/cpu:1'
         cpu_data_processor = '/cpu:0'
 
@@ -148,6 +181,7 @@ class MMD_GAN(object):
 
             else:
                 self.batch_queue = tf.contrib.slim.prefetch_queue.prefetch_queue([self.image_batch], capacity=4 * self.config.num_gpus)
+            self.queue_size = self.batch_queue.size()
 
         with tf.device(cpu_master_worker):
             self.global_step = tf.Variable(0, name="global_step", trainable=False)
@@ -166,6 +200,11 @@ class MMD_GAN(object):
                                           name='scaling_coeff',
                                           trainable=False, dtype=tf.float32)
                     self.sc_decay_op = self.sc.assign(self.sc * self.config.sc_decay_rate)
+            # float16 gradients underflow without loss scaling, bfloat16 has the float32 range
+            self.g_loss_scale, self.d_loss_scale = None, None
+            if self.config.is_train and self.config.precision == 'float16':
+                self.g_loss_scale = precision.DynamicLossScale('g_loss_scale', self.config.loss_scale)
+                self.d_loss_scale = precision.DynamicLossScale('d_loss_scale', self.config.loss_scale)
 
             self.sample_z = tf.constant(np.random.uniform(-1, 1, size=(self.sample_size,
                                                           self.z_dim)).astype(np.float32),
@@ -178,6 +217,7 @@ class MMD_GAN(object):
         self.towers_g_grads = []
         self.towers_d_grads = []
         self.update_ops = []
+        self.towers = []
         with tf.variable_scope(tf.get_variable_scope()):
             for i in range(self.config.num_gpus):
                 worker = '/gpu:%d' % i
@@ -194,27 +234,49 @@ class MMD_GAN(object):
                     tf.get_variable_scope().reuse_variables()
                     with tf.name_scope('%s_%d' % ('tower', i)) as scope:
                         #if i==0:
-                        self.update_ops.extend(tf.get_collection(tf.GraphKeys.UPDATE_OPS, scope))
+                        self.update_ops.extend(self.tower_update_ops)
                         #else:
                         #    self.set_tower_loss(scope, images,Generator,Discriminator,update_collection="NO_OPS")
                         #    update_ops.extend(tf.get_collection(tf.GraphKeys.UPDATE_OPS,scope))
 
                         #update_ops.append(tf.get_collection(tf.GraphKeys.UPDATE_OPS,scope))
                         if self.config.is_train:
-                            losses.append([self.g_loss, self.d_loss])
-
                             if i == 0:
                                 t_vars = tf.trainable_variables()
                                 self.d_vars = [var for var in t_vars if 'd_' in var.name]
                                 self.g_vars = [var for var in t_vars if 'g_' in var.name]
-                            self.compute_grads()
-                            self.towers_g_grads.append(self.g_gvs)
-                            self.towers_d_grads.append(self.d_gvs)
+                            if self.gather_towers:
+                                self.towers.append(self.tower_outputs())
+                            else:
+                                losses.append([self.g_loss, self.d_loss])
+                                self.compute_grads()
+                                self.towers_g_grads.append(self.g_gvs)
+                                self.towers_d_grads.append(self.d_gvs)
 
                         summaries = tf.get_collection(tf.GraphKeys.SUMMARIES, scope)
 
+        if self.config.is_train and self.gather_towers:
+            with tf.device(self.consolidation_device):
+                self.gather_tower_outputs(self.towers)
+                self.set_loss(self.d_G, self.d_images)
+                losses.append([self.g_loss, self.d_loss])
+                self.compute_grads(colocate=True)
+                self.towers_g_grads.append(self.g_gvs)
+                self.towers_d_grads.append(self.d_gvs)
+            summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
+
         if self.config.is_train:
             self.set_optimizer()
+        if self.config.is_train and self.config.compute_scores and self.config.async_scoring:
+            self.build_scoring_generator(Generator)
+        if self.config.is_train and self.config.compute_scores:
+            self.scorer.fuse(self.G_NHWC)
+            if hasattr(self, 'scoring_G_NHWC'):
+                self.scorer.fuse(self.scoring_G_NHWC)
+
+        if self.config.bulk_sample_dir:
+            with tf.device('/gpu:0'):
+                self.build_bulk_sampler()
 
         block = min(8, int(np.sqrt(self.real_batch_size)), int(np.sqrt(self.batch_size)))
 
@@ -223,9 +285,51 @@ class MMD_GAN(object):
         summaries.append(tf.summary.image("train/gen_image",
                          self.imageRearrange(tf.clip_by_value(self.G_NHWC, 0, 1), block)))
         #self.TrainSummary = tf.summary.merge(summaries)
-        self.saver = tf.train.Saver(max_to_keep=self.max_to_keep)
+        saved = [var for var in tf.global_variables() if not var.op.name.startswith('async_scoring/')]
+        self.saver = tf.train.Saver(saved, max_to_keep=self.max_to_keep)
+        if hasattr(self, 'scoring_G_NHWC'):
+            self.scoring_saver = tf.train.Saver(saved, max_to_keep=2)
         print('[*] Model built.')
 
+    def build_scoring_generator(self, Generator):
+        """
+        Non-trainable copy of the generator, scored in the background while the
+        live generator keeps training.
+        """
+        def non_trainable(getter, *args, **kwargs):
+            kwargs['trainable'] = False
+            return getter(*args, **kwargs)
+
+        with tf.device('/gpu:%d' % (self.config.num_gpus - 1)), \
+                tf.variable_scope('async_scoring', custom_getter=non_trainable):
+            generator = Generator(**self.gen_kw)
+            z = tf.random_uniform([self.batch_size, self.z_dim], minval=-1., maxval=1., dtype=tf.float32)
+            if self.with_labels:
+                y = tf.random_uniform([self.batch_size], maxval=self.num_classes, dtype=tf.int32)
+                G = generator(z, y, self.batch_size, update_collection="NO_OPS")
+            else:
+                G = generator(z, self.batch_size, update_collection="NO_OPS")
+        if self.format == 'NCHW':
+            self.scoring_G_NHWC = tf.transpose(G, [0, 2, 3, 1])
+        else:
+            self.scoring_G_NHWC = G
+
+        live = dict([(var.op.name, var) for var in tf.global_variables()])
+        self.scoring_snapshot_op = tf.group(*[
+            var.assign(live[var.op.name[len('async_scoring/'):]])
+            for var in tf.global_variables('async_scoring')])
+        print('[*] Scoring generator built')
+
+    def snapshot_for_scoring(self, step):
+        "Copies the generator to its scoring copy and checkpoints the model; returns the checkpoint path."
+        self.sess.run(self.scoring_snapshot_op)
+        self._ensure_dirs('checkpoint')
+        return self.scoring_saver.save(self.sess, os.path.join(self.checkpoint_dir, 'scoring.model'),
+                                       global_step=step, latest_filename='scoring_checkpoint')
+
+    def copy_to_best(self, path):
+        selection.link_checkpoint(path, os.path.join(self.checkpoint_dir, 'best.model'))
+
     def average_gradients(self, tower_grads):
         """Calculate the average gradient for each shared variable across all towers.
         Note that this function provides a synchronization point across all towers.
@@ -274,6 +378,7 @@ class MMD_GAN(object):
             'use_batch_norm': self.config.batch_norm,
             'format': self.format,
             'is_train': self.config.is_train,
+            'dtype': self.compute_dtype,
         }
         disc_kw = {
             'dim': self.df_dim,
@@ -283,9 +388,12 @@ class MMD_GAN(object):
             'with_learnable_sn_scale': self.config.with_learnable_sn_scale,
             'format': self.format,
             'is_train': self.config.is_train,
+            'dtype': self.compute_dtype,
+            'checkpoint_blocks': self.config.checkpoint_blocks,
         }
         if self.with_labels:
             gen_kw['num_classes'] = disc_kw['num_classes'] = self.num_classes
+        self.gen_kw = gen_kw
         self.generator = Generator(**gen_kw)
         self.discriminator = Discriminator(**disc_kw)
 
@@ -293,35 +401,143 @@ class MMD_GAN(object):
         if self.with_labels:
             dist_y = tf.distributions.Categorical(probs=np.ones([self.num_classes])/self.num_classes)
             self.y = dist_y.sample(sample_shape=[self.batch_size], name='y')
-            self.G = self.generator(self.z, self.y, self.batch_size, update_collection=update_collection)
             self.sampler = self.generator(self.sample_z, self.sample_y, self.sample_size, update_collection="NO_OPS")
         else:
-            self.G = self.generator(self.z, self.batch_size, update_collection=update_collection)
+            self.y = None
             self.sampler = self.generator(self.sample_z, self.sample_size, update_collection="NO_OPS")
-
-        if self.format == 'NCHW':
-            self.G_NHWC = tf.transpose(self.G, [0, 2, 3, 1])
-        else:
-            self.G_NHWC = self.G
         if self.format == 'NCHW':  # convert to NHWC format for sampling images
             self.sampler = tf.transpose(self.sampler, [0, 2, 3, 1])
 
-        if self.with_labels:
-            self.d_images_layers = self.discriminator(self.images,
-                                                      self.real_batch_size,  return_layers=True, update_collection=update_collection, y=labels)
-            self.d_G_layers = self.discriminator(self.G,  self.batch_size,
-                                                 return_layers=True, update_collection="NO_OPS", y=self.y)
+        # the batch norm updates of the training passes only, not of the
+        # sampling ones; they are in the generator and discriminator name
+        # scopes, not in the tower one
+        n_update_ops = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+        if self.accumulate_grads:
+            self.set_micro_batches(images, labels, update_collection)
+            self.tower_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)[n_update_ops:]
+            # the concatenated micro-batches depend on their discriminator
+            # passes, samples and scores are generated on their own
+            if self.with_labels:
+                G = self.generator(self.z, self.y, self.batch_size, update_collection="NO_OPS")
+            else:
+                G = self.generator(self.z, self.batch_size, update_collection="NO_OPS")
         else:
-            self.d_images_layers = self.discriminator(self.images,
-                                                      self.real_batch_size,  return_layers=True, update_collection=update_collection)
-            self.d_G_layers = self.discriminator(self.G,  self.batch_size,
-                                                 return_layers=True, update_collection="NO_OPS")
+            self.G, self.d_G_layers, self.d_images_layers = self.forward(
+                self.z, self.y, self.images, labels, update_collection=update_collection)
+            self.tower_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)[n_update_ops:]
+            G = self.G
+
+        if self.format == 'NCHW':
+            self.G_NHWC = tf.transpose(G, [0, 2, 3, 1])
+        else:
+            self.G_NHWC = G
         self.d_images = self.d_images_layers['hF']
         self.d_G = self.d_G_layers['hF']
 
-        if self.config.is_train:
+        if self.config.is_train and not self.gather_towers:
             self.set_loss(self.d_G, self.d_images)
 
+    def forward(self, z, y, images, labels, G=None, update_collection="NO_OPS"):
+        bs, real_bs = z.get_shape().as_list()[0], images.get_shape().as_list()[0]
+        if self.with_labels:
+            if G is None:
+                G = self.generator(z, y, bs, update_collection=update_collection)
+            d_images_layers = self.discriminator(images, real_bs, return_layers=True,
+                                                 update_collection=update_collection, y=labels)
+            d_G_layers = self.discriminator(G, bs, return_layers=True, update_collection="NO_OPS", y=y)
+        else:
+            if G is None:
+                G = self.generator(z, bs, update_collection=update_collection)
+            d_images_layers = self.discriminator(images, real_bs, return_layers=True,
+                                                 update_collection=update_collection)
+            d_G_layers = self.discriminator(G, bs, return_layers=True, update_collection="NO_OPS")
+        return G, d_G_layers, d_images_layers
+
+    def micro_batch_outputs(self, z, y, images, labels, G=None, update_collection="NO_OPS"):
+        G, d_G_layers, d_images_layers = self.forward(z, y, images, labels, G, update_collection)
+        outputs = dict([('d_G/' + key, val) for key, val in d_G_layers.items()] +
+                       [('d_images/' + key, val) for key, val in d_images_layers.items()])
+        if self.config.with_scaling and not self.config.use_gaussian_noise:
+            outputs['norm2_jac'] = self.squared_norm_jacobian(d_images_layers['hF'], images)
+        return G, outputs
+
+    def set_micro_batches(self, images, labels, update_collection):
+        """
+        Forwards the logical batch in `grad_accum_steps` sequential micro-batches.
+        The discriminator features are concatenated as constants, so that the
+        kernel loss is computed once on the full batch; `accumulated_gradients`
+        then backpropagates it micro-batch by micro-batch.
+        """
+        k = self.config.grad_accum_steps
+        if (self.batch_size % k) or (self.real_batch_size % k):
+            raise ValueError('batch_size and real_batch_size must be divisible by grad_accum_steps')
+        split = lambda t: [None] * k if t is None else tf.split(t, k)
+        self.micro_batches = []
+        deps = []
+        for i, inputs in enumerate(zip(split(self.z), split(self.y), split(images), split(labels))):
+            # the next micro-batch starts once the previous one is done,
+            # so that only one set of activations is alive at a time
+            with tf.control_dependencies(deps):
+                inputs = [None if t is None else tf.identity(t) for t in inputs]
+            G, outputs = self.micro_batch_outputs(
+                *inputs, update_collection=update_collection if i == 0 else "NO_OPS")
+            G = tf.stop_gradient(G)
+            outputs = dict([(key, tf.stop_gradient(val)) for key, val in outputs.items()])
+            self.micro_batches.append({'inputs': inputs, 'G': G, 'outputs': outputs})
+            deps = [G] + list(outputs.values())
+
+        concat = lambda key: tf.concat([m['outputs'][key] for m in self.micro_batches], axis=0)
+        self.micro_outputs = dict([(key, concat(key)) for key in self.micro_batches[0]['outputs']])
+        self.G = tf.concat([m['G'] for m in self.micro_batches], axis=0)
+        self.d_G_layers, self.d_images_layers = {}, {}
+        for key, val in self.micro_outputs.items():
+            if key.startswith('d_G/'):
+                self.d_G_layers[key[len('d_G/'):]] = val
+            elif key.startswith('d_images/'):
+                self.d_images_layers[key[len('d_images/'):]] = val
+        if 'norm2_jac' in self.micro_outputs:
+            self.norm2_jac = self.micro_outputs['norm2_jac']
+        print('[*] Batch split into %d micro-batches' % k)
+
+    def tower_outputs(self):
+        outputs = {
+            'images': self.images,
+            'G': self.G,
+            'd_images_layers': self.d_images_layers,
+            'd_G_layers': self.d_G_layers,
+        }
+        # the discriminator passes of the penalties run on the tower: the
+        # gathered features cannot be differentiated w.r.t. the gathered inputs
+        if self.config.gradient_penalty > 0:
+            outputs['gp_data'], outputs['gp_features'] = self.interpolates()
+        if self.config.with_scaling:
+            x_hat_data, x_hat = self.scaling_inputs()
+            outputs['scaling_features'] = x_hat
+            outputs['norm2_jac'] = self.squared_norm_jacobian(x_hat, x_hat_data)
+        return outputs
+
+    def gather_tower_outputs(self, towers):
+        concat = lambda key: tf.concat([t[key] for t in towers], axis=0)
+        self.images = concat('images')
+        self.G = concat('G')
+        if self.format == 'NCHW':
+            self.G_NHWC = tf.transpose(self.G, [0, 2, 3, 1])
+        else:
+            self.G_NHWC = self.G
+        for layers in ['d_images_layers', 'd_G_layers']:
+            keys = towers[0][layers].keys()
+            self.__dict__[layers] = dict([
+                (key, tf.concat([t[layers][key] for t in towers], axis=0)) for key in keys])
+        self.d_images = self.d_images_layers['hF']
+        self.d_G = self.d_G_layers['hF']
+        if 'gp_data' in towers[0]:
+            self.gp_data = [t['gp_data'] for t in towers]
+            self.gp_features = concat('gp_features')
+        if 'norm2_jac' in towers[0]:
+            self.scaling_features = concat('scaling_features')
+            self.norm2_jac = concat('norm2_jac')
+        print('[*] Features of %d towers gathered' % len(towers))
+
     def set_loss(self, G, images):
         kernel = getattr(mmd, '_%s_kernel' % self.config.kernel)
         kerGI = kernel(G, images)
@@ -336,21 +552,38 @@ class MMD_GAN(object):
 
         print('[*] Loss set')
 
-    def add_gradient_penalty(self, kernel, fake, real):
-        bs = min([self.batch_size, self.real_batch_size])
-        real, fake = real[:bs], fake[:bs]
-
+    def interpolates(self):
+        "Random interpolates of the real and generated images, and their discriminator features."
+        bs = min([self.G.get_shape().as_list()[0], self.images.get_shape().as_list()[0]])
+        # with gradient accumulation the penalty is estimated on a micro-batch
+        bs //= self.config.grad_accum_steps
         alpha = tf.random_uniform(shape=[bs, 1, 1, 1])
         real_data = self.images[:bs]  # discirminator input level
         fake_data = self.G[:bs]  # discriminator input level
         x_hat_data = (1. - alpha) * real_data + alpha * fake_data
-        x_hat = self.discriminator(x_hat_data, bs, update_collection="NO_OPS")
+        return x_hat_data, self.discriminator(x_hat_data, bs, update_collection="NO_OPS")
+
+    def gradient_penalty(self, kernel, fake, real):
+        if self.gather_towers:
+            x_hat_data, x_hat = self.gp_data, self.gp_features
+        else:
+            x_hat_data, x_hat = self.interpolates()
+            x_hat_data = [x_hat_data]
+        bs = x_hat.get_shape().as_list()[0]
+        real, fake = real[:bs], fake[:bs]
+
         Ekx = lambda yy: tf.reduce_mean(kernel(x_hat, yy, K_XY_only=True), axis=1)
         Ekxr, Ekxf = Ekx(real), Ekx(fake)
         witness = Ekxr - Ekxf
-        gradients = tf.gradients(witness, [x_hat_data])[0]
+        # backpropagated through the discriminator of each tower
+        gradients = tf.concat(tf.gradients(witness, x_hat_data,
+                                           colocate_gradients_with_ops=self.gather_towers), axis=0)
 
-        penalty = tf.reduce_mean(tf.square(safer_norm(gradients, axis=1) - 1.0))
+        return tf.reduce_mean(tf.square(safer_norm(gradients, axis=1) - 1.0))
+
+    def add_gradient_penalty(self, kernel, fake, real):
+        if self.config.gradient_penalty > 0:
+            penalty = self.gradient_penalty(kernel, fake, real)
 
         with tf.variable_scope('loss'):
             if self.config.gradient_penalty > 0:
@@ -375,23 +608,37 @@ class MMD_GAN(object):
             tf.summary.scalar('L2_disc_penalty', self.d_L2_penalty)
             print('[*] L2 discriminator penalty added')
 
-    def add_scaling(self):
+    def squared_norm_jacobian(self, y, x):
+        # float16 activations are backpropagated with the discriminator loss scale
+        scale = None if self.d_loss_scale is None else self.d_loss_scale.scale
+        return squared_norm_jacobian(y, x, scale)
+
+    def scaling_inputs(self):
+        "Inputs of the scaling penalty and their discriminator features."
         if self.config.use_gaussian_noise:
-            x_hat_data = tf.random_normal(self.images.get_shape().as_list(), mean=0.,
+            shape = self.images.get_shape().as_list()
+            shape[0] //= self.config.grad_accum_steps
+            x_hat_data = tf.random_normal(shape, mean=0.,
                                    stddev=10., dtype=tf.float32, name='x_scaling')
-            x_hat = self.discriminator(x_hat_data, self.batch_size, update_collection="NO_OPS")
+            x_hat = self.discriminator(x_hat_data, x_hat_data.get_shape().as_list()[0], update_collection="NO_OPS")
         else:
             # Avoid rebuilding a new discriminator network subgraph
             x_hat_data = self.images
             x_hat = self.d_images
+        return x_hat_data, x_hat
 
-        
-
-
-        
-
-
-        norm2_jac = squared_norm_jacobian(x_hat, x_hat_data)
+    def add_scaling(self):
+        if self.gather_towers:
+            if not self.config.with_scaling:
+                return
+            # computed on the towers, see tower_outputs
+            x_hat, norm2_jac = self.scaling_features, self.norm2_jac
+        else:
+            x_hat_data, x_hat = self.scaling_inputs()
+            if self.accumulate_grads and not self.config.use_gaussian_noise:
+                norm2_jac = self.norm2_jac
+            else:
+                norm2_jac = self.squared_norm_jacobian(x_hat, x_hat_data)
 
         norm2_jac = tf.reduce_mean(norm2_jac)
         norm_discriminator = tf.reduce_mean(tf.square(x_hat))
@@ -453,33 +700,86 @@ class MMD_GAN(object):
             self.d_grads = self.d_optim.apply_gradients(self.d_gvs)
         print('[*] Gradients set')
 
-    def compute_grads(self):
+    def gradients(self, loss, var_list, loss_scale=None, colocate=False):
+        if self.accumulate_grads:
+            return self.accumulated_gradients(loss, var_list, loss_scale, colocate)
+        if loss_scale is None:
+            return tf.gradients(loss, var_list, colocate_gradients_with_ops=colocate)
+        return loss_scale.gradients(loss, var_list, colocate_gradients_with_ops=colocate)
+
+    def accumulated_gradients(self, loss, var_list, loss_scale=None, colocate=False):
+        """
+        The kernel loss couples all samples, so it is first differentiated
+        w.r.t. the concatenated micro-batch features. Each micro-batch is then
+        recomputed and backpropagated with those feature gradients, one after
+        the other, and the parameter gradients are summed.
+        """
+        if loss_scale is not None:
+            loss = loss * loss_scale.scale
+        keys = sorted(self.micro_outputs)
+        n = len(var_list)
+        grads = tf.gradients(loss, var_list + [self.micro_outputs[key] for key in keys],
+                             colocate_gradients_with_ops=colocate)
+        grads, feature_grads = grads[:n], grads[n:]
+        k = len(self.micro_batches)
+        feature_grads = [(key, tf.split(g, k)) for key, g in zip(keys, feature_grads) if g is not None]
+        # generated images are recomputed only for the generator gradients
+        regenerate = len(set(var_list) & set(self.g_vars)) > 0
+
+        deps = []
+        for i, micro in enumerate(self.micro_batches if feature_grads else []):
+            with tf.control_dependencies(deps):
+                inputs = [None if t is None else tf.identity(t) for t in micro['inputs']]
+                G = None if regenerate else tf.identity(micro['G'])
+            _, outputs = self.micro_batch_outputs(*inputs, G=G)
+            micro_grads = tf.gradients([outputs[key] for key, _ in feature_grads], var_list,
+                                       grad_ys=[g[i] for _, g in feature_grads],
+                                       colocate_gradients_with_ops=colocate)
+            grads = [g if mg is None else (mg if g is None else g + mg)
+                     for g, mg in zip(grads, micro_grads)]
+            deps = [g for g in micro_grads if g is not None]
+
+        if loss_scale is not None:
+            grads = [None if g is None else g / loss_scale.scale for g in grads]
+        return grads
+
+    def compute_grads(self, colocate=False):
         with tf.variable_scope("G_grads"):
-            self.g_gvs = tf.gradients(self.g_loss, self.g_vars)
+            self.g_gvs = self.gradients(self.g_loss, self.g_vars, self.g_loss_scale, colocate)
             self.g_gvs = zip(self.g_gvs, self.g_vars)
             if self.config.clip_grad:
                 self.g_gvs = [(tf.clip_by_norm(gg, 1.), vv) for gg, vv in self.g_gvs]
 
         with tf.variable_scope("D_grads"):
-            self.d_gvs = tf.gradients(self.d_loss, self.d_vars)
+            self.d_gvs = self.gradients(self.d_loss, self.d_vars, self.d_loss_scale, colocate)
             self.d_gvs = zip(self.d_gvs, self.d_vars)
             if self.config.clip_grad:
                 self.d_gvs = [(tf.clip_by_norm(gg, 1.), vv) for gg, vv in self.d_gvs]
         print('[*] Gradients set')
 
+    def apply_gradients(self, optimizer, gvs, loss_scale=None, **kwargs):
+        if loss_scale is None:
+            return optimizer.apply_gradients(gvs, **kwargs)
+        # skips the update and lowers the scale if the gradients overflowed
+        return loss_scale.apply_gradients(optimizer, gvs, **kwargs)
+
     def apply_grads(self):
         with tf.variable_scope("G_grads"):
             if len(self.g_gvs):
-                self.g_grads = self.g_optim.apply_gradients(
+                self.g_grads = self.apply_gradients(
+                    self.g_optim,
                     self.g_gvs,
+                    self.g_loss_scale,
                     global_step=self.global_step
                 )
             else:
                 self.d_grads = tf.no_op()
         with tf.variable_scope("D_grads"):
             if len(self.d_gvs):
-                self.d_grads = self.d_optim.apply_gradients(
+                self.d_grads = self.apply_gradients(
+                    self.d_optim,
                     self.d_gvs,
+                    self.d_loss_scale,
                     global_step=self.global_d_step
                 )
             else:
@@ -532,24 +832,30 @@ class MMD_GAN(object):
         eval_ops = [self.g_gvs, self.d_gvs, self.g_loss, self.d_loss]
         #print("step %d", step)
 
+        run_kwargs = self.profiler.run_kwargs(step)
+        # each tower dequeues a batch
+        self.profiler.wait_for_data(lambda: self.sess.run(self.queue_size) >= self.config.num_gpus)
+
         if self.config.is_demo:
             summary_str, g_grads, d_grads, g_loss, d_loss = self.sess.run(
                 [self.TrainSummary] + eval_ops
             )
         else:
-            if self.d_counter == 0:
-                if write_summary:
-                    _, summary_str, g_grads, d_grads, g_loss, d_loss = self.sess.run(
-                        [self.g_grads, self.TrainSummary] + eval_ops
-                    )
+            with self.profiler.phase('g_step' if (self.d_counter == 0) else 'd_step'):
+                if self.d_counter == 0:
+                    if write_summary:
+                        _, summary_str, g_grads, d_grads, g_loss, d_loss = self.sess.run(
+                            [self.g_grads, self.TrainSummary] + eval_ops, **run_kwargs
+                        )
 
-                else:
+                    else:
 
-                    _, g_grads, d_grads, g_loss, d_loss = self.sess.run([self.g_grads] + eval_ops)
-            else:
+                        _, g_grads, d_grads, g_loss, d_loss = self.sess.run([self.g_grads] + eval_ops, **run_kwargs)
+                else:
 
-                    _, g_grads, d_grads, g_loss, d_loss = self.sess.run([self.d_grads] + eval_ops)
-                #print("g loss: ",g_loss, ",  d loss:", d_loss)
+                        _, g_grads, d_grads, g_loss, d_loss = self.sess.run([self.d_grads] + eval_ops, **run_kwargs)
+                    #print("g loss: ",g_loss, ",  d loss:", d_loss)
+            self.profiler.add_trace(step, run_kwargs, 'g' if (self.d_counter == 0) else 'd%d' % self.d_counter)
             et = self.timer(step, "g step" if (self.d_counter == 0) else "d step", False)
 
         assert ~np.isnan(g_loss), et + "NaN g_loss, epoch: "
@@ -598,17 +904,35 @@ class MMD_GAN(object):
             self.save_checkpoint_and_samples(step)
             if self.config.save_layer_outputs:
                 self.save_layers(step)
+            if self.config.profile and (step % self.config.profile_window == 0) and (self.d_counter == 0):
+                self.profiler.write_summaries(self.writer, step, queue_size=self.sess.run(self.queue_size))
+        if self.config.compute_scores:
+            self.scorer.finish(self)
+        self.save_checkpoint(step)
+        if self.profiler.traces:
+            self.profiler.export_traces()
         self.pipe.stop()
 
     def save_checkpoint(self, step=None):
         if self._ensure_dirs('checkpoint'):
             if step is None:
-                self.saver.save(self.sess,
-                                os.path.join(self.checkpoint_dir, "best.model"))
+                return self.saver.save(self.sess,
+                                       os.path.join(self.checkpoint_dir, "best.model"))
             else:
-                self.saver.save(self.sess,
-                                os.path.join(self.checkpoint_dir, "MMDGAN.model"),
-                                global_step=step)
+                path = self.saver.save(self.sess,
+                                       os.path.join(self.checkpoint_dir, "MMDGAN.model"),
+                                       global_step=step)
+                self.save_scorer_state(path)
+                return path
+
+    def save_scorer_state(self, path):
+        "Saves the LR scheduler state next to the checkpoint `path`, dropping those of deleted checkpoints."
+        state = self.scorer.state_dict() if hasattr(self, 'scorer') else None
+        if state is not None:
+            np.savez(path + '.scorer.npz', **state)
+        for f in glob(os.path.join(self.checkpoint_dir, 'MMDGAN.model-*.scorer.npz')):
+            if not os.path.exists(f[:-len('.scorer.npz')] + '.index'):
+                os.remove(f)
 
     def load_checkpoint(self):
         print(" [*] Reading checkpoints...")
@@ -621,18 +945,24 @@ class MMD_GAN(object):
             else:
                 return False
         self.saver.restore(self.sess, os.path.join(self.checkpoint_dir, ckpt_name))
+        state_path = os.path.join(self.checkpoint_dir, ckpt_name) + '.scorer.npz'
+        if hasattr(self, 'scorer') and os.path.exists(state_path):
+            self.scorer.load_state_dict(dict(np.load(state_path)))
+            print(" [*] LR scheduler state restored")
         return True
 
     def save_checkpoint_and_samples(self, step, freq=1000):
         checkpoint_freq = 2000
         sample_freq = 1000
         if (np.mod(step, checkpoint_freq) == 0) and (self.d_counter == 0):
-            self.save_checkpoint(step)
+            with self.profiler.phase('checkpoint'):
+                self.save_checkpoint(step)
         if (np.mod(step, sample_freq) == 0) and (self.d_counter == 0):
-            samples = self.sess.run(self.sampler)
-            self._ensure_dirs('sample')
-            p = os.path.join(self.sample_dir, 'train_{:02d}.png'.format(step))
-            misc.save_images(samples[:64, :, :, :], [8, 8], p)
+            with self.profiler.phase('samples'):
+                samples = self.sess.run(self.sampler)
+                self._ensure_dirs('sample')
+                p = os.path.join(self.sample_dir, 'train_{:02d}.png'.format(step))
+                misc.save_images(samples[:64, :, :, :], [8, 8], p)
 
     def save_layers(self, step, freq=1000, n=256, layers=[-1, -2]):
         c = self.config.save_layer_outputs
@@ -664,6 +994,36 @@ class MMD_GAN(object):
             )
         return image_r
 
+    def build_bulk_sampler(self):
+        "Generator fed with z (and y) of any batch size, with uint8 NHWC samples."
+        self.bulk_z = tf.placeholder(tf.float32, [None, self.z_dim], name='bulk_z')
+        batch_size = tf.shape(self.bulk_z)[0]
+        if self.with_labels:
+            self.bulk_y = tf.placeholder(tf.int32, [None], name='bulk_y')
+            G = self.generator(self.bulk_z, self.bulk_y, batch_size, update_collection="NO_OPS")
+        else:
+            G = self.generator(self.bulk_z, batch_size, update_collection="NO_OPS")
+        if self.format == 'NCHW':
+            G = tf.transpose(G, [0, 2, 3, 1])
+        self.bulk_samples = tf.cast(tf.round(255. * tf.clip_by_value(G, 0., 1.)), tf.uint8)
+
+    def bulk_sample(self, n, directory):
+        "Samples n images to uint8 shards of `directory`, resuming from the shards already there."
+        if not self.initialize_for_sampling():
+            return
+
+        def generate(z, y):
+            feed = {self.bulk_z: z}
+            if self.with_labels:
+                feed[self.bulk_y] = y
+            return self.sess.run(self.bulk_samples, feed)
+
+        return sampling.bulk_sample(
+            generate, n, directory, self.z_dim, shard_size=self.config.sample_shard_size,
+            batch_size=self.config.sample_batch_size or self.batch_size,
+            seed=self.config.sample_seed, fmt=self.config.sample_format,
+            num_classes=self.num_classes if self.with_labels else 0)
+
     def _evaluate_tensors(self, variable_dict, n=None):
         if n is None:
             n = self.batch_size
@@ -678,7 +1038,7 @@ class MMD_GAN(object):
             values[key] = np.concatenate(val, axis=0)[:n]
         return values
 
-    def get_samples(self, n=None, save=True, layers=[]):
+    def initialize_for_sampling(self):
         if not (self.initialized_for_sampling or self.config.is_train):
             print('[*] Loading from ' + self.checkpoint_dir + '...')
             self.sess.run(tf.local_variables_initializer())
@@ -688,7 +1048,13 @@ class MMD_GAN(object):
                       self.sess.run(self.global_step))
             else:
                 print(" [!] Load failed...")
-                return
+                return False
+            self.initialized_for_sampling = True
+        return True
+
+    def get_samples(self, n=None, save=True, layers=[]):
+        if not self.initialize_for_sampling():
+            return
 
         if len(layers) > 0:
             outputs = dict([(key + '_features', val) for key, val in self.d_G_layers.items()])
@@ -228,9 +228,20 @@ def dot(x, y, name=None):
         return tf.squeeze(tf.matmul(tf.expand_dims(x, 0), tf.expand_dims(y, 1)))
 
 
-def squared_norm_jacobian(y, x):
+def squared_norm_jacobian(y, x, scale=None):
+    """
+    Squared Frobenius norm of the Jacobian of y w.r.t. x, per sample, in
+    float32. With reduced precision activations, `scale` is a loss scale
+    applied to y so that their gradients do not underflow.
+    """
     d = y.shape.as_list()[1]
+    y, x = tf.cast(y, tf.float32), tf.cast(x, tf.float32)
+
+    def gradients(i):
+        if scale is None:
+            return tf.gradients(y[:, i], x)[0]
+        return tf.cast(tf.gradients(y[:, i] * scale, x)[0], tf.float32) / scale
     norm_gradients = tf.stack(
-        [tf.reduce_sum(tf.square(tf.gradients(y[:, i], x)[0]), axis=[1, 2, 3]) for i in range(d)])
+        [tf.reduce_sum(tf.square(gradients(i)), axis=[1, 2, 3]) for i in range(d)])
     norm2_jac = tf.reduce_sum(norm_gradients, axis=0)
     return norm2_jac
@@ -0,0 +1,72 @@
+"""
+Reduced precision helpers: activations run in float16/bfloat16 while the
+variables (master weights), the kernels and the spectral norm stay in float32.
+"""
+import tensorflow as tf
+
+
+DTYPES = {
+    'float32': tf.float32,
+    'float16': tf.float16,
+    'bfloat16': tf.bfloat16,
+}
+
+
+def get_dtype(precision):
+    if precision not in DTYPES:
+        raise ValueError('Wrong precision: "%s"' % precision)
+    return DTYPES[precision]
+
+
+def cast(x, dtype):
+    if x.dtype.base_dtype == dtype:
+        return x
+    return tf.cast(x, dtype)
+
+
+def cast_like(w, x):
+    "Casts a (float32) weight to the dtype of the activations it is applied to."
+    return cast(w, x.dtype.base_dtype)
+
+
+class DynamicLossScale(object):
+    """
+    Dynamic loss scaling for float16 gradients: the loss is multiplied by
+    `scale` before differentiation, updates with non-finite gradients are
+    skipped and halve the scale, and the scale doubles after
+    `incr_every_n_steps` consecutive finite updates.
+    """
+    def __init__(self, name, init_scale=2.**15, factor=2., incr_every_n_steps=2000, min_scale=1.):
+        self.factor = factor
+        self.incr_every_n_steps = incr_every_n_steps
+        self.min_scale = min_scale
+        with tf.variable_scope(name):
+            self.scale = tf.Variable(init_scale, name='loss_scale',
+                                     trainable=False, dtype=tf.float32)
+            self.good_steps = tf.Variable(0, name='good_steps',
+                                          trainable=False, dtype=tf.int32)
+        tf.summary.scalar(name, self.scale)
+
+    def gradients(self, loss, var_list, **kwargs):
+        grads = tf.gradients(loss * self.scale, var_list, **kwargs)
+        return [None if g is None else g / self.scale for g in grads]
+
+    def all_finite(self, grads):
+        return tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g in grads if g is not None])
+
+    def apply_gradients(self, optimizer, gvs, **kwargs):
+        finite = self.all_finite([g for g, _ in gvs])
+        apply_op = tf.cond(finite, lambda: optimizer.apply_gradients(gvs, **kwargs), tf.no_op)
+        with tf.control_dependencies([apply_op]):
+            return tf.cond(finite, self._increase, self._decrease)
+
+    def _increase(self):
+        grow = self.good_steps + 1 >= self.incr_every_n_steps
+        return tf.group(
+            self.scale.assign(tf.where(grow, self.scale * self.factor, self.scale)),
+            self.good_steps.assign(tf.where(grow, 0, self.good_steps + 1)))
+
+    def _decrease(self):
+        return tf.group(
+            self.scale.assign(tf.maximum(self.scale / self.factor, self.min_scale)),
+            self.good_steps.assign(0))
@@ -2,14 +2,70 @@
 Based on https://github.com/igul222/improved_wgan_training/blob/master/gan_64x64.py.
 """
 import functools
+import uuid
+import weakref
+
 import tensorflow as tf
+from core import sn
 from core.resnet.ops import conv2d, batchnorm, layernorm, cond_batchnorm
 
 
-def ResidualBlock(name, input_dim, output_dim, filter_size, inputs, y=None, num_classes=None, resample=None, he_init=True, mode='', with_sn=False, with_learnable_sn_scale=False, update_collection=None):
+def ResidualBlock(name, input_dim, output_dim, filter_size, inputs, y=None, num_classes=None, resample=None, he_init=True, mode='', with_sn=False, with_learnable_sn_scale=False, update_collection=None, checkpoint=False):
     """
     resample: None, 'down', or 'up'
+    checkpoint: if True, the block activations are not kept for the backward
+        pass but recomputed from the block input
+    """
+    block = functools.partial(_ResidualBlock, name, input_dim, output_dim, filter_size, y=y, num_classes=num_classes,
+                              resample=resample, he_init=he_init, mode=mode, with_sn=with_sn,
+                              with_learnable_sn_scale=with_learnable_sn_scale)
+    if checkpoint:
+        return Checkpoint(name, block, inputs, update_collection=update_collection)
+    return block(inputs=inputs, update_collection=update_collection)
+
+
+# a token per graph makes the gradient names of its blocks unique in the
+# global gradient registry, independently of the other graphs
+_graph_tokens = weakref.WeakKeyDictionary()
+
+
+def _gradient_name(graph, name):
+    token = _graph_tokens.setdefault(graph, uuid.uuid4().hex[:8])
+    return '%s/%s' % (token, graph.unique_name('ResidualBlockCheckpoint/' + name, mark_as_used=True))
+
+
+def Checkpoint(name, block, inputs, update_collection=None):
+    """
+    Runs `block(inputs=inputs)` so that none of its intermediate activations
+    are used by the gradient: the output goes through an IdentityN op whose
+    gradient rebuilds the block on its input and backpropagates through the
+    copy. The copy is an ordinary subgraph, so it can be differentiated again
+    (gradient penalty, scaling). It reuses the stop-gradient power iteration
+    vectors of the forward pass, so that its spectral norms are the ones of
+    the forward pass even when that pass updated u.
     """
+    graph = tf.get_default_graph()
+    var_scope = tf.get_variable_scope()
+    with sn.record_power_iterations() as power_iterations:
+        output = block(inputs=tf.stop_gradient(inputs), update_collection=update_collection)
+    prefix = (var_scope.name + '/' if var_scope.name else '') + name + '.'
+    variables = [v for v in tf.trainable_variables() if v.op.name.startswith(prefix)]
+
+    grad_name = _gradient_name(graph, name)
+
+    @tf.RegisterGradient(grad_name)
+    def _recompute_grad(op, grad, *unused_grads):
+        x, params = op.inputs[1], list(op.inputs[2:])
+        with tf.variable_scope(var_scope, reuse=True), sn.reuse_power_iterations(power_iterations):
+            recomputed = block(inputs=x, update_collection="NO_OPS")
+        grads = tf.gradients(recomputed, [x] + params, grad_ys=grad)
+        return [None] + grads
+
+    with graph.gradient_override_map({'IdentityN': grad_name}):
+        return tf.identity_n([output, inputs] + [v.value() for v in variables])[0]
+
+
+def _ResidualBlock(name, input_dim, output_dim, filter_size, inputs, y=None, num_classes=None, resample=None, he_init=True, mode='', with_sn=False, with_learnable_sn_scale=False, update_collection=None):
     if resample == 'down':
         conv_shortcut = MeanPoolConv
         conv_1 = functools.partial(conv2d.Conv2D, input_dim=input_dim, output_dim=input_dim)
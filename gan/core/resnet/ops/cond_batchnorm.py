@@ -11,7 +11,7 @@ def Batchnorm(name, axes, inputs, is_training=None, stats_iter=None, update_movi
     shape = mean.get_shape().as_list() # shape is [1,n,1,1]
     offset_m = lib.param(name+'.offset', np.zeros([n_labels,shape[1]], dtype='float32'))
     scale_m = lib.param(name+'.scale', np.ones([n_labels,shape[1]], dtype='float32'))
-    offset = tf.nn.embedding_lookup(offset_m, labels)
-    scale = tf.nn.embedding_lookup(scale_m, labels)
+    offset = tf.cast(tf.nn.embedding_lookup(offset_m, labels), inputs.dtype)
+    scale = tf.cast(tf.nn.embedding_lookup(scale_m, labels), inputs.dtype)
     result = tf.nn.batch_normalization(inputs, mean, var, offset[:,:,None,None], scale[:,:,None,None], 1e-5)
     return result
\ No newline at end of file
@@ -4,6 +4,7 @@ Based on https://github.com/igul222/improved_wgan_training/blob/master/
 
 import tensorflow as tf
 from ... import sn
+from ...precision import cast_like
 
 default_weightnorm = False
 
@@ -30,12 +31,12 @@ def Conv2D(name, input_dim, output_dim, filter_size, inputs, stride=1, biases=Tr
             s = tf.get_variable('s', shape=[1], initializer=tf.constant_initializer(scale), trainable=with_learnable_sn_scale, dtype=tf.float32)
             w_bar, sigma = sn.spectral_normed_weight(w, update_collection=update_collection, with_sigma=True)
             w_bar = s*w_bar
-            conv = tf.nn.conv2d(inputs, w_bar, strides=strides, padding='SAME', data_format='NCHW')
+            conv = tf.nn.conv2d(inputs, cast_like(w_bar, inputs), strides=strides, padding='SAME', data_format='NCHW')
         else:
-            conv = tf.nn.conv2d(inputs, w, strides=strides, padding='SAME', data_format='NCHW')
+            conv = tf.nn.conv2d(inputs, cast_like(w, inputs), strides=strides, padding='SAME', data_format='NCHW')
 
         if biases:
             biases = tf.get_variable('biases', [output_dim], initializer=tf.constant_initializer(0.0))
-            conv = tf.reshape(tf.nn.bias_add(conv, biases, data_format='NCHW'), conv.get_shape())
+            conv = tf.reshape(tf.nn.bias_add(conv, cast_like(biases, conv), data_format='NCHW'), conv.get_shape())
 
         return conv
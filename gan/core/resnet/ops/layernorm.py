@@ -15,8 +15,8 @@ def Layernorm(name, norm_axes, inputs):
     scale = lib.param(name+'.scale', np.ones(n_neurons, dtype='float32'))
 
     # Add broadcasting dims to offset and scale (e.g. BCHW conv data)
-    offset = tf.reshape(offset, [-1] + [1 for i in range(len(norm_axes)-1)])
-    scale = tf.reshape(scale, [-1] + [1 for i in range(len(norm_axes)-1)])
+    offset = tf.cast(tf.reshape(offset, [-1] + [1 for i in range(len(norm_axes)-1)]), inputs.dtype)
+    scale = tf.cast(tf.reshape(scale, [-1] + [1 for i in range(len(norm_axes)-1)]), inputs.dtype)
 
     result = tf.nn.batch_normalization(inputs, mean, var, offset, scale, 1e-5)
 
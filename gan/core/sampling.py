@@ -0,0 +1,182 @@
+"""
+Bulk sampling of a generator to sharded uint8 files:
+
+    <dir>/samples.json          n, shard size, seed, format and image shape
+    <dir>/samples-00000.npy     [shard_size, H, W, C] uint8
+    <dir>/samples-00001.npy     ...
+
+or, with the png format, one directory of PNG files per shard. The z (and y)
+of shard i are drawn from RandomState([seed, i]), so its samples do not
+depend on the sampling batch size nor on the shards already written. Shards
+are filled on the host while a writer thread saves the previous ones, under
+a temporary name renamed once complete: an interrupted run is resumed by
+running it again, and only the missing shards are sampled.
+
+From the training graph, with a sampling batch size independent of
+-batch_size:
+
+    python main.py ... -is_train false -bulk_sample_dir $DIR -no_of_samples 100000 -sample_batch_size 1000
+
+or from an exported generator (see core/export.py), from the gan directory:
+
+    python -m core.sampling export/cifar10 $DIR -n 100000
+"""
+from __future__ import division, print_function
+import os
+import sys
+import json
+import shutil
+import argparse
+import threading
+
+import numpy as np
+from six.moves import queue
+from tqdm import tqdm
+
+
+def shard_path(directory, shard, fmt='npy'):
+    return os.path.join(directory, 'samples-%05d' % shard + ('.npy' if fmt == 'npy' else ''))
+
+
+def shard_inputs(shard, size, z_dim, seed=0, num_classes=0):
+    "The z, and labels y for conditional generators, of a shard."
+    rng = np.random.RandomState([seed, shard])
+    z = rng.uniform(-1., 1., size=(size, z_dim)).astype(np.float32)
+    y = rng.randint(num_classes, size=size).astype(np.int32) if num_classes else None
+    return z, y
+
+
+def write_shard(path, images, fmt='npy'):
+    tmp = path + '.tmp'
+    if fmt == 'npy':
+        with open(tmp, 'wb') as f:
+            np.save(f, images, allow_pickle=False)
+    else:
+        from PIL import Image
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for i, image in enumerate(images):
+            if image.shape[-1] == 1:
+                image = image[..., 0]
+            Image.fromarray(image).save(os.path.join(tmp, '%06d.png' % i))
+    os.rename(tmp, path)
+
+
+class ShardWriter(object):
+    '''
+    Writes shards in a background thread. At most `max_pending` shards wait
+    to be written, which bounds the host memory; the first error is raised
+    by the next put or by close.
+    '''
+    def __init__(self, fmt='npy', max_pending=2):
+        self.fmt = fmt
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error is None:  # keep draining so that put never blocks
+                try:
+                    write_shard(item[0], item[1], self.fmt)
+                except Exception as e:
+                    self.error = e
+
+    def put(self, path, images):
+        if self.error is not None:
+            raise self.error
+        self.pending.put((path, images))
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def bulk_sample(generate, n, directory, z_dim, shard_size=10000, batch_size=1000, seed=0,
+                fmt='npy', num_classes=0, max_pending=2, output=sys.stdout):
+    '''
+    Samples n images with generate(z, y), which returns uint8 NHWC batches,
+    to the shards of `directory`; returns the shard paths.
+    '''
+    if fmt not in ['npy', 'png']:
+        raise ValueError('Unknown sample format %s' % fmt)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    meta = {'n': n, 'shard_size': shard_size, 'seed': seed, 'format': fmt,
+            'z_dim': z_dim, 'num_classes': num_classes}
+    meta_path = os.path.join(directory, 'samples.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            stored = json.load(f)
+        different = [k for k, v in meta.items() if stored.get(k) != v]
+        if different:
+            raise ValueError('%s holds samples drawn with different %s'
+                             % (directory, ', '.join(sorted(different))))
+        meta = stored
+    sizes = [min(shard_size, n - start) for start in range(0, n, shard_size)]
+    paths = [shard_path(directory, i, fmt) for i in range(len(sizes))]
+    todo = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+    if len(todo) < len(paths):
+        print('Resuming: %d of %d shards already sampled' % (len(paths) - len(todo), len(paths)),
+              file=output)
+
+    writer = ShardWriter(fmt, max_pending)
+    try:
+        with tqdm(total=n, unit='img', unit_scale=True, file=output) as t:
+            t.update(n - sum(sizes[i] for i in todo))
+            for i in todo:
+                z, y = shard_inputs(i, sizes[i], z_dim, seed, num_classes)
+                images = None
+                for start in range(0, sizes[i], batch_size):
+                    end = min(start + batch_size, sizes[i])
+                    batch = generate(z[start:end], None if y is None else y[start:end])
+                    if images is None:
+                        images = np.empty((sizes[i],) + batch.shape[1:], dtype=np.uint8)
+                    images[start:end] = batch
+                    t.update(end - start)
+                if 'shape' not in meta:
+                    meta['shape'] = list(images.shape[1:])
+                    with open(meta_path, 'w') as f:
+                        json.dump(meta, f, indent=1, sort_keys=True)
+                writer.put(paths[i], images)
+    finally:
+        writer.close()
+    return paths
+
+
+def load_samples(directory, mmap_mode='r'):
+    "The npy shards of `directory` (memory-mapped by default), in order."
+    with open(os.path.join(directory, 'samples.json')) as f:
+        meta = json.load(f)
+    n_shards = -(-meta['n'] // meta['shard_size'])
+    return [np.load(shard_path(directory, i), mmap_mode=mmap_mode) for i in range(n_shards)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sample an exported generator to sharded uint8 files.')
+    parser.add_argument('generator', type=str, help='path of the export, without .pb')
+    parser.add_argument('directory', type=str)
+    parser.add_argument('-n', type=int, default=100000, help='[%(default)s]')
+    parser.add_argument('--shard-size', type=int, default=10000, help='[%(default)s]')
+    parser.add_argument('--batch-size', type=int, default=1000, help='[%(default)s]')
+    parser.add_argument('--seed', type=int, default=0, help='[%(default)s]')
+    parser.add_argument('--format', choices=['npy', 'png'], default='npy', help='[%(default)s]')
+    args = parser.parse_args()
+
+    from .export import GeneratorSampler
+    sampler = GeneratorSampler(args.generator)
+    bulk_sample(sampler.generate, args.n, args.directory, sampler.meta['z_dim'],
+                shard_size=args.shard_size, batch_size=args.batch_size, seed=args.seed,
+                fmt=args.format, num_classes=sampler.meta['num_classes'])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,42 @@
 Based on https://github.com/minhnhat93/tf-SNDCGAN/tree/master/libs/sn.py
 """
 
+from contextlib import contextmanager
+import weakref
+
 import tensorflow as tf
 import warnings
 
 
 NO_OPS = 'NO_OPS'
 
+# per graph, stacks of the power iterations recorded and reused by
+# recomputed subgraphs (see resnet.block.Checkpoint)
+_recorded = weakref.WeakKeyDictionary()
+_reused = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def record_power_iterations():
+    "Yields a dict filled with the (u, v) of the weights normalized within, by weight name."
+    stack = _recorded.setdefault(tf.get_default_graph(), [])
+    stack.append({})
+    try:
+        yield stack[-1]
+    finally:
+        stack.pop()
+
+
+@contextmanager
+def reuse_power_iterations(iterations):
+    "Within, the weights in `iterations` are normalized with their recorded u and v."
+    stack = _reused.setdefault(tf.get_default_graph(), [])
+    stack.append(iterations)
+    try:
+        yield
+    finally:
+        stack.pop()
+
 
 def _l2normalize(v, eps=1e-12):
     return v / (tf.reduce_sum(v ** 2) ** 0.5 + eps)
@@ -24,17 +54,24 @@ def spectral_normed_weight(W, u=None, num_iters=1, update_collection=None, with_
         v_ip1 = _l2normalize(tf.matmul(u_i, tf.transpose(W_reshaped)))
         u_ip1 = _l2normalize(tf.matmul(v_ip1, W_reshaped))
         return i + 1, u_ip1, v_ip1
-    _, u_final, v_final = tf.while_loop(
-        cond=lambda i, _1, _2: i < num_iters,
-        body=power_iteration,
-        loop_vars=(
-            tf.constant(0, dtype=tf.int32),
-            u,
-            tf.zeros(dtype=tf.float32, shape=[1, W_reshaped.shape.as_list()[0]]))
-    )
+    reused = _reused.get(tf.get_default_graph())
+    if reused and W.name in reused[-1]:
+        u_final, v_final = reused[-1][W.name]
+    else:
+        _, u_final, v_final = tf.while_loop(
+            cond=lambda i, _1, _2: i < num_iters,
+            body=power_iteration,
+            loop_vars=(
+                tf.constant(0, dtype=tf.int32),
+                u,
+                tf.zeros(dtype=tf.float32, shape=[1, W_reshaped.shape.as_list()[0]]))
+        )
     if stop_grad:
         u_final = tf.stop_gradient(u_final)
         v_final = tf.stop_gradient(v_final)
+    recorded = _recorded.get(tf.get_default_graph())
+    if recorded:
+        recorded[-1][W.name] = (u_final, v_final)
 
     if update_collection is None:
         warnings.warn('Setting update_collection to None will make u being updated every W execution. This maybe undesirable'
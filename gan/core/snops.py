@@ -1,6 +1,7 @@
 from tensorflow.python.framework import ops
 from utils.misc import variable_summaries
 from .mmd import tf
+from .precision import cast_like
 try:
     from .sn import spectral_normed_weight
 except:
@@ -82,12 +83,12 @@ def conv2d(input_, output_dim,
             s = tf.get_variable('s', shape=[1], initializer=tf.constant_initializer(scale), trainable=with_learnable_sn_scale, dtype=tf.float32)
             w_bar, sigma = spectral_normed_weight(w, update_collection=update_collection, with_sigma=True)
             w_bar = s*w_bar
-            conv = tf.nn.conv2d(input_, w_bar, strides=strides, padding='SAME', data_format=data_format)
+            conv = tf.nn.conv2d(input_, cast_like(w_bar, input_), strides=strides, padding='SAME', data_format=data_format)
         else:
-            conv = tf.nn.conv2d(input_, w, strides=strides, padding='SAME', data_format=data_format)
+            conv = tf.nn.conv2d(input_, cast_like(w, input_), strides=strides, padding='SAME', data_format=data_format)
 
         biases = tf.get_variable('biases', [output_dim], initializer=tf.constant_initializer(0.0))
-        conv = tf.reshape(tf.nn.bias_add(conv, biases, data_format=data_format), conv.get_shape())
+        conv = tf.reshape(tf.nn.bias_add(conv, cast_like(biases, conv), data_format=data_format), conv.get_shape())
 
         if not has_summary:
             if with_sn:
@@ -118,12 +119,12 @@ def deconv2d(input_, output_shape,
             s = tf.get_variable('s', shape=[1], initializer=tf.constant_initializer(scale), trainable=with_learnable_sn_scale, dtype=tf.float32)
             w_bar, sigma = spectral_normed_weight(w, update_collection=update_collection, with_sigma=True)
             w_bar = s*w_bar
-            deconv = tf.nn.conv2d_transpose(input_, w_bar, output_shape=output_shape, strides=strides, data_format=data_format)
+            deconv = tf.nn.conv2d_transpose(input_, cast_like(w_bar, input_), output_shape=output_shape, strides=strides, data_format=data_format)
         else:
-            deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape, strides=strides, data_format=data_format)
+            deconv = tf.nn.conv2d_transpose(input_, cast_like(w, input_), output_shape=output_shape, strides=strides, data_format=data_format)
 
         biases = tf.get_variable('biases', [out_channel], initializer=tf.constant_initializer(0.0))
-        deconv = tf.reshape(tf.nn.bias_add(deconv, biases, data_format=data_format), deconv.get_shape())
+        deconv = tf.reshape(tf.nn.bias_add(deconv, cast_like(biases, deconv), data_format=data_format), deconv.get_shape())
 
         if not has_summary:
             if with_sn:
@@ -181,10 +182,10 @@ def linear(input_, output_size, name="Linear", stddev=0.01, scale=1.0, with_lear
 
             matrix_bar, sigma = spectral_normed_weight(matrix, update_collection=update_collection, with_sigma=True)
             matrix_bar = s*matrix_bar
-            mul = tf.matmul(input_, matrix_bar)
+            mul = tf.matmul(input_, cast_like(matrix_bar, input_))
 
         else:
-            mul = tf.matmul(input_, matrix)
+            mul = tf.matmul(input_, cast_like(matrix, input_))
 
         bias = tf.get_variable(
             "bias",
@@ -200,9 +201,9 @@ def linear(input_, output_size, name="Linear", stddev=0.01, scale=1.0, with_lear
                 variable_summaries({'W': matrix}, with_singular_values=with_singular_values) 
 
         if with_w:
-            return mul + bias, matrix, bias
+            return mul + cast_like(bias, mul), matrix, bias
         else:
-            return mul + bias
+            return mul + cast_like(bias, mul)
 
 
 def linear_one_hot(input_, output_size, num_classes, name="Linear_one_hot", stddev=0.01, scale=1.0, with_learnable_sn_scale=False, with_sn=False, bias_start=0.0, with_w=False, update_collection=None,with_singular_values=False):
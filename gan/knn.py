@@ -0,0 +1,185 @@
+"""
+k-NN precision and recall (Kynkaanniemi et al., 2019) of generated codes
+against the training codes.
+
+The training codes are indexed once: optionally projected by PCA and
+product-quantized, with the distance of each point to its k-th nearest
+neighbour, which defines the radius of its ball in the estimated manifold.
+The index is cached on disk next to the codes file, so that a scoring round
+only searches the generated codes.
+"""
+from __future__ import division, print_function
+import os
+import sys
+
+import numpy as np
+from scipy.cluster.vq import kmeans2
+from tqdm import tqdm
+
+import compute_scores as cs
+
+
+class NNIndex(object):
+    '''
+    Exact k-NN search over (PCA-projected) points, by blocks of queries
+    against all points with BLAS matmuls. With product quantization the
+    points are stored as one byte per subspace and the distances of the
+    queries are approximated from per-block lookup tables; the radii are
+    computed exactly before quantization. The approximate distances bias
+    the ball tests upward, so `within` re-ranks its best candidates exactly
+    when given the indexed codes.
+    '''
+    def __init__(self, mean, components=None, points=None, pq_codebooks=None,
+                 pq_codes=None, radii=None, k=3, block_size=1024):
+        self.mean = mean
+        self.components = components
+        self.points = points
+        self.pq_codebooks = pq_codebooks
+        self.pq_codes = pq_codes
+        self.radii = radii
+        self.k = k
+        self.block_size = block_size
+        if points is not None:
+            self.sq_norms = np.einsum('ij,ij->i', points, points)
+
+    @classmethod
+    def build(cls, codes, k=3, pca_dim=None, pq_subspaces=None, block_size=1024,
+              output=sys.stdout):
+        mean, cov = next(cs.weighted_mean_cov(codes, np.ones((1, len(codes)))))
+        components = None
+        if pca_dim:
+            w, V = np.linalg.eigh(cov)
+            components = V[:, ::-1][:, :pca_dim].astype(np.float32)
+        index = cls(mean.astype(np.float32), components, k=k, block_size=block_size)
+        points = index.transform(codes)
+        index.points = points
+        index.sq_norms = np.einsum('ij,ij->i', points, points)  # set by __init__ otherwise
+        index.radii = index.kth_distances(points, exclude_self=True, output=output)  # exact
+        if pq_subspaces:
+            index.pq_codebooks, index.pq_codes = train_pq(points, pq_subspaces)
+            index.points = index.sq_norms = None
+        return index
+
+    def transform(self, codes):
+        x = np.asarray(codes, dtype=np.float32) - self.mean
+        return x if self.components is None else x.dot(self.components)
+
+    def __len__(self):
+        return len(self.points) if self.pq_codes is None else len(self.pq_codes)
+
+    def distance_blocks(self, queries, output=sys.stdout, desc='k-NN'):
+        "Yields the slices of `queries` (transformed) and their squared distances to all points."
+        for start in tqdm(range(0, len(queries), self.block_size), desc=desc, file=output):
+            Q = queries[start:start + self.block_size]
+            if self.pq_codes is None:
+                D = Q.dot(self.points.T)
+                D *= -2
+                D += np.einsum('ij,ij->i', Q, Q)[:, None]
+                D += self.sq_norms[None, :]
+            else:
+                D = np.zeros((len(Q), len(self)), dtype=np.float32)
+                for m, (sub, codebook) in enumerate(zip(_pq_slices(Q.shape[1], len(self.pq_codebooks)),
+                                                        self.pq_codebooks)):
+                    table = ((Q[:, None, sub] - codebook[None]) ** 2).sum(axis=-1)
+                    D += table[:, self.pq_codes[:, m]]
+            np.maximum(D, 0, out=D)
+            yield slice(start, start + len(Q)), D
+
+    def kth_distances(self, queries, exclude_self=False, output=sys.stdout):
+        "Distances to the k-th neighbour; with exclude_self, `queries` are the indexed points and not their own neighbours."
+        out = np.empty(len(queries), dtype=np.float32)
+        for rows, D in self.distance_blocks(queries, output=output, desc='k-NN radii'):
+            if exclude_self:
+                D[np.arange(D.shape[0]), np.arange(rows.start, rows.start + D.shape[0])] = np.inf
+            out[rows] = np.partition(D, self.k - 1, axis=1)[:, self.k - 1]
+        return np.sqrt(out)
+
+    def within(self, queries, codes=None, n_candidates=64, output=sys.stdout):
+        '''
+        Whether each of `queries` (transformed) is in the ball of some point.
+        With product quantization and the indexed `codes`, the n_candidates
+        balls each query is deepest in by the approximate distances are
+        tested with the exact ones.
+        '''
+        out = np.empty(len(queries), dtype=bool)
+        sq_radii = self.radii ** 2
+        for rows, D in self.distance_blocks(queries, output=output):
+            if self.pq_codes is None or codes is None:
+                out[rows] = (D <= sq_radii[None, :]).any(axis=1)
+                continue
+            D -= sq_radii[None, :]
+            c = min(n_candidates, D.shape[1])
+            candidates = np.argpartition(D, c - 1, axis=1)[:, :c]
+            Q = queries[rows]
+            flat = candidates.ravel()
+            order = np.argsort(flat)  # sorted reads of memory-mapped codes
+            points = np.empty((len(flat), Q.shape[1]), dtype=np.float32)
+            points[order] = self.transform(codes[flat[order]])
+            exact = ((points.reshape(len(Q), c, -1) - Q[:, None, :]) ** 2).sum(axis=-1)
+            out[rows] = (exact <= sq_radii[candidates]).any(axis=1)
+        return out
+
+    def save(self, path, **meta):
+        arrays = dict((name, getattr(self, name)) for name in
+                      ['mean', 'components', 'points', 'pq_codebooks', 'pq_codes', 'radii']
+                      if getattr(self, name) is not None)
+        np.savez(path, k=self.k, block_size=self.block_size, **dict(arrays, **meta))
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        get = lambda name: f[name] if name in f.files else None
+        return cls(f['mean'], get('components'), get('points'), get('pq_codebooks'),
+                   get('pq_codes'), f['radii'], int(f['k']), int(f['block_size']))
+
+
+def _pq_slices(dim, n_subspaces):
+    bounds = np.linspace(0, dim, n_subspaces + 1).astype(int)
+    return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def train_pq(points, n_subspaces, n_centroids=256, n_train=20000):
+    "k-means codebooks of each subspace, trained on a subsample, and the uint8 codes of the points."
+    train = points[np.random.choice(len(points), min(n_train, len(points)), replace=False)]
+    codebooks, codes = [], np.empty((len(points), n_subspaces), dtype=np.uint8)
+    for m, sub in enumerate(_pq_slices(points.shape[1], n_subspaces)):
+        codebook, _ = kmeans2(train[:, sub], n_centroids, iter=20, minit='points')
+        codebooks.append(codebook.astype(np.float32))
+        D = -2 * points[:, sub].dot(codebook.T) + (codebook ** 2).sum(axis=1)[None, :]
+        codes[:, m] = D.argmin(axis=1)
+    return np.stack(codebooks), codes
+
+
+def precision_recall(index, codes_g, codes_r, output=sys.stdout):
+    '''
+    Precision: fraction of the generated codes within the manifold of the
+    training codes `codes_r`, which the index was built from. Recall:
+    fraction of the training codes within the manifold of the generated
+    codes, searched exactly.
+    '''
+    g = index.transform(codes_g)
+    precision = index.within(g, codes=codes_r, output=output).mean()
+    fake = NNIndex(index.mean, index.components, g, k=index.k, block_size=index.block_size)
+    fake.radii = fake.kth_distances(g, exclude_self=True, output=output)
+    recall = fake.within(index.transform(codes_r), output=output).mean()
+    return precision, recall
+
+
+def load_or_build(path, codes, version, k=3, pca_dim=None, pq_subspaces=None,
+                  output=sys.stdout):
+    '''
+    Loads the index of `codes` from `path` if it was built from the same
+    codes (`version`) with the same parameters, otherwise builds and saves it.
+    '''
+    params = {'version': version, 'k': k, 'pca_dim': pca_dim or 0,
+              'pq_subspaces': pq_subspaces or 0}
+    if os.path.exists(path):
+        f = np.load(path)
+        if all((name in f.files) and (f[name] == value) for name, value in params.items()):
+            print('[*] k-NN index loaded from <%s>' % path)
+            return NNIndex.load(path)
+        print('[!] k-NN index in <%s> is stale, rebuilding...' % path)
+    index = NNIndex.build(codes, k=k, pca_dim=pca_dim, pq_subspaces=pq_subspaces, output=output)
+    index.save(path, **dict((name, value) for name, value in params.items() if name != 'k'))
+    print('[*] k-NN index saved in <%s>' % path)
+    return index
@@ -90,8 +90,15 @@ add_arg('-print_pca',                   default=False,          type=str2bool,
 add_arg('-suffix',                      default="",             type=str,       help="For additional settings ['', '_tf_records']")
 add_arg('-gpu_mem',                     default=.9,             type=float,     help="GPU memory fraction limit [%(default)s]")
 add_arg('-no_of_samples',               default=100000,         type=int,       help="number of samples to produce [%(default)s]")
+add_arg('-bulk_sample_dir',             default="",             type=str,       help="Sample -no_of_samples images to uint8 shards of this directory, resuming from the shards already there [none]")
+add_arg('-sample_batch_size',           default=0,              type=int,       help="Batch size of bulk sampling, 0 for -batch_size [%(default)s]")
+add_arg('-sample_shard_size',           default=10000,          type=int,       help="Number of samples per shard [%(default)s]")
+add_arg('-sample_seed',                 default=0,              type=int,       help="Seed of the samples; shard i is drawn with the seed (sample_seed, i) [%(default)s]")
+add_arg('-sample_format',               default='npy',          type=str,       help="Format of the shards [*npy*, png]")
 add_arg('-save_layer_outputs',          default=0,              type=int,       help="Whether to save_layer_outputs. If == 2, saves outputs at exponential steps: 1, 2, 4, ..., 512 and every 1000. [*0*, 1, 2]")
 add_arg('-ckpt_name',                   default="",             type=str,       help="Name of the checkpoint to load [none]")
+add_arg('-export_generator',            default="",             type=str,       help="Export the generator of the checkpoint as a frozen graph to <path>.pb and <path>.json, then exit [none]")
+add_arg('-export_fold',                 default=True,           type=str2bool,  help="Fold the batch norms of DCGAN and SNGAN generators into their weights on export [%(default)s]")
 
 # Decay rates
 add_arg('-decay_rate',                  default=.8,             type=float,     help='Decay rate [%(default)s]')
@@ -103,6 +110,22 @@ add_arg('-MMD_lr_scheduler',            default=True,           type=str2bool,
 add_arg('-MMD_sdlr_past_sample',        default=10,             type=int,       help='lr scheduler: number of past iterations to keep [%(default)s]')
 add_arg('-MMD_sdlr_num_test',           default=3,              type=int,       help='lr scheduler: number of failures to decrease KID score [%(default)s]')
 add_arg('-MMD_sdlr_freq',               default=2000,           type=int,       help='lr scheduler: frequency of scoring the model [%(default)s]')
+add_arg('-async_scoring',               default=False,          type=str2bool,  help='Score a snapshot of the generator in the background while training goes on [%(default)s]')
+add_arg('-max_staleness',               default=1000,           type=int,       help='Maximum number of steps between a scoring snapshot and applying its results [%(default)s]')
+add_arg('-kid_max_subsets',             default=10,             type=int,       help='Number of (maximum number with -kid_target_se or -kid_time_budget) KID subsets [%(default)s]')
+add_arg('-kid_target_se',               default=0.,             type=float,     help='Stop drawing KID subsets once the standard error of the mean is below this, 0 for all subsets [%(default)s]')
+add_arg('-kid_time_budget',             default=0.,             type=float,     help='Stop drawing KID subsets after this many seconds, 0 for no limit [%(default)s]')
+add_arg('-score_dtype',                 default='float32',      type=str,       help='dtype of the KID kernel matrices, float32 or float64; sums are accumulated in float64 [%(default)s]')
+add_arg('-score_blas_threads',          default=0,              type=int,       help='BLAS threads of the scoring code, 0 for no limit [%(default)s]')
+add_arg('-score_openmp_threads',        default=0,              type=int,       help='OpenMP threads of the scoring code, 0 for no limit [%(default)s]')
+add_arg('-score_isolated',              default=False,          type=str2bool,  help='Run the feature extractor in its own graph and session, fed from the host [%(default)s]')
+add_arg('-score_process',               default=False,          type=str2bool,  help='Run the feature extractor in a worker process of its own, fed from the host [%(default)s]')
+add_arg('-score_knn',                   default=False,          type=str2bool,  help='Compute the k-NN precision and recall of the samples [%(default)s]')
+add_arg('-knn_k',                       default=3,              type=int,       help='Neighbour defining the k-NN manifold radii [%(default)s]')
+add_arg('-knn_pca_dim',                 default=64,             type=int,       help='PCA dimension of the codes in the k-NN index, 0 for none [%(default)s]')
+add_arg('-knn_pq_subspaces',            default=0,              type=int,       help='Product quantization subspaces of the k-NN index, 0 for exact points; the precision tests re-rank its candidates exactly [%(default)s]')
+add_arg('-score_db',                    default='',             type=str,       help='SQLite file of the scores, shared by the runs of an experiment; default scores.sqlite next to the sample directory [%(default)s]')
+add_arg('-keep_top_k',                  default=0,              type=int,       help='Keep (hard links to) the checkpoints of the k best scored steps [%(default)s]')
 
 # discriminator penalties
 add_arg('-gradient_penalty',            default=0.0,            type=float,     help='Use gradient penalty if > 0 [%(default)s]')
@@ -126,6 +149,17 @@ add_arg('-incho_max_steps',             default=1000,           type=int,
 # multi-gpu training
 add_arg('-multi_gpu',                   default=False,          type=str2bool,  help='Train accross multiple gpus in a multi-tower fashion [%(default)s]')
 add_arg('-num_gpus',                    default=None,           type=int,       help='Number of GPUs to use [len(CUDA_VISIBLE_DEVICES)]')
+add_arg('-global_mmd',                  default=False,          type=str2bool,  help='Gather the discriminator features of all towers and compute the loss once on the global batch [%(default)s]')
+add_arg('-grad_accum_steps',            default=1,              type=int,       help='Number of micro-batches the batches are forwarded and backpropagated in; the loss is still computed on the full batch [%(default)s]')
+add_arg('-checkpoint_blocks',           default=False,          type=str2bool,  help='Recompute the residual block activations of resnet discriminators in the backward pass to save memory [%(default)s]')
+# mixed precision
+add_arg('-precision',                   default='float32',      type=str,       help='Precision of the network activations; weights, kernels and spectral norms stay in float32 [*float32*, float16, bfloat16]')
+add_arg('-loss_scale',                  default=32768.,         type=float,     help='Initial dynamic loss scale, used with float16 [%(default)s]')
+# profiling
+add_arg('-profile',                     default=False,          type=str2bool,  help='Record per-phase step timings and write their percentiles to the summaries [%(default)s]')
+add_arg('-profile_window',              default=1000,           type=int,       help='Number of recent timings per phase the percentiles are computed on [%(default)s]')
+add_arg('-trace_start',                 default=100,            type=int,       help='First step to trace [%(default)s]')
+add_arg('-trace_steps',                 default=0,              type=int,       help='Number of steps traced and exported as Chrome trace JSON to the log dir [%(default)s]')
 # conditional gan, only for imagenet
 add_arg('-with_labels',                 default=False,          type=str2bool,  help='Conditional GAN [%(default)s]')
 
@@ -150,6 +184,11 @@ def main(_):
     elif FLAGS.dataset in ['celebA', 'lsun', 'imagenet']:
         FLAGS.c_dim = 3
 
+    if FLAGS.export_generator:
+        from core.export import export_generator
+        export_generator(FLAGS, FLAGS.export_generator, fold=FLAGS.export_fold)
+        return
+
     from core import model_class
     Model = model_class(FLAGS.model)
 
@@ -165,6 +204,8 @@ def main(_):
         elif FLAGS.visualize:
             gan.load_checkpoint()
             visualize(sess, gan, FLAGS, 2)
+        elif FLAGS.bulk_sample_dir:
+            gan.bulk_sample(FLAGS.no_of_samples, FLAGS.bulk_sample_dir)
         else:
             gan.get_samples(FLAGS.no_of_samples, layers=[-1])
 
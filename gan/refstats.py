@@ -0,0 +1,192 @@
+"""
+Cached statistics of the reference (training) codes used by FID and KID.
+
+The store is keyed by dataset, resolution, feature extractor and number of
+codes, and records a fingerprint of the dataset files so that stale
+statistics are recomputed. It holds the mean and covariance of the codes,
+the symmetric square root of the covariance and the within-sample
+polynomial kernel sums of fixed reference subsets, so that a scoring round
+only processes the generated codes.
+"""
+from __future__ import division, print_function
+import os
+import sys
+import hashlib
+
+import numpy as np
+from tqdm import tqdm
+
+import compute_scores as cs
+
+
+def stats_key(dataset, resolution, extractor, n):
+    return '%s_%d_%s_%d' % (dataset, resolution, extractor, n)
+
+
+# files holding the dataset itself (records, archives, lmdb, arrays, the
+# cifar10 and mnist batches) or listing it; loose images are not stat'ed
+DATASET_FILES = ('.tfrecord', '.tfrecords', '.zip', '.tar', '.tgz', '.gz', '.mdb',
+                 '.npy', '.npz', '.txt', '.csv', '.json', '-ubyte', 'data_batch_1',
+                 'data_batch_2', 'data_batch_3', 'data_batch_4', 'data_batch_5', 'test_batch')
+
+
+def dataset_version(path, max_depth=2):
+    '''
+    Fingerprint of the dataset at `path`: the names, sizes and modification
+    times of its record, archive and manifest files, and of its directories
+    down to `max_depth`. Directories of loose images are not walked, adding
+    or removing an image changes the modification time of its directory.
+    '''
+    entries = []
+
+    def stat(full, name):
+        st = os.stat(full)
+        entries.append('%s:%d:%d' % (name, st.st_size, int(st.st_mtime)))
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            rel = os.path.relpath(root, path)
+            depth = 0 if rel == '.' else rel.count(os.sep) + 1
+            dirs.sort()
+            for name in dirs:
+                stat(os.path.join(root, name), os.path.join(rel, name) + '/')
+            if depth >= max_depth:
+                dirs[:] = []
+            for name in sorted(files):
+                if name.endswith(DATASET_FILES) or '.tfrecord' in name:
+                    stat(os.path.join(root, name), os.path.join(rel, name))
+    elif os.path.exists(path):
+        stat(path, os.path.basename(path))
+    return hashlib.md5('\n'.join(entries).encode('utf-8')).hexdigest()
+
+
+class ReferenceStats(object):
+    def __init__(self, key, version, mean, cov, sqrt_cov, kid_indices, kid_sums, kernel_args):
+        self.key = key
+        self.version = version
+        self.mean = mean
+        self.cov = cov
+        self.sqrt_cov = sqrt_cov
+        self.kid_indices = kid_indices
+        self.kid_sums = kid_sums
+        self.kernel_args = kernel_args
+        self.codes = None
+        self._fid_engine = None
+
+    @classmethod
+    def from_codes(cls, codes, key, version, n_subsets=10, subset_size=1000,
+                   degree=3, gamma=None, coef0=1, output=sys.stdout):
+        mean = codes.mean(axis=0, dtype=np.float64)
+        cov = np.cov(codes, rowvar=False)
+        kernel_args = {'degree': degree, 'gamma': gamma, 'coef0': coef0}
+        kid_indices = np.stack([np.random.choice(len(codes), subset_size, replace=False)
+                                for _ in range(n_subsets)])
+        kid_sums = []
+        for inds in tqdm(kid_indices, desc='Reference KID sums', file=output):
+            K_YY = cs.polynomial_kernel_batch(codes[inds], **kernel_args)
+            kid_sums.append(cs._kernel_sums(K_YY))
+        engine = cs.FIDEngine(mean, cov)
+        stats = cls(key, version, mean, cov, engine.sqrt_cov_r, kid_indices, kid_sums, kernel_args)
+        stats.codes = codes
+        stats._fid_engine = engine
+        return stats
+
+    def matches(self, key, version):
+        return (self.key == key) and (self.version == version)
+
+    def compatible(self, n_subsets=10, subset_size=1000, degree=3, gamma=None, coef0=1):
+        "Whether the cached KID subsets and kernel are the requested ones."
+        return (self.kid_indices.shape == (n_subsets, subset_size)) and \
+            (self.kernel_args == {'degree': degree, 'gamma': gamma, 'coef0': coef0})
+
+    def save(self, path):
+        sums = dict([('kid_' + k, np.array([s[k] for s in self.kid_sums])) for k in self.kid_sums[0]])
+        np.savez(path, key=self.key, version=self.version, mean=self.mean, cov=self.cov,
+                 sqrt_cov=self.sqrt_cov, kid_indices=self.kid_indices,
+                 kernel_degree=self.kernel_args['degree'],
+                 kernel_gamma=np.nan if self.kernel_args['gamma'] is None else self.kernel_args['gamma'],
+                 kernel_coef0=self.kernel_args['coef0'], **sums)
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        sum_keys = [k[len('kid_'):] for k in f.files if k.startswith('kid_') and k != 'kid_indices']
+        kid_sums = [dict([(k, f['kid_' + k][i]) for k in sum_keys]) for i in range(len(f['kid_indices']))]
+        gamma = float(f['kernel_gamma'])
+        kernel_args = {'degree': int(f['kernel_degree']), 'gamma': None if np.isnan(gamma) else gamma,
+                       'coef0': float(f['kernel_coef0'])}
+        return cls(str(f['key']), str(f['version']), f['mean'], f['cov'], f['sqrt_cov'],
+                   f['kid_indices'], kid_sums, kernel_args)
+
+    def fid_engine(self, **kwargs):
+        if self._fid_engine is None:
+            self._fid_engine = cs.FIDEngine(self.mean, self.cov, self.sqrt_cov, **kwargs)
+        return self._fid_engine
+
+    def fid(self, codes_g, output=sys.stdout, **split_args):
+        "FID of resamples of the generated codes against the full reference set."
+        assert self.mean.shape[0] == codes_g.shape[1]
+        return self.fid_engine().score(codes_g, output=output, **split_args)
+
+    def kid(self, codes_g, ret_var=True, output=sys.stdout, batch_size=10, stopping=None):
+        """
+        Polynomial MMD estimates of the generated codes against the cached
+        reference subsets; with a cs.KIDStopping rule, only as many subsets
+        as needed are used.
+        """
+        assert self.codes is not None, 'Reference codes are needed for the cross-kernel terms'
+        n_subsets, subset_size = self.kid_indices.shape
+        m = min(codes_g.shape[0], self.codes.shape[0])
+        mmds = np.zeros(n_subsets)
+        need_var = ret_var or (stopping is not None)
+        if need_var:
+            vars = np.zeros(n_subsets)
+            stop_vars = np.zeros(n_subsets)
+        inds = np.stack([np.random.choice(len(codes_g), subset_size, replace=False)
+                         for _ in range(n_subsets)])
+        if stopping is not None:
+            stopping.reset()
+
+        used = n_subsets
+        with tqdm(total=n_subsets, desc='MMD', file=output) as bar:
+            for start in range(0, n_subsets, batch_size):
+                g = np.take(codes_g, inds[start:start + batch_size], axis=0)
+                r = np.take(self.codes, self.kid_indices[start:start + batch_size], axis=0)
+                K_XX = cs.polynomial_kernel_batch(g, **self.kernel_args)
+                K_XY = cs.polynomial_kernel_batch(g, r, **self.kernel_args)
+                for k in range(len(g)):
+                    o = cs._mmd2_and_variance_from_sums(
+                        cs._kernel_sums(K_XX[k], ret_var=need_var), K_XY[k],
+                        self.kid_sums[start + k], var_at_m=(m, subset_size), ret_var=need_var)
+                    if need_var:
+                        mmds[start + k], (vars[start + k], stop_vars[start + k]) = o
+                    else:
+                        mmds[start + k] = o
+                bar.update(len(g))
+                bar.set_postfix({'mean': mmds[:start + len(g)].mean()})
+                if (stopping is not None) and stopping(stop_vars[:start + len(g)]):
+                    used = start + len(g)
+                    break
+        if stopping is not None:
+            stopping.report(used, n_subsets, output=output)
+        return (mmds[:used], vars[:used]) if ret_var else mmds[:used]
+
+
+def load_or_compute(path, codes, key, version, output=sys.stdout, **kwargs):
+    """
+    Loads the statistics from `path` if they match `key` and `version`,
+    otherwise computes them from `codes` (an array, or a callable returning one)
+    and saves them.
+    """
+    if os.path.exists(path):
+        stats = ReferenceStats.load(path)
+        if stats.matches(key, version) and stats.compatible(**kwargs):
+            stats.codes = codes() if callable(codes) else codes
+            print('[*] Reference statistics loaded from <%s>' % path)
+            return stats
+        print('[!] Reference statistics in <%s> are stale, recomputing...' % path)
+    stats = ReferenceStats.from_codes(codes() if callable(codes) else codes, key, version,
+                                      output=output, **kwargs)
+    stats.save(path)
+    print('[*] Reference statistics saved in <%s>' % path)
+    return stats
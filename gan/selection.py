@@ -0,0 +1,130 @@
+"""
+Checkpoint selection from the score store (see utils/scoredb.py), without
+rescoring. Run from the gan directory:
+
+    python selection.py $OUTDIR/sample/scores.sqlite --metric mmd2 --top 10
+    python selection.py $OUTDIR/sample/scores.sqlite --metric mmd2 --export gen/best
+
+Checkpoints of the best scored steps of a run are kept as hard links in its
+checkpoint directory (top/top.model-<step>), so that the Saver deleting old
+checkpoints does not lose them; see Scorer.update and -keep_top_k.
+"""
+from __future__ import division, print_function
+import os
+import json
+import shutil
+import argparse
+from glob import glob
+
+import numpy as np
+from scipy import stats
+
+from utils.scoredb import ScoreDB
+
+
+def rank(db, metric='mmd2', runs=None, lower=True, confidence=.95):
+    '''
+    Scored steps of the runs ordered by the mean of `metric`, as
+    (run, step, mean, ci_low, ci_high) with normal confidence intervals of
+    the mean over the n estimates of each round.
+    '''
+    z = stats.norm.ppf(.5 + confidence / 2.)
+    ranked = []
+    for run, step, mean, std, n in db.summary(metric, runs):
+        half = z * std / np.sqrt(max(n, 1))
+        ranked.append((run, step, mean, mean - half, mean + half))
+    return sorted(ranked, key=lambda r: r[2], reverse=not lower)
+
+
+def link_checkpoint(src, dst):
+    "Hard-links the files of the checkpoint `src` as `dst`; copies them across file systems."
+    for f in glob(src + '.*'):
+        target = dst + f[len(src):]
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(f, target)
+        except OSError:
+            shutil.copyfile(f, target)
+
+
+def keep_top(top_dir, steps):
+    "Removes the links of the top checkpoints whose step is not in `steps`."
+    for f in glob(os.path.join(top_dir, 'top.model-*')):
+        step = int(os.path.basename(f)[len('top.model-'):].split('.')[0])
+        if step not in steps:
+            os.remove(f)
+
+
+def checkpoint_dir(config, run):
+    return os.path.join(config['out_dir'], config['checkpoint_dir'], config['name'], run)
+
+
+def find_checkpoint(config, run, step):
+    "Path of a checkpoint of `step` of the run, if one was kept."
+    ckpt_dir = checkpoint_dir(config, run)
+    for name in ['top/top.model-%d', 'MMDGAN.model-%d', 'scoring.model-%d']:
+        path = os.path.join(ckpt_dir, name % step)
+        if os.path.exists(path + '.index'):
+            return path
+    return None
+
+
+def save_generator_checkpoint(checkpoint, path, config=None, scope='generator'):
+    '''
+    Writes a checkpoint holding only the generator variables of `checkpoint`
+    (no discriminator, no optimizer slots), with the run config as json.
+    '''
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    names = sorted(name for name in reader.get_variable_to_shape_map()
+                   if name.startswith(scope + '/') and not name.split('/')[-1].startswith('Adam'))
+    with tf.Graph().as_default():
+        values = [tf.placeholder(reader.get_variable_to_dtype_map()[name], name='value_%d' % i)
+                  for i, name in enumerate(names)]
+        variables = [tf.Variable(value, name=name, validate_shape=False)
+                     for value, name in zip(values, names)]
+        with tf.Session() as sess:
+            sess.run(tf.variables_initializer(variables),
+                     dict(zip(values, [reader.get_tensor(name) for name in names])))
+            tf.train.Saver(variables).save(sess, path, write_meta_graph=False)
+    with open(path + '.json', 'w') as f:
+        json.dump({'checkpoint': checkpoint, 'variables': names, 'config': config},
+                  f, indent=1, sort_keys=True)
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank scored checkpoints and export the best generator.')
+    parser.add_argument('db', type=str, help='scores SQLite file')
+    parser.add_argument('--metric', type=str, default='mmd2', help='[%(default)s]')
+    parser.add_argument('--runs', type=str, nargs='*', default=None, help='[all]')
+    parser.add_argument('--higher', action='store_true', help='higher is better, e.g. inception')
+    parser.add_argument('--confidence', type=float, default=.95, help='[%(default)s]')
+    parser.add_argument('--top', type=int, default=10, help='[%(default)s]')
+    parser.add_argument('--export', type=str, default=None,
+                        help='export the generator of the best kept checkpoint to this path')
+    args = parser.parse_args()
+
+    db = ScoreDB(args.db)
+    ranked = rank(db, args.metric, args.runs, lower=not args.higher, confidence=args.confidence)
+    configs = dict((run, db.config(run)) for run in set(r[0] for r in ranked))
+    print('%-60s  %8s  %12s  %27s  %s' % ('run', 'step', args.metric, 'CI', 'checkpoint'))
+    for run, step, mean, low, high in ranked[:args.top]:
+        ckpt = find_checkpoint(configs[run], run, step) if configs[run] else None
+        print('%-60s  %8d  %12.6f  [%12.6f, %12.6f]  %s' % (run, step, mean, low, high, ckpt or '-'))
+
+    if args.export:
+        for run, step, _, _, _ in ranked:
+            ckpt = find_checkpoint(configs[run], run, step) if configs[run] else None
+            if ckpt is not None:
+                names = save_generator_checkpoint(ckpt, args.export, configs[run])
+                print('Generator of %s at step %d (%d variables) exported to %s'
+                      % (run, step, len(names), args.export))
+                break
+        else:
+            print('No checkpoint kept for the ranked steps.')
+
+
+if __name__ == '__main__':
+    main()
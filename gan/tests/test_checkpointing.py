@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('needs TensorFlow 1', allow_module_level=True)
+from core.architecture import SNResNetDiscriminator
+
+
+def discriminator_gradients(checkpoint, images, values=None):
+    "Gradients of a loss with a gradient penalty term, and the variable values, of a small SN ResNet discriminator."
+    with tf.Graph().as_default():
+        x = tf.constant(images)
+        discriminator = SNResNetDiscriminator(dim=2, o_dim=3, use_batch_norm=False, with_sn=True,
+                                              checkpoint_blocks=checkpoint)
+        # update_collection=None: the forward pass updates the power iteration u
+        hF = discriminator(x, len(images), update_collection=None)
+        penalty = tf.reduce_sum(tf.gradients(tf.reduce_sum(hF), x)[0] ** 2)
+        loss = tf.reduce_sum(hF ** 2) + penalty
+        variables = tf.global_variables()
+        grads = tf.gradients(loss, [x] + tf.trainable_variables())
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if values is not None:
+                for var in variables:
+                    var.load(values[var.op.name], sess)
+            values = dict(zip([v.op.name for v in variables], sess.run(variables)))
+            return sess.run([hF] + grads), values
+
+
+def test_checkpointed_blocks_give_the_same_gradients():
+    images = np.random.RandomState(0).randn(2, 3, 32, 32).astype(np.float32)
+    expected, values = discriminator_gradients(False, images)
+    outputs, _ = discriminator_gradients(True, images, values)
+    assert len(outputs) == len(expected)
+    for out, e in zip(outputs, expected):
+        np.testing.assert_allclose(out, e, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,252 @@
+from __future__ import division
+import io
+import os
+
+import numpy as np
+import pytest
+
+cs = pytest.importorskip('compute_scores')
+
+
+def codes(n, d, seed, shift=0.):
+    rng = np.random.RandomState(seed)
+    return (rng.randn(n, d).dot(rng.randn(d, d)) / np.sqrt(d) + shift).astype(np.float32)
+
+
+def test_fid_eigh_matches_sqrtm():
+    g, r = codes(500, 16, 0, shift=.3), codes(600, 16, 1)
+    eigh = cs.fid_score(g, r, method='eigh', splits=3, output=io.StringIO())
+    sqrtm = cs.fid_score(g, r, method='sqrtm', splits=3, output=io.StringIO())
+    np.testing.assert_allclose(eigh, sqrtm, rtol=1e-6, atol=1e-8)
+
+
+def test_fid_engine_matches_fid_score():
+    g, r = codes(400, 8, 2, shift=.5), codes(400, 8, 3)
+    engine = cs.FIDEngine.from_codes(r)
+    expected = cs.fid_score(g, r, method='sqrtm', splits=1, output=io.StringIO())
+    np.testing.assert_allclose(engine.score(g, splits=1, output=io.StringIO()), expected,
+                               rtol=1e-6)
+
+
+def test_bootstrap_weights_match_splits():
+    np.random.seed(0)
+    splits = cs.get_splits(50, splits=4, split_method='bootstrap')
+    np.random.seed(0)
+    weights = cs.get_split_weights(50, splits=4, split_method='bootstrap')
+    for s, w in zip(splits, weights):
+        np.testing.assert_array_equal(w, np.bincount(s, minlength=50))
+
+
+def test_weighted_mean_cov_matches_resampled_codes():
+    x = codes(200, 6, 4)
+    np.random.seed(1)
+    splits = cs.get_splits(len(x), splits=3, split_method='bootstrap')
+    np.random.seed(1)
+    weights = cs.get_split_weights(len(x), splits=3, split_method='bootstrap')
+    for s, (mean, cov) in zip(splits, cs.weighted_mean_cov(x, weights)):
+        resampled = x[s].astype(np.float64)
+        np.testing.assert_allclose(mean, resampled.mean(axis=0), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(cov, np.cov(resampled, rowvar=False), rtol=1e-10, atol=1e-12)
+
+
+def test_weighted_inception_score_matches_resampled_preds():
+    rng = np.random.RandomState(5)
+    preds = rng.dirichlet(np.ones(10), size=300)
+    np.random.seed(2)
+    splits = cs.get_splits(len(preds), splits=3, split_method='bootstrap')
+    np.random.seed(2)
+    scores = cs.inception_score(preds, splits=3, split_method='bootstrap')
+    for s, score in zip(splits, scores):
+        p = preds[s]
+        kl = np.sum(p * (np.log(p) - np.log(p.mean(axis=0))), axis=1)
+        np.testing.assert_allclose(score, np.exp(kl.mean()), rtol=1e-10)
+
+
+def subset_kids(g, r, n_subsets, subset_size):
+    "The per-subset KID estimates, drawn and computed one subset at a time."
+    m = min(len(g), len(r))
+    mmds, vars = [], []
+    for _ in range(n_subsets):
+        i = np.random.choice(len(g), subset_size, replace=False)
+        j = np.random.choice(len(r), subset_size, replace=False)
+        mmd2, var = cs.polynomial_mmd(g[i], r[j], var_at_m=(m, subset_size))
+        mmds.append(mmd2)
+        vars.append(var)
+    return np.array(mmds), np.array(vars)
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 10])
+def test_batched_kid_matches_subsets(batch_size):
+    g, r = codes(300, 8, 6, shift=.2), codes(250, 8, 7)
+    np.random.seed(3)
+    mmds, vars = cs.polynomial_mmd_averages(g, r, n_subsets=7, subset_size=50,
+                                            batch_size=batch_size, output=io.StringIO())
+    np.random.seed(3)
+    expected_mmds, expected_vars = subset_kids(g, r, 7, 50)
+    np.testing.assert_allclose(mmds, expected_mmds, rtol=1e-6)
+    np.testing.assert_allclose(vars, expected_vars[:, 0], rtol=1e-6)
+
+
+def test_numeric_policy(monkeypatch):
+    g, r = codes(300, 8, 6, shift=.2), codes(250, 8, 7)
+    monkeypatch.setattr(cs, 'policy', cs.policy)  # restored after the test
+    assert cs.set_policy().kernel_input(g) is g
+    assert cs.polynomial_kernel_batch(g[None]).dtype == np.float32
+    np.random.seed(3)
+    kid32 = cs.polynomial_mmd_averages(g, r, n_subsets=5, subset_size=50, ret_var=False,
+                                       output=io.StringIO())
+    policy = cs.set_policy(kernel_dtype='float64', blas_threads=0)
+    assert policy.blas_threads is None and cs.policy is policy
+    assert cs.polynomial_kernel_batch(g[None]).dtype == np.float64
+    np.random.seed(3)
+    with policy.limits():
+        kid64 = cs.polynomial_mmd_averages(g, r, n_subsets=5, subset_size=50, ret_var=False,
+                                           output=io.StringIO())
+    np.testing.assert_allclose(kid32, kid64, rtol=1e-4)
+
+
+def test_kid_stopping_uses_subset_variances():
+    g, r = codes(2000, 8, 8, shift=.1), codes(2000, 8, 9)
+    stopping = cs.KIDStopping()
+    np.random.seed(4)
+    mmds = cs.polynomial_mmd_averages(g, r, n_subsets=40, subset_size=100, ret_var=False,
+                                      stopping=stopping, output=io.StringIO())
+    np.random.seed(4)
+    _, vars = subset_kids(g, r, 40, 100)
+    subset_vars = vars[:, 1]
+    np.testing.assert_allclose(stopping.se, np.sqrt(subset_vars.mean() / 40), rtol=1e-6)
+    # the standard error of the mean of the subset estimates
+    empirical_se = mmds.std(ddof=1) / np.sqrt(len(mmds))
+    assert .5 < stopping.se / empirical_se < 2
+
+
+def test_kid_stopping_stops_at_target_se():
+    g, r = codes(2000, 8, 10), codes(2000, 8, 11)
+    np.random.seed(5)
+    _, vars = subset_kids(g, r, 40, 100)
+    k = 10
+    target_se = np.sqrt(vars[:k, 1].mean() / k) * 1.0001  # reached after about k subsets
+    stopping = cs.KIDStopping(target_se=target_se)
+    np.random.seed(5)
+    mmds = cs.polynomial_mmd_averages(g, r, n_subsets=40, subset_size=100, ret_var=False,
+                                      batch_size=1, stopping=stopping, output=io.StringIO())
+    assert len(mmds) < 40
+    assert stopping.se < target_se
+    assert all(np.sqrt(vars[:n, 1].mean() / n) >= target_se for n in range(2, len(mmds)))
+
+
+class FakeModel(object):
+    "Runs a fixed linear map of the images in place of a network, failing after `fail_after` runs."
+    softmax_dim, coder_dim = 3, 2
+
+    def __init__(self, fail_after=None):
+        self.sess, self.input, self.softmax, self.coder = self, 'input', 'softmax', 'coder'
+        self.fail_after, self.runs = fail_after, 0
+
+    def run(self, to_get, feed):
+        if self.runs == self.fail_after:
+            raise KeyboardInterrupt
+        self.runs += 1
+        flat = feed[self.input].reshape(len(feed[self.input]), -1)
+        return tuple(flat[:, :self.softmax_dim] if t == 'softmax' else flat[:, -self.coder_dim:]
+                     for t in to_get)
+
+
+def test_featurize_resumes_from_journal(tmpdir):
+    images = np.random.RandomState(0).uniform(0, 255, (95, 2, 2, 3)).astype(np.float32)
+    kwargs = {'batch_size': 10, 'get_codes': True, 'output': io.StringIO(), 'flush_every': 2}
+    expected = cs.featurize(images, FakeModel(), **kwargs)
+
+    journal = str(tmpdir.join('codes.journal'))
+    outs = {'out_preds': np.lib.format.open_memmap(str(tmpdir.join('preds.npy')), mode='w+',
+                                                   dtype=np.float32, shape=(95, 3)),
+            'out_codes': np.lib.format.open_memmap(str(tmpdir.join('codes.npy')), mode='w+',
+                                                   dtype=np.float32, shape=(95, 2))}
+    for out in outs.values():
+        out.fill(np.nan)
+    with pytest.raises(KeyboardInterrupt):
+        cs.featurize(images, FakeModel(fail_after=5), journal=journal, **dict(kwargs, **outs))
+    with open(journal) as f:
+        assert sorted(int(line) for line in f) == [0, 10, 20, 30, 40]
+
+    outs['out_codes'][15] = np.nan  # lost before the flush: batch 10 is featurized again
+    model = FakeModel()
+    preds, codes = cs.featurize(images, model, journal=journal, **dict(kwargs, **outs))
+    assert model.runs == 10 - 4
+    np.testing.assert_array_equal(preds, expected[0])
+    np.testing.assert_array_equal(codes, expected[1])
+
+
+def test_graph_def_cache_versioning(tmpdir, monkeypatch):
+    made = []
+
+    def make_graph_def():
+        made.append(cs.CACHE_VERSION)
+        with cs.tf.Graph().as_default() as graph:
+            cs.tf.constant(float(cs.CACHE_VERSION), name='version')
+        return graph.as_graph_def()
+
+    monkeypatch.setattr(cs, 'CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(cs, 'EXTRACTORS', {'fake': cs.ExtractorSpec(make_graph_def, None, 1, 1, 1, None)})
+    monkeypatch.setattr(cs, '_graph_defs', {})
+    version = cs.CACHE_VERSION
+    first = cs.cached_graph_def('fake')
+    assert cs.cached_graph_def('fake') is first  # parsed once per process
+    cs._graph_defs.clear()
+    assert cs.cached_graph_def('fake') == first  # read back from the disk cache
+    assert made == [version] and tmpdir.listdir() == [tmpdir.join('fake-v%d.pb' % version)]
+
+    # graphs cached by an older version are not used
+    monkeypatch.setattr(cs, 'CACHE_VERSION', version + 1)
+    cs._graph_defs.clear()
+    assert cs.cached_graph_def('fake') != first
+    assert made == [version, version + 1]
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['fake-v%d.pb' % v for v in made]
+
+
+class InlinePool(object):
+    "multiprocessing Pool running the jobs in the test process."
+    def __init__(self, n):
+        self.n = n
+
+    def map(self, f, jobs):
+        return [f(job) for job in jobs]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def test_score_files_parallel_keeps_order(tmpdir, monkeypatch):
+    import multiprocessing
+    from argparse import Namespace
+    monkeypatch.setattr(multiprocessing, 'get_context', lambda method: Namespace(Pool=InlinePool))
+    monkeypatch.setattr(cs, 'policy', cs.policy)
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '')
+    monkeypatch.setattr(cs, 'score_files', lambda paths, args: [
+        {'samples': path, 'gpu': os.environ['CUDA_VISIBLE_DEVICES']} for path in paths])
+    args = Namespace(workers=3, worker_gpus=['0', '1'], kernel_dtype='float32',
+                     blas_threads=None, openmp_threads=None)
+    paths = ['samples-%d.npy' % i for i in range(7)]
+    rows = cs.score_files_parallel(paths, args)
+    assert [row['samples'] for row in rows] == paths
+    assert [row['gpu'] for row in rows] == ['0', '1', '0'] * 2 + ['0']
+
+    rows = [dict(row, fid_mean=float(i)) for i, row in enumerate(rows[:2])]
+    cs.write_results(str(tmpdir.join('scores.csv')), rows)
+    assert tmpdir.join('scores.csv').read().splitlines() == [
+        'samples,gpu,fid_mean', 'samples-0.npy,0,0.0', 'samples-1.npy,1,1.0']
+
+
+def test_prefetched_raises_load_errors():
+    def load(path):
+        if path == 'bad':
+            raise IOError(path)
+        return path.upper()
+
+    it = cs.prefetched(['a', 'b', 'bad'], load=load)
+    assert [next(it), next(it)] == [('a', 'A'), ('b', 'B')]
+    with pytest.raises(IOError):
+        next(it)
@@ -0,0 +1,69 @@
+from __future__ import division
+
+import numpy as np
+import pytest
+
+export = pytest.importorskip('core.export')
+
+EPS = 1e-5
+
+
+def bn_values(name, channels, rng):
+    return {
+        'generator/%s/gamma' % name: rng.uniform(.5, 2., channels),
+        'generator/%s/beta' % name: rng.randn(channels),
+        'generator/%s/moving_mean' % name: rng.randn(channels),
+        'generator/%s/moving_variance' % name: rng.uniform(.1, 3., channels),
+    }
+
+
+def batch_norm(x, values, name):
+    "Inference batch norm of the NCHW x with the g_bn variables `name` of `values`."
+    get = lambda v: values['generator/%s/%s' % (name, v)][None, :, None, None]
+    return (x - get('moving_mean')) / np.sqrt(get('moving_variance') + EPS) * get('gamma') + get('beta')
+
+
+def test_fold_linear_and_deconv():
+    rng = np.random.RandomState(0)
+    n, z_dim, c0, s, c1 = 5, 6, 4, 3, 2
+    values = {
+        'generator/g_h0_lin/Matrix': rng.randn(z_dim, c0 * s * s),
+        'generator/g_h0_lin/bias': rng.randn(c0 * s * s),
+        # a 2x2 stride 2 deconvolution of a single pixel: [k_h, k_w, out, in]
+        'generator/g_h1/w': rng.randn(2, 2, c1, c0),
+        'generator/g_h1/biases': rng.randn(c1),
+        'generator/g_h1/Adam': np.zeros(1),  # optimizer slots are ignored
+    }
+    values.update(bn_values('g_bn0', c0, rng))
+    values.update(bn_values('g_bn1', c1, rng))
+    folded = export.fold_generator(values, epsilon=EPS)
+    assert sorted(folded) == ['generator/g_h0_lin/Matrix', 'generator/g_h0_lin/bias',
+                              'generator/g_h1/biases', 'generator/g_h1/w']
+
+    z = rng.randn(n, z_dim)
+    lin = lambda v: (z.dot(v['generator/g_h0_lin/Matrix'])
+                     + v['generator/g_h0_lin/bias']).reshape(n, c0, s, s)
+    np.testing.assert_allclose(lin(folded), batch_norm(lin(values), values, 'g_bn0'),
+                               rtol=1e-4, atol=1e-4)
+
+    x = rng.randn(n, c0)
+    deconv = lambda v: (np.einsum('pqoi,ni->nopq', v['generator/g_h1/w'], x)
+                        + v['generator/g_h1/biases'][None, :, None, None])
+    np.testing.assert_allclose(deconv(folded), batch_norm(deconv(values), values, 'g_bn1'),
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_fold_without_batch_norm_keeps_layer():
+    rng = np.random.RandomState(1)
+    values = {'generator/g_h4/w': rng.randn(3, 3, 2, 4), 'generator/g_h4/biases': rng.randn(2)}
+    folded = export.fold_generator(values)
+    for name, value in values.items():
+        np.testing.assert_allclose(folded[name], value, rtol=1e-6)
+
+
+def test_fold_refuses_spectral_norm():
+    rng = np.random.RandomState(2)
+    values = {'generator/g_h1/w': rng.randn(3, 3, 2, 4), 'generator/g_h1/biases': rng.randn(2),
+              'generator/g_h1/u': rng.randn(1, 2)}
+    with pytest.raises(ValueError):
+        export.fold_generator(values)
@@ -0,0 +1,68 @@
+from __future__ import division
+import io
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+knn = pytest.importorskip('knn')
+
+
+def gaussian_codes(n, d, seed, shift=0.):
+    return (np.random.RandomState(seed).randn(n, d) + shift).astype(np.float32)
+
+
+def exact_precision_recall(g, r, k):
+    "k-NN precision and recall of g against r from full distance matrices."
+    D_rr, D_gg, D_gr = cdist(r, r), cdist(g, g), cdist(g, r)
+    radii_r = np.sort(D_rr, axis=1)[:, k]  # column 0 is the point itself
+    radii_g = np.sort(D_gg, axis=1)[:, k]
+    precision = (D_gr <= radii_r[None, :]).any(axis=1).mean()
+    recall = (D_gr.T <= radii_g[None, :]).any(axis=1).mean()
+    return radii_r, precision, recall
+
+
+def test_exact_index_matches_cdist():
+    r, g = gaussian_codes(500, 8, 0), gaussian_codes(400, 8, 1, shift=.3)
+    index = knn.NNIndex.build(r, k=3, block_size=128, output=io.StringIO())
+    radii, precision, recall = exact_precision_recall(g, r, 3)
+    np.testing.assert_allclose(index.radii, radii, rtol=1e-4)
+    p, rc = knn.precision_recall(index, g, r, output=io.StringIO())
+    assert p == pytest.approx(precision, abs=1e-3)
+    assert rc == pytest.approx(recall, abs=1e-3)
+
+
+def test_pca_index_matches_cdist_of_projections():
+    r, g = gaussian_codes(500, 16, 2), gaussian_codes(400, 16, 3, shift=.2)
+    index = knn.NNIndex.build(r, k=3, pca_dim=6, output=io.StringIO())
+    radii, precision, _ = exact_precision_recall(index.transform(g), index.transform(r), 3)
+    np.testing.assert_allclose(index.radii, radii, rtol=1e-4)
+    assert knn.precision_recall(index, g, r, output=io.StringIO())[0] == \
+        pytest.approx(precision, abs=1e-3)
+
+
+def test_pq_index_keeps_exact_radii_and_precision():
+    r, g = gaussian_codes(2000, 64, 4), gaussian_codes(2000, 64, 5)
+    np.random.seed(0)
+    exact = knn.NNIndex.build(r, k=3, pca_dim=16, output=io.StringIO())
+    np.random.seed(0)
+    pq = knn.NNIndex.build(r, k=3, pca_dim=16, pq_subspaces=4, output=io.StringIO())
+    assert pq.points is None
+    np.testing.assert_allclose(pq.radii, exact.radii, rtol=1e-5)
+    p_exact, r_exact = knn.precision_recall(exact, g, r, output=io.StringIO())
+    p_pq, r_pq = knn.precision_recall(pq, g, r, output=io.StringIO())
+    assert abs(p_pq - p_exact) < .02
+    assert r_pq == r_exact
+
+
+def test_load_or_build_rebuilds_stale_index(tmpdir):
+    path = str(tmpdir.join('codes-knn.npz'))
+    r = gaussian_codes(300, 8, 6)
+    built = knn.load_or_build(path, r, 'v1', k=3, output=io.StringIO())
+    loaded = knn.load_or_build(path, r + 100, 'v1', k=3, output=io.StringIO())
+    np.testing.assert_array_equal(loaded.radii, built.radii)  # same version: loaded
+    np.testing.assert_array_equal(loaded.mean, built.mean)
+    for version, k in [('v2', 3), ('v1', 4)]:
+        rebuilt = knn.load_or_build(path, r + 100, version, k=k, output=io.StringIO())
+        np.testing.assert_allclose(rebuilt.mean, built.mean + 100, rtol=1e-5)
+        assert rebuilt.k == k
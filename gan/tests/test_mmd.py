@@ -0,0 +1,47 @@
+from __future__ import division
+
+import numpy as np
+import pytest
+
+mmd = pytest.importorskip('core.mmd')
+
+
+def cubic_kernel(A, B):
+    return (A.dot(B.T) / A.shape[1] + 1) ** 3
+
+
+@pytest.mark.parametrize('block_size', [7, 16, 1024])
+def test_tiled_sums_match_full_kernels(block_size):
+    rng = np.random.RandomState(0)
+    X, Y = rng.randn(45, 10), rng.randn(38, 10) + .1
+    expected = mmd._np_get_sums(cubic_kernel(X, Y), cubic_kernel(Y, Y))
+    sums = mmd._np_polynomial_sums(X / X.shape[1], Y, block_size=block_size)
+    for s, e in zip(sums, expected):
+        np.testing.assert_allclose(s, e, rtol=1e-10)
+
+
+def test_tiled_sums_of_float32_codes():
+    rng = np.random.RandomState(1)
+    X, Y = rng.randn(60, 16), rng.randn(50, 16)
+    expected = mmd._np_get_sums(cubic_kernel(X, Y), cubic_kernel(Y, Y))
+    X32, Y32 = X.astype(np.float32), Y.astype(np.float32)
+    sums = mmd._np_polynomial_sums(X32 / np.float32(X.shape[1]), Y32, block_size=16)
+    for s, e in zip(sums, expected):
+        np.testing.assert_allclose(s, e, rtol=1e-5)
+
+
+def test_sq_sum_accumulates_in_float64():
+    K = np.full((300, 1000), 1000.1, dtype=np.float32)
+    expected = (K.astype(np.float64) ** 2).sum()
+    assert mmd._np_sq_sum(K) == pytest.approx(expected, rel=1e-12)
+    assert mmd._np_sq_sum(K[:, ::3]) == pytest.approx(expected / 1000 * 334, rel=1e-12)
+
+
+@pytest.mark.parametrize('x_dtype, y_dtype', [(np.float64, np.float32), (np.float32, np.float64)])
+def test_tiled_sums_of_mixed_dtypes(x_dtype, y_dtype):
+    rng = np.random.RandomState(2)
+    X, Y = rng.randn(30, 8), rng.randn(25, 8)
+    expected = mmd._np_get_sums(cubic_kernel(X, Y), cubic_kernel(Y, Y))
+    sums = mmd._np_polynomial_sums((X / X.shape[1]).astype(x_dtype), Y.astype(y_dtype), block_size=8)
+    for s, e in zip(sums, expected):
+        np.testing.assert_allclose(s, e, rtol=1e-5)
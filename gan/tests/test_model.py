@@ -0,0 +1,102 @@
+from argparse import Namespace
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('needs TensorFlow 1', allow_module_level=True)
+from core import mmd
+from core.model import MMD_GAN
+
+
+def generator(z, batch_size, update_collection=None):
+    with tf.variable_scope('generator', reuse=tf.AUTO_REUSE):
+        return tf.tanh(tf.matmul(z, tf.get_variable('g_w', [4, 6])))
+
+
+def discriminator(x, batch_size, return_layers=False, update_collection=None):
+    with tf.variable_scope('discriminator', reuse=tf.AUTO_REUSE):
+        h1 = tf.tanh(tf.matmul(x, tf.get_variable('d_w1', [6, 5])))
+        return {'h1': h1, 'hF': tf.matmul(h1, tf.get_variable('d_w2', [5, 3]))}
+
+
+class Model(MMD_GAN):
+    "The micro-batching and tower gathering of MMD_GAN on a tiny dense generator and discriminator."
+    def __init__(self, z, grad_accum_steps):
+        self.config = Namespace(grad_accum_steps=grad_accum_steps, with_scaling=False,
+                                use_gaussian_noise=False, kernel='mix_rbf', gradient_penalty=0,
+                                L2_discriminator_penalty=0)
+        self.accumulate_grads = grad_accum_steps > 1
+        self.with_labels = False
+        self.z, self.y = z, None
+        self.batch_size = self.real_batch_size = z.get_shape().as_list()[0]
+        self.generator, self.discriminator = generator, discriminator
+        self.format, self.gather_towers = 'NHWC', False
+
+
+def kernel_loss(d_G, d_images):
+    return mmd.mmd2(mmd._mix_rbf_kernel(d_G, d_images))
+
+
+@pytest.mark.parametrize('grad_accum_steps', [2, 4])
+def test_accumulated_gradients_match_full_batch(grad_accum_steps):
+    rng = np.random.RandomState(0)
+    with tf.Graph().as_default():
+        z = tf.constant(rng.uniform(-1, 1, (8, 4)).astype(np.float32))
+        images = tf.constant(rng.randn(8, 6).astype(np.float32))
+
+        full = Model(z, 1)
+        _, d_G, d_images = full.forward(z, None, images, None)
+        full_loss = kernel_loss(d_G['hF'], d_images['hF'])
+        g_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'generator')
+        d_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, 'discriminator')
+        expected = tf.gradients(full_loss, g_vars + d_vars)
+
+        micro = Model(z, grad_accum_steps)
+        micro.g_vars = g_vars
+        micro.set_micro_batches(images, None, None)
+        loss = kernel_loss(micro.d_G_layers['hF'], micro.d_images_layers['hF'])
+        accumulated = micro.accumulated_gradients(loss, g_vars) + \
+            micro.accumulated_gradients(loss, d_vars)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            (l, l_full), expected, accumulated = sess.run([(loss, full_loss), expected, accumulated])
+    np.testing.assert_allclose(l, l_full, rtol=1e-5)
+    for a, e in zip(accumulated, expected):
+        np.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('num_towers', [2, 4])
+def test_global_mmd_matches_single_device(num_towers):
+    rng = np.random.RandomState(1)
+    with tf.Graph().as_default():
+        z = tf.constant(rng.uniform(-1, 1, (8, 4)).astype(np.float32))
+        images = tf.constant(rng.randn(8, 6).astype(np.float32))
+
+        single = Model(z, 1)
+        _, d_G, d_images = single.forward(z, None, images, None)
+        single.set_loss(d_G['hF'], d_images['hF'])
+        t_vars = tf.trainable_variables()
+        expected = tf.gradients(single.g_loss, t_vars)
+
+        towers = []
+        for tower_z, tower_images in zip(tf.split(z, num_towers), tf.split(images, num_towers)):
+            tower = Model(tower_z, 1)
+            G, d_G, d_images = tower.forward(tower_z, None, tower_images, None)
+            towers.append({'images': tower_images, 'G': G, 'd_images_layers': d_images,
+                           'd_G_layers': d_G})
+        gathered = Model(z, 1)
+        gathered.gather_towers = True
+        gathered.gather_tower_outputs(towers)
+        gathered.set_loss(gathered.d_G, gathered.d_images)
+        grads = tf.gradients(gathered.g_loss, t_vars)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            (loss, expected_loss), grads, expected = sess.run(
+                [(gathered.g_loss, single.g_loss), grads, expected])
+    np.testing.assert_allclose(loss, expected_loss, rtol=1e-5)
+    for g, e in zip(grads, expected):
+        np.testing.assert_allclose(g, e, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('needs TensorFlow 1', allow_module_level=True)
+from core.precision import DynamicLossScale
+
+
+def reference_scales(finite_steps, init_scale, factor, incr_every_n_steps, min_scale):
+    "The scale after each step, in numpy."
+    scale, good_steps, scales = init_scale, 0, []
+    for finite in finite_steps:
+        if not finite:
+            scale, good_steps = max(scale / factor, min_scale), 0
+        elif good_steps + 1 >= incr_every_n_steps:
+            scale, good_steps = scale * factor, 0
+        else:
+            good_steps += 1
+        scales.append(scale)
+    return scales
+
+
+def test_dynamic_loss_scale():
+    finite_steps = [True, True, True, False, True, False, False, False, True, True, True]
+    with tf.Graph().as_default():
+        w = tf.Variable([1., 2.])
+        grad = tf.placeholder(tf.float32, [2])
+        loss_scale = DynamicLossScale('loss_scale', init_scale=4., incr_every_n_steps=3, min_scale=1.)
+        train_op = loss_scale.apply_gradients(tf.train.GradientDescentOptimizer(1.), [(grad, w)])
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            expected_w, scales = np.array([1., 2.], np.float32), []
+            for finite in finite_steps:
+                g = np.array([.5, .25], np.float32) if finite else np.array([np.inf, .25], np.float32)
+                sess.run(train_op, {grad: g})
+                if finite:
+                    expected_w -= g
+                # updates with non-finite gradients are skipped
+                np.testing.assert_array_equal(sess.run(w), expected_w)
+                scales.append(sess.run(loss_scale.scale))
+    assert scales == reference_scales(finite_steps, 4., 2., 3, 1.)
+    assert min(scales) == 1. and max(scales) == 8.
+
+
+def test_scaled_gradients_are_unscaled():
+    rng = np.random.RandomState(0)
+    with tf.Graph().as_default():
+        w = tf.Variable(rng.randn(3).astype(np.float32))
+        loss = tf.reduce_sum(tf.square(w)) + tf.reduce_sum(w)
+        loss_scale = DynamicLossScale('loss_scale', init_scale=2.**10)
+        scaled, plain = loss_scale.gradients(loss, [w]), tf.gradients(loss, [w])
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            scaled, plain = sess.run([scaled, plain])
+    np.testing.assert_allclose(scaled[0], plain[0], rtol=1e-6)
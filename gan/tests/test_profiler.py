@@ -0,0 +1,44 @@
+import os
+from collections import namedtuple
+
+import pytest
+
+profiler = pytest.importorskip('utils.profiler')
+
+RunMetadata = namedtuple('RunMetadata', ['step_stats'])
+
+
+class Timeline(object):
+    def __init__(self, step_stats):
+        self.step_stats = step_stats
+
+    def generate_chrome_trace_format(self):
+        return '{"trace": "%s"}' % self.step_stats
+
+
+def test_traces_of_several_d_steps_per_global_step(tmpdir, monkeypatch):
+    monkeypatch.setattr(profiler.timeline, 'Timeline', Timeline)
+    p = profiler.Profiler(enabled=True, trace_start=10, trace_steps=2, log_dir=str(tmpdir))
+    # the global step only advances on G steps, each preceded by two D steps
+    runs = [(step, run) for step in range(9, 13) for run in ['d1', 'd2', 'g']]
+    for step, run in runs:
+        run_kwargs = p.run_kwargs(step) if not p.is_traced(step) else \
+            {'run_metadata': RunMetadata('%d-%s' % (step, run))}
+        p.add_trace(step, run_kwargs, run)
+    assert p.traces == []
+    names = sorted(os.listdir(str(tmpdir)))
+    assert names == sorted('timeline_%d_%s.json' % (step, run) for step, run in runs
+                           if step in (10, 11))
+    with open(os.path.join(str(tmpdir), 'timeline_11_d2.json')) as f:
+        assert f.read() == '{"trace": "11-d2"}'
+
+
+def test_data_wait_is_recorded_on_every_step():
+    p = profiler.Profiler(enabled=True)
+    polls = iter([False, False, True, True])
+    p.wait_for_data(lambda: next(polls), poll=0)
+    p.wait_for_data(lambda: next(polls), poll=0)
+    assert len(p.durations['data_wait']) == 2
+    off = profiler.Profiler(enabled=False)
+    off.wait_for_data(lambda: pytest.fail('polled when disabled'))
+    assert not off.durations
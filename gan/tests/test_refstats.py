@@ -0,0 +1,73 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+refstats = pytest.importorskip('refstats')
+
+
+def codes(n, d, seed, shift=0.):
+    rng = np.random.RandomState(seed)
+    return np.maximum(rng.randn(n, d) + shift, 0).astype(np.float32)
+
+
+def test_save_load_round_trip(tmpdir):
+    np.random.seed(0)
+    r, g = codes(300, 8, 0), codes(300, 8, 1, shift=.2)
+    stats = refstats.ReferenceStats.from_codes(r, 'key', 'v1', n_subsets=4, subset_size=50,
+                                               output=io.StringIO())
+    path = str(tmpdir.join('stats.npz'))
+    stats.save(path)
+    loaded = refstats.ReferenceStats.load(path)
+    assert loaded.matches('key', 'v1') and not loaded.matches('key', 'v2')
+    assert loaded.compatible(n_subsets=4, subset_size=50)
+    assert not loaded.compatible(n_subsets=4, subset_size=50, degree=2)
+    assert loaded.kernel_args == stats.kernel_args
+    for name in ['mean', 'cov', 'sqrt_cov', 'kid_indices']:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(stats, name))
+
+    loaded.codes = r
+    for s in [stats, loaded]:
+        np.random.seed(1)
+        s.scores = (s.fid(g, splits=1, output=io.StringIO()),
+                    s.kid(g, ret_var=False, output=io.StringIO()))
+    np.testing.assert_allclose(loaded.scores[0], stats.scores[0], rtol=1e-10)
+    np.testing.assert_allclose(loaded.scores[1], stats.scores[1], rtol=1e-10)
+
+
+def test_load_or_compute_recomputes_stale(tmpdir, monkeypatch):
+    computed = []
+    from_codes = refstats.ReferenceStats.from_codes.__func__
+
+    def counting(cls, *args, **kwargs):
+        computed.append(args[1:3])
+        return from_codes(cls, *args, **kwargs)
+
+    monkeypatch.setattr(refstats.ReferenceStats, 'from_codes', classmethod(counting))
+    path, r = str(tmpdir.join('stats.npz')), codes(200, 4, 2)
+    args = {'n_subsets': 2, 'subset_size': 50, 'output': io.StringIO()}
+    refstats.load_or_compute(path, r, 'key', 'v1', **args)
+    stats = refstats.load_or_compute(path, lambda: r, 'key', 'v1', **args)
+    assert computed == [('key', 'v1')]
+    assert stats.codes is r
+    refstats.load_or_compute(path, r, 'key', 'v2', **args)  # the dataset changed
+    refstats.load_or_compute(path, r, 'key', 'v2', n_subsets=3, subset_size=50, output=io.StringIO())
+    assert computed == [('key', 'v1'), ('key', 'v2'), ('key', 'v2')]
+
+
+def test_dataset_version(tmpdir):
+    data = tmpdir.mkdir('data')
+    data.join('train.tfrecord').write('records')
+    images = data.mkdir('images')
+    images.join('0.png').write('image')
+    version = refstats.dataset_version(str(data))
+    assert refstats.dataset_version(str(data)) == version
+
+    images.join('0.png').write('edited image')  # loose images are not stat'ed
+    os.utime(str(images.join('0.png')), (0, 0))
+    assert refstats.dataset_version(str(data)) == version
+
+    data.join('train.tfrecord').write('more records')
+    assert refstats.dataset_version(str(data)) != version
+    assert refstats.dataset_version(str(tmpdir.join('missing'))) != version
@@ -0,0 +1,65 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from core import sampling
+
+
+class Generator(object):
+    "uint8 NHWC images computed from z (and y), failing after `fail_after` batches."
+    def __init__(self, fail_after=None):
+        self.fail_after, self.batches = fail_after, 0
+
+    def __call__(self, z, y):
+        if self.batches == self.fail_after:
+            raise KeyboardInterrupt
+        self.batches += 1
+        images = np.round(127.5 * (z[:, :12] + 1.)).astype(np.uint8).reshape(-1, 2, 2, 3)
+        if y is not None:
+            images[:, 0, 0, 0] = y
+        return images
+
+
+def sample(directory, generate, batch_size=4, **kwargs):
+    return sampling.bulk_sample(generate, 25, str(directory), 16, shard_size=10,
+                                batch_size=batch_size, output=io.StringIO(), **kwargs)
+
+
+def test_shards_do_not_depend_on_batch_size(tmpdir):
+    sample(tmpdir.join('a'), Generator(), batch_size=3)
+    sample(tmpdir.join('b'), Generator(), batch_size=10)
+    a, b = sampling.load_samples(str(tmpdir.join('a'))), sampling.load_samples(str(tmpdir.join('b')))
+    assert [len(shard) for shard in a] == [10, 10, 5]
+    for x, y in zip(a, b):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_resume(tmpdir):
+    expected = tmpdir.join('expected')
+    sample(expected, Generator(), num_classes=5)
+    with pytest.raises(KeyboardInterrupt):
+        sample(tmpdir.join('resumed'), Generator(fail_after=6), num_classes=5)
+    # the two shards sampled before the interruption are complete
+    assert sorted(os.listdir(str(tmpdir.join('resumed')))) == \
+        ['samples-00000.npy', 'samples-00001.npy', 'samples.json']
+
+    generate = Generator()
+    sample(tmpdir.join('resumed'), generate, num_classes=5)
+    assert generate.batches == 2
+    for x, y in zip(sampling.load_samples(str(expected)),
+                    sampling.load_samples(str(tmpdir.join('resumed')))):
+        np.testing.assert_array_equal(x, y)
+
+    with pytest.raises(ValueError, match='seed'):
+        sample(tmpdir.join('resumed'), Generator(), seed=1, num_classes=5)
+
+
+def test_writer_errors(tmpdir):
+    writer = sampling.ShardWriter()
+    writer.put(str(tmpdir.join('missing', 'samples-00000.npy')), np.zeros((2, 1), np.uint8))
+    with pytest.raises(IOError):
+        writer.close()
+    with pytest.raises(ValueError):
+        sample(tmpdir.join('a'), Generator(), fmt='jpg')
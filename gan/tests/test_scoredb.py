@@ -0,0 +1,32 @@
+import numpy as np
+
+from utils import scoredb
+
+
+def test_round_trip():
+    db = scoredb.ScoreDB(':memory:')
+    tables = [name for name, in db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    assert sorted(tables) == ['rounds', 'runs', 'scores']
+
+    a = db.run_id('a', {'batch_size': 64})
+    assert db.run_id('a', {'batch_size': 128}) == a  # the first config is kept
+    assert db.config('a') == {'batch_size': 64}
+    db.append('a', 2000, {'mmd2': [.3, .5], 'fid': [40.]}, elapsed=1.5, lr=1e-4)
+    db.append('a', 4000, {'mmd2': [.1, .2, .3]}, lr=5e-5)
+    db.append('a', 2000, {'mmd2': [.4]})  # scored again, the latest row wins
+    db.append('b', 2000, {'mmd2': [.05]})
+    assert db.runs() == ['a', 'b']
+
+    summary = db.summary('mmd2')
+    assert [row[:2] for row in summary] == [('a', 2000), ('a', 4000), ('b', 2000)]
+    np.testing.assert_allclose([row[2] for row in summary], [.4, .2, .05])
+    assert [row[4] for row in summary] == [1, 3, 1]
+    assert db.summary('mmd2', ['b']) == summary[2:]
+
+    steps, values = db.values('a', 'mmd2')
+    assert steps == [2000, 4000]
+    np.testing.assert_array_equal(values[1], [.1, .2, .3])
+
+    assert [row[:2] for row in db.best('mmd2')] == [('b', 2000), ('a', 4000)]
+    assert [row[:2] for row in db.best('mmd2', lower=False)] == [('a', 2000), ('b', 2000)]
+    assert [(step, lr) for step, _, _, lr, _ in db.rounds('a')] == [(2000, 1e-4), (2000, None), (4000, 5e-5)]
@@ -0,0 +1,115 @@
+import threading
+
+import numpy as np
+import pytest
+
+scorer = pytest.importorskip('utils.scorer')
+
+
+class Recorder(scorer.Scorer):
+    def __init__(self):
+        self.updates = []
+
+    def update(self, gan, step, output, codes, elapsed, snapshot=None):
+        self.updates.append((step, snapshot))
+
+
+def start_job(s, step, release):
+    job = {'step': step, 'snapshot': 'snapshot-%d' % step}
+
+    def run():
+        release.wait()
+        job['output'], job['codes'], job['time'] = {'mmd2': np.zeros(1)}, None, 0.
+
+    job['thread'] = threading.Thread(target=run)
+    job['thread'].start()
+    s.job = job
+
+
+def test_finish_applies_pending_job():
+    s, release = Recorder(), threading.Event()
+    start_job(s, 2000, release)
+    threading.Timer(.1, release.set).start()
+    s.finish(gan=None)
+    assert s.updates == [(2000, 'snapshot-2000')]
+    assert s.job is None
+    s.finish(gan=None)  # nothing pending
+    assert len(s.updates) == 1
+
+
+def test_finish_raises_job_error():
+    s = Recorder()
+    s.job = {'step': 0, 'thread': threading.Thread(target=lambda: None), 'error': ValueError('scoring')}
+    s.job['thread'].start()
+    with pytest.raises(ValueError):
+        s.finish(gan=None)
+    assert s.updates == []
+
+
+class FakeGAN(object):
+    class config:
+        MMD_sdlr_past_sample = 2
+        MMD_sdlr_num_test = 2
+        with_scaling = False
+        keep_top_k = 0
+
+    lr = sc = None
+
+    class profiler:
+        @staticmethod
+        def record(name, elapsed):
+            pass
+
+    def __init__(self):
+        self.decays, self.step = [], None
+        self.sess = self
+
+    def run(self, tensor):
+        return 1e-4
+
+    def decay_ops(self):
+        self.decays.append(self.step)
+
+    def timer(self, step, message):
+        pass
+
+    def save_checkpoint(self):
+        pass
+
+
+def lr_scorer(train_codes):
+    s = scorer.Scorer(None, 'cifar10')
+    s.train_codes, s.run = train_codes, 'run'
+    s.db = scorer.scoredb.ScoreDB(':memory:')
+    return s
+
+
+def test_three_sample_state_round_trip(tmpdir):
+    rng = np.random.RandomState(0)
+    train_codes = rng.rand(200, 16).astype(np.float32)
+    # improving, then stuck samples: both kinds of decisions
+    shifts = [.5, .4, .3, .2, .2, .2, .2, .2, .1, .1, .1, .1]
+    samples = [(rng.rand(200, 16) + shift).astype(np.float32) for shift in shifts]
+
+    def feed(s, gan, steps):
+        for step in steps:
+            gan.step = step
+            s.update(gan, step, {'mmd2': np.array([shifts[step]])}, samples[step], 0.)
+
+    uninterrupted, gan = lr_scorer(train_codes), FakeGAN()
+    feed(uninterrupted, gan, range(len(samples)))
+    assert gan.decays
+
+    for stop in [3, 6]:
+        first, resumed_gan = lr_scorer(train_codes), FakeGAN()
+        feed(first, resumed_gan, range(stop))
+        path = str(tmpdir.join('state-%d.npz' % stop))
+        np.savez(path, **first.state_dict())
+        resumed = lr_scorer(train_codes)
+        resumed.load_state_dict(dict(np.load(path)))
+        feed(resumed, resumed_gan, range(stop, len(samples)))
+        assert resumed_gan.decays == gan.decays
+        assert resumed.three_sample.chances == uninterrupted.three_sample.chances
+        for a, b in zip(resumed.three_sample.sums, uninterrupted.three_sample.sums):
+            for x, y in zip(a, b):
+                np.testing.assert_array_equal(x, y)
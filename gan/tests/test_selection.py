@@ -0,0 +1,46 @@
+import numpy as np
+from scipy import stats
+
+import selection
+from utils.scoredb import ScoreDB
+
+
+def test_rank_confidence_intervals():
+    db = ScoreDB(':memory:')
+    rng = np.random.RandomState(0)
+    values = {('a', 2000): rng.normal(.3, .05, 10), ('a', 4000): rng.normal(.1, .05, 40),
+              ('b', 2000): rng.normal(.2, .01, 10), ('b', 4000): np.array([.15])}
+    for (run, step), value in sorted(values.items()):
+        db.append(run, step, {'mmd2': value})
+
+    ranked = selection.rank(db, 'mmd2', confidence=.9)
+    assert [r[:2] for r in ranked] == [('a', 4000), ('b', 4000), ('b', 2000), ('a', 2000)]
+    for run, step, mean, low, high in ranked:
+        value = values[run, step]
+        if len(value) == 1:
+            assert low == mean == high
+            continue
+        expected = stats.norm.interval(.9, loc=value.mean(), scale=value.std() / np.sqrt(len(value)))
+        np.testing.assert_allclose([mean, low, high], [value.mean()] + list(expected), rtol=1e-10)
+    # a wider confidence widens the intervals, higher is better reverses the order
+    wide = selection.rank(db, 'mmd2', confidence=.99)
+    assert all(w[3] < r[3] and w[4] > r[4] for w, r in zip(wide, ranked) if r[3] < r[4])
+    assert [r[:2] for r in selection.rank(db, 'mmd2', runs=['b'], lower=False)] == \
+        [('b', 2000), ('b', 4000)]
+
+
+def test_keep_top_links(tmpdir):
+    src = tmpdir.mkdir('ckpt')
+    for step in [2000, 4000]:
+        for ext in ['index', 'data-00000-of-00001']:
+            src.join('MMDGAN.model-%d.%s' % (step, ext)).write('%d' % step)
+    top = src.mkdir('top')
+    for step in [2000, 4000]:
+        selection.link_checkpoint(str(src.join('MMDGAN.model-%d' % step)),
+                                  str(top.join('top.model-%d' % step)))
+    src.join('MMDGAN.model-2000.index').remove()  # deleted by the Saver, the link survives
+    assert top.join('top.model-2000.index').read() == '2000'
+
+    selection.keep_top(str(top), set([4000]))
+    assert sorted(f.basename for f in top.listdir()) == \
+        ['top.model-4000.data-00000-of-00001', 'top.model-4000.index']
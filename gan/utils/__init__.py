@@ -1 +1 @@
-__all__ = ['scorer', 'timer', 'misc']
+__all__ = ['scorer', 'timer', 'misc', 'profiler', 'scoredb']
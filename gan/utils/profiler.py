@@ -0,0 +1,102 @@
+"""
+Per-phase timing of the training loop. Durations are kept in ring buffers
+and their rolling percentiles written to the summary writer; selected steps
+can be traced and exported as Chrome trace JSON (chrome://tracing).
+"""
+import os
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class _NoOp(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_no_op = _NoOp()
+
+
+class Profiler(object):
+    def __init__(self, enabled=False, window=1000, trace_start=0, trace_steps=0,
+                 log_dir=None, percentiles=(50, 90, 99)):
+        self.enabled = enabled
+        self.window = window
+        self.trace_range = range(trace_start, trace_start + trace_steps)
+        self.log_dir = log_dir
+        self.percentiles = percentiles
+        self.durations = defaultdict(lambda: deque(maxlen=self.window))
+        self.traces = []
+
+    def phase(self, name):
+        "Context timing one occurrence of the phase; free when disabled."
+        if not self.enabled:
+            return _no_op
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.time()
+        yield
+        self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self.durations[name].append(seconds)
+
+    def is_traced(self, step):
+        return step in self.trace_range
+
+    def run_kwargs(self, step):
+        "Keyword arguments of session.run that enable a full trace at traced steps."
+        if not self.is_traced(step):
+            if self.traces:  # past the traced window
+                self.export_traces()
+            return {}
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': tf.RunMetadata()}
+
+    def wait_for_data(self, ready, poll=1e-3, timeout=60.):
+        '''
+        Records the time until `ready()`, e.g. whether the prefetch queue
+        holds the batches of the next step, polling it on every step.
+        '''
+        if not self.enabled:
+            return
+        start = time.time()
+        while not ready() and (time.time() - start < timeout):
+            time.sleep(poll)
+        self.record('data_wait', time.time() - start)
+
+    def add_trace(self, step, run_kwargs, run='g'):
+        "Keeps the trace of a traced run; the D steps of a global step are told apart by `run`."
+        if 'run_metadata' not in run_kwargs:
+            return
+        step_stats = run_kwargs['run_metadata'].step_stats
+        self.traces.append(((step, run), timeline.Timeline(step_stats).generate_chrome_trace_format()))
+
+    def export_traces(self):
+        for (step, run), trace in self.traces:
+            path = os.path.join(self.log_dir, 'timeline_%d_%s.json' % (step, run))
+            with open(path, 'w') as f:
+                f.write(trace)
+        print('[*] %d step traces written to %s' % (len(self.traces), self.log_dir))
+        self.traces = []
+
+    def write_summaries(self, writer, step, **gauges):
+        if not self.enabled:
+            return
+        values = []
+        for name, durations in sorted(self.durations.items()):
+            for p, v in zip(self.percentiles, np.percentile(durations, self.percentiles)):
+                values.append(tf.Summary.Value(tag='profile/%s_p%d' % (name, p), simple_value=v))
+        for name, value in gauges.items():
+            values.append(tf.Summary.Value(tag='profile/%s' % name, simple_value=value))
+        writer.add_summary(tf.Summary(value=values), step)
@@ -0,0 +1,154 @@
+"""
+Append-only store of the scores computed during training, one SQLite file
+per experiment shared by its runs:
+
+    runs(id, name, config, created)
+    rounds(run_id, step, wall_time, elapsed, lr, sc)
+    scores(run_id, step, metric, mean, std, n, value)
+
+`value` holds the float64 array of the per-split estimates, e.g. the KID of
+each subset; mean, std and n are stored alongside so that runs can be
+compared without decoding the arrays. Rows are never updated: a step scored
+again (e.g. after resuming) is appended and the latest row wins.
+
+Compare runs from the gan directory:
+
+    python utils/scoredb.py $OUTDIR/sample/scores.sqlite --metric mmd2
+    python utils/scoredb.py $OUTDIR/sample/scores.sqlite --metric mmd2 --best
+"""
+from __future__ import print_function
+import json
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    config TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    step INTEGER NOT NULL,
+    wall_time REAL,
+    elapsed REAL,
+    lr REAL,
+    sc REAL
+);
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    step INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    mean REAL,
+    std REAL,
+    n INTEGER,
+    value BLOB
+);
+CREATE INDEX IF NOT EXISTS scores_metric ON scores (metric, run_id, step);
+CREATE INDEX IF NOT EXISTS rounds_run ON rounds (run_id, step);
+"""
+
+
+class ScoreDB(object):
+    def __init__(self, path, timeout=60.):
+        # runs of a sweep may write to the same file concurrently
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def run_id(self, name, config=None):
+        "Id of the run `name`, created with its config (a dict) if needed."
+        # in one transaction, since runs of a sweep may create the same name concurrently
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO runs (name, config, created) VALUES (?, ?, ?)',
+                (name, json.dumps(config, default=str, sort_keys=True), time.time()))
+            return self.conn.execute('SELECT id FROM runs WHERE name = ?', (name,)).fetchone()[0]
+
+    def append(self, run, step, scores, elapsed=None, lr=None, sc=None):
+        "Appends a scoring round: `scores` maps metric names to arrays of estimates."
+        run_id = self.run_id(run)
+        rows = []
+        for metric, value in sorted(scores.items()):
+            value = np.asarray(value, dtype=np.float64).ravel()
+            rows.append((run_id, step, metric, float(value.mean()), float(value.std()),
+                         len(value), sqlite3.Binary(value.tobytes())))
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO rounds (run_id, step, wall_time, elapsed, lr, sc) VALUES (?, ?, ?, ?, ?, ?)',
+                (run_id, step, time.time(), elapsed, lr, sc))
+            self.conn.executemany(
+                'INSERT INTO scores (run_id, step, metric, mean, std, n, value) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def runs(self):
+        return [name for name, in self.conn.execute('SELECT name FROM runs ORDER BY id')]
+
+    def config(self, run):
+        row = self.conn.execute('SELECT config FROM runs WHERE name = ?', (run,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def summary(self, metric, runs=None):
+        "Latest (run, step, mean, std, n) of each step of each run, ordered by run and step."
+        query = ('SELECT r.name, s.step, s.mean, s.std, s.n FROM scores s JOIN runs r ON r.id = s.run_id '
+                 'WHERE s.id IN (SELECT MAX(id) FROM scores WHERE metric = ? GROUP BY run_id, step)')
+        args = [metric]
+        if runs:
+            query += ' AND r.name IN (%s)' % ','.join('?' * len(runs))
+            args += list(runs)
+        return self.conn.execute(query + ' ORDER BY r.id, s.step', args).fetchall()
+
+    def values(self, run, metric):
+        "Steps of the run and the arrays of estimates of `metric` at each."
+        rows = self.conn.execute(
+            'SELECT s.step, s.value FROM scores s JOIN runs r ON r.id = s.run_id '
+            'WHERE r.name = ? AND s.metric = ? ORDER BY s.step, s.id', (run, metric)).fetchall()
+        latest = dict((step, np.frombuffer(value, dtype=np.float64)) for step, value in rows)
+        steps = sorted(latest)
+        return steps, [latest[step] for step in steps]
+
+    def best(self, metric, runs=None, lower=True):
+        "The (run, step, mean, std, n) of the best mean of each run."
+        best = {}
+        for row in self.summary(metric, runs):
+            if (row[0] not in best) or ((row[2] < best[row[0]][2]) == lower):
+                best[row[0]] = row
+        return [best[run] for run in sorted(best, key=lambda r: best[r][2], reverse=not lower)]
+
+    def rounds(self, run):
+        "(step, wall_time, elapsed, lr, sc) of each scoring round of the run."
+        return self.conn.execute(
+            'SELECT q.step, q.wall_time, q.elapsed, q.lr, q.sc FROM rounds q JOIN runs r ON r.id = q.run_id '
+            'WHERE r.name = ? ORDER BY q.step, q.id', (run,)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the scores of training runs.')
+    parser.add_argument('db', type=str, help='scores SQLite file')
+    parser.add_argument('--metric', type=str, default='mmd2', help='[%(default)s]')
+    parser.add_argument('--runs', type=str, nargs='*', default=None, help='[all]')
+    parser.add_argument('--best', action='store_true', help='only the best step of each run')
+    parser.add_argument('--higher', action='store_true', help='higher is better, e.g. inception')
+    args = parser.parse_args()
+
+    db = ScoreDB(args.db)
+    if args.best:
+        rows = db.best(args.metric, args.runs, lower=not args.higher)
+    else:
+        rows = db.summary(args.metric, args.runs)
+    print('%-60s  %8s  %12s  %12s  %5s' % ('run', 'step', args.metric, 'std', 'n'))
+    for run, step, mean, std, n in rows:
+        print('%-60s  %8d  %12.6f  %12.6f  %5d' % (run, step, mean, std, n))
+
+
+if __name__ == '__main__':
+    main()
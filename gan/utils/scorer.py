@@ -9,130 +9,324 @@ import time
 import os
 import scipy
 import sys
+import threading
 import numpy as np
+from six.moves import queue
 from core import mmd
+from utils import scoredb
 import compute_scores as cs
+import refstats
+import knn
+import selection
 
 
 class Scorer(object):
-    def __init__(self, sess, dataset, lr_scheduler=True, stdout=sys.stdout):
+    def __init__(self, sess, dataset, lr_scheduler=True, stdout=sys.stdout, isolated=False):
         self.stdout = stdout
         self.dataset = dataset
-        if dataset == 'mnist':
+        self.isolated = isolated
+        extractor = 'lenet' if dataset == 'mnist' else 'inception'
+        if isolated:  # in a graph or a process of its own, fed from the host
+            self.model = cs.isolated_extractor(extractor, process=isolated == 'process')
+        elif dataset == 'mnist':
             self.model = cs.LeNet(sess)
+        else:
+            # Inception is built in-graph on the image tensors, see fuse
+            self.model = None
+        if dataset == 'mnist':
             self.size = 100000
             self.frequency = 500
         else:
-            self.model = cs.Inception(sess)
             self.size = 25000
             self.frequency = 2000
+        self.sess = sess
+        self.fused = {}
 
-        self.output = []
+        self.best_mmd2 = None
 
         if lr_scheduler:
-            self.three_sample = []
-            self.three_sample_chances = 0
+            self.three_sample = None  # mmd.ThreeSampleState, built with the train codes
+            self.three_sample_loaded = None
         self.lr_scheduler = lr_scheduler
 
+    def state_dict(self):
+        if self.lr_scheduler and (self.three_sample is not None):
+            return self.three_sample.state_dict()
+        return self.three_sample_loaded if self.lr_scheduler else None
+
+    def load_state_dict(self, state):
+        if self.lr_scheduler:
+            if self.three_sample is not None:
+                self.three_sample.load_state_dict(state)
+            else:
+                self.three_sample_loaded = state
+
     def set_train_codes(self, gan):
         suffix = '' if (gan.output_size <= 32) else ('-%d' % gan.output_size)
         path = os.path.join(gan.data_dir, '%s-codes%s.npy' % (self.dataset, suffix))
+        stats_path = os.path.join(gan.data_dir, '%s-refstats%s.npz' % (self.dataset, suffix))
+        key = refstats.stats_key(self.dataset, gan.output_size,
+                                 'lenet' if self.dataset == 'mnist' else 'inception', self.size)
+        version = refstats.dataset_version(os.path.join(gan.data_dir, self.dataset))
+        # codes cached before the dataset changed are stale as well
+        stale = os.path.exists(stats_path) and \
+            not refstats.ReferenceStats.load(stats_path).matches(key, version)
 
-        if os.path.exists(path):
+        if os.path.exists(path) and not stale:
             self.train_codes = np.load(path)
             print('[*] Train codes loaded. ')
-            return
-        print('[!] Codes not found. Featurizing...')
-        ims = []
-        while len(ims) < self.size // gan.batch_size:
-            ims.append(gan.sess.run(gan.images_NHWC))
-        ims = np.concatenate(ims, axis=0)[:self.size]
-        if self.dataset == 'mnist':  # LeNet model takes [-.5, .5] pics
-            ims -= .5
-            if (ims.max() > .5) or (ims.min() < -.5):
-                print('WARNING! LeNet min/max violated: min = %f, max = %f. Clipping values.' % (ims.min(), ims.max()))
-                ims = ims.clip(-.5, .5)
         else:
-            ims *= 255.0
-            if (ims.max() > 255.) or (ims.min() < .0):
-                print('WARNING! Inception min/max violated: min = %f, max = %f. Clipping values.' % (ims.min(), ims.max()))
-                ims = ims.clip(0., 255.)
+            self.featurize_train_codes(gan, path)
+        self.ref_stats = refstats.load_or_compute(stats_path, self.train_codes, key, version,
+                                                  output=self.stdout,
+                                                  n_subsets=gan.config.kid_max_subsets)
+        if gan.config.score_knn:
+            self.knn_index = knn.load_or_build(
+                path[:-len('.npy')] + '-knn.npz', self.train_codes, refstats.dataset_version(path),
+                k=gan.config.knn_k, pca_dim=gan.config.knn_pca_dim,
+                pq_subspaces=gan.config.knn_pq_subspaces, output=self.stdout)
 
-        _, self.train_codes = cs.featurize(ims, self.model, get_preds=True,
-                                           get_codes=True, output=self.stdout)
+    def featurize_train_codes(self, gan, path):
+        print('[!] Codes not found. Featurizing...')
+        self.train_codes = self.stream_featurize(gan.sess, gan.images_NHWC, get_preds=False)[0]
         np.save(path, self.train_codes)
         print('[*] %d train images featurized and saved in <%s>' % (self.size, path))
 
+    def transform(self, images):
+        if self.dataset == 'mnist':  # LeNet model takes [-.5, .5] pics
+            images -= .5
+            low, high = -.5, .5
+        else:  # Inception model takes [0 , 255] pics
+            images *= 255.0
+            low, high = 0., 255.
+        if (images.max() > high) or (images.min() < low):
+            print('WARNING! min/max violated: min = %f, max = %f. Clipping values.' % (images.min(), images.max()))
+            np.clip(images, low, high, out=images)
+        return images
+
+    def fuse(self, images):
+        """
+        Builds Inception on the `images` tensor (values in [0, 1]), so that
+        the images never leave the device; LeNet is fed from the host.
+        """
+        if self.isolated:
+            return None
+        if (self.dataset != 'mnist') and (images not in self.fused):
+            self.fused[images] = cs.Inception(self.sess, images)
+        return self.fused.get(images)
+
+    def stream_featurize(self, sess, images, get_preds=True, get_codes=True, prefetch=4):
+        """
+        Featurizes `self.size` images evaluated from the `images` tensor. A
+        thread evaluates the batches and passes them to the featurizer through
+        a bounded queue, so that both overlap and only the outputs are kept.
+        """
+        model = self.fuse(images)
+        if model is not None:
+            return cs.featurize_in_graph(self.size, model, get_preds=get_preds,
+                                         get_codes=get_codes, output=self.stdout)
+
+        batches = queue.Queue(maxsize=prefetch)
+        done = threading.Event()
+
+        def produce():
+            try:
+                produced = 0
+                while (produced < self.size) and not done.is_set():
+                    batch = self.transform(sess.run(images))
+                    batches.put(batch)
+                    produced += len(batch)
+            except Exception as e:
+                batches.put(e)
+
+        def consume():
+            while True:
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            return cs.featurize_batches(consume(), self.size, self.model, get_preds=get_preds,
+                                        get_codes=get_codes, output=self.stdout)
+        finally:
+            done.set()
+            while producer.is_alive():  # unblock a pending put
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    pass
+                producer.join(.1)
+
     def compute(self, gan, step):
+        if gan.config.async_scoring:
+            return self.compute_async(gan, step)
         if step % gan.config.MMD_sdlr_freq != 0:
             return
 
+        self.prepare(gan)
+        tt = time.time()
+        with cs.policy.limits():
+            output, codes = self.score(gan, step, gan.G_NHWC)
+            self.update(gan, step, output, codes, time.time() - tt)
+
+    def prepare(self, gan):
         if not hasattr(self, 'train_codes'):
+            self.open_db(gan)
+            cs.set_policy(kernel_dtype=gan.config.score_dtype,
+                          blas_threads=gan.config.score_blas_threads,
+                          openmp_threads=gan.config.score_openmp_threads)
             print('[ ] Getting train codes...')
             self.set_train_codes(gan)
 
-        tt = time.time()
+    def open_db(self, gan):
+        """
+        Opens the score store of the experiment (shared by the runs in the
+        parent of sample_dir) and resumes the best KID of the run from it.
+        """
+        path = gan.config.score_db or os.path.join(os.path.dirname(gan.sample_dir), 'scores.sqlite')
+        self.db = scoredb.ScoreDB(path)
+        self.run = os.path.basename(gan.sample_dir)
+        self.db.run_id(self.run, vars(gan.config))
+        best = self.db.best('mmd2', [self.run])
+        if best:
+            self.best_mmd2 = best[0][2]
+        print('[*] Scores stored in <%s> as run %s' % (path, self.run))
+
+    def score(self, gan, step, images):
+        "Computes the scores of the generated `images` tensor; returns the scores and the codes."
         gan.timer(step, "Scoring start")
         output = {}
-        images4score = gan.get_samples(n=self.size, save=False)
-        if self.dataset == 'mnist':  # LeNet model takes [-.5, .5] pics
-            images4score -= .5
-            if (images4score.max() > .5) or (images4score.min() < -.5):
-                print('WARNING! LeNet min/max violated: min = %f, max = %f. Clipping values.' % (images4score.min(), images4score.max()))
-                images4score = images4score.clip(-.5, .5)
-        else:  # Inception model takes [0 , 255] pics
-            images4score *= 255.0
-            if (images4score.max() > 255.) or (images4score.min() < .0):
-                print('WARNING! Inception min/max violated: min = %f, max = %f. Clipping values.' % (images4score.min(), images4score.max()))
-                images4score = images4score.clip(0., 255.)
-
-        preds, codes = cs.featurize(images4score, self.model, get_preds=True,
-                                    get_codes=True, output=self.stdout)
+        preds, codes = self.stream_featurize(gan.sess, images)
         gan.timer(step, "featurizing finished")
 
         output['inception'] = scores = cs.inception_score(preds)
         gan.timer(step, "Inception mean (std): %f (%f)" % (np.mean(scores), np.std(scores)))
-        output['fid'] = scores = cs.fid_score(
+        output['fid'] = scores = self.ref_stats.fid(
             codes,
-            self.train_codes,
             output=self.stdout,
             split_method='bootstrap',
             splits=3)
         gan.timer(step, "FID mean (std): %f (%f)" % (np.mean(scores), np.std(scores)))
 
-        ret = cs.polynomial_mmd_averages(
+        stopping = None
+        if gan.config.kid_target_se or gan.config.kid_time_budget:
+            stopping = cs.KIDStopping(gan.config.kid_target_se, gan.config.kid_time_budget)
+        ret = self.ref_stats.kid(
             codes,
-            self.train_codes,
             output=self.stdout,
-            n_subsets=10,
-            subset_size=1000,
-            ret_var=False)
+            ret_var=False,
+            batch_size=10 if stopping is None else 2,
+            stopping=stopping)
         output['mmd2'] = mmd2s = ret
-        gan.timer(step, "KID mean (std): %f (%f)" % (mmd2s.mean(), mmd2s.std()))
+        gan.timer(step, "KID mean (std): %f (%f), %d subsets" % (mmd2s.mean(), mmd2s.std(), len(mmd2s)))
+
+        if gan.config.score_knn:
+            precision, recall = knn.precision_recall(self.knn_index, codes, self.train_codes,
+                                                     output=self.stdout)
+            output['precision'], output['recall'] = np.array([precision]), np.array([recall])
+            gan.timer(step, "k-NN precision: %f, recall: %f" % (precision, recall))
+        return output, codes
+
+    def keep_top(self, gan, step, snapshot=None):
+        """
+        Keeps hard links to the checkpoints of the keep_top_k best scored
+        steps of the run, by KID, in checkpoint_dir/top.
+        """
+        ranked = selection.rank(self.db, 'mmd2', [self.run])
+        top = set(s for _, s, _, _, _ in ranked[:gan.config.keep_top_k])
+        top_dir = os.path.join(gan.checkpoint_dir, 'top')
+        if step in top:
+            source = snapshot if snapshot is not None else gan.save_checkpoint(step)
+            if not os.path.exists(top_dir):
+                os.makedirs(top_dir)
+            selection.link_checkpoint(source, os.path.join(top_dir, 'top.model-%d' % step))
+        if os.path.exists(top_dir):
+            selection.keep_top(top_dir, top)
+
+    def compute_async(self, gan, step):
+        """
+        Scores a snapshot of the generator in a background thread while
+        training goes on. Results are applied (best model, 3-sample test) on
+        the training thread, at most `max_staleness` steps after the snapshot.
+        """
+        job = getattr(self, 'job', None)
+        if job is not None:
+            self.apply_job(gan, wait=step - job['step'] >= gan.config.max_staleness)
 
-        if len(self.output) > 0:
-            if np.min([sc['mmd2'].mean() for sc in self.output]) > output['mmd2'].mean():
+        if (step % gan.config.MMD_sdlr_freq != 0) or (getattr(self, 'job', None) is not None):
+            return
+        self.prepare(gan)
+        gan.timer(step, "Snapshot for scoring")
+        job = {'step': step, 'snapshot': gan.snapshot_for_scoring(step)}
+
+        def run():
+            tt = time.time()
+            try:
+                with cs.policy.limits():
+                    job['output'], job['codes'] = self.score(gan, job['step'], gan.scoring_G_NHWC)
+            except Exception as e:
+                job['error'] = e
+            job['time'] = time.time() - tt
+
+        job['thread'] = threading.Thread(target=run)
+        job['thread'].daemon = True
+        job['thread'].start()
+        self.job = job
+
+    def apply_job(self, gan, wait=False):
+        "Applies the scores of the background job once it is done, joining it first if `wait`."
+        job = self.job
+        if wait:
+            job['thread'].join()
+        if not job['thread'].is_alive():
+            self.job = None
+            if 'error' in job:
+                raise job['error']
+            with cs.policy.limits():
+                self.update(gan, job['step'], job['output'], job['codes'],
+                            job['time'], snapshot=job['snapshot'])
+
+    def finish(self, gan):
+        "Waits for the scoring job still running at the end of training, and applies its scores."
+        if getattr(self, 'job', None) is not None:
+            self.apply_job(gan, wait=True)
+
+    def update(self, gan, step, output, codes, elapsed, snapshot=None):
+        "Applies the scores of `step`: best model saving, 3-sample test LR scheduler."
+        if self.best_mmd2 is not None:
+            if self.best_mmd2 > output['mmd2'].mean():
                 print('Saving BEST model (so far)')
-                gan.save_checkpoint()
-        self.output.append(output)
+                if snapshot is None:
+                    gan.save_checkpoint()
+                else:
+                    gan.copy_to_best(snapshot)
+        if (self.best_mmd2 is None) or (self.best_mmd2 > output['mmd2'].mean()):
+            self.best_mmd2 = output['mmd2'].mean()
 
         if self.lr_scheduler:
             n = gan.config.MMD_sdlr_past_sample
             nc = gan.config.MMD_sdlr_num_test
             bs = 2048
             new_Y = codes[:bs]
-            X = self.train_codes[:bs]
-            print('3-sample stats so far: %d' % len(self.three_sample))
-            if len(self.three_sample) >= n:
-                saved_Z = self.three_sample[0]
-                mmd2_diff, test_stat, Y_related_sums = \
-                    mmd.np_diff_polynomial_mmd2_and_ratio_with_saving(X, new_Y, saved_Z)
+            if self.three_sample is None:
+                self.three_sample = mmd.ThreeSampleState(self.train_codes[:bs], n)
+                if self.three_sample_loaded is not None:
+                    self.three_sample.load_state_dict(self.three_sample_loaded)
+                    self.three_sample_loaded = None
+            state = self.three_sample
+            print('3-sample stats so far: %d' % len(state))
+            if state.full():
+                mmd2_diff, test_stat, Y_related_sums = state.test(new_Y)
                 p_val = scipy.stats.norm.cdf(test_stat)
                 gan.timer(step, "3-sample test stat = %.1f" % test_stat)
                 gan.timer(step, "3-sample p-value = %.1f" % p_val)
                 if p_val > .1:
-                    self.three_sample_chances += 1
-                    if self.three_sample_chances >= nc:
+                    state.chances += 1
+                    if state.chances >= nc:
                         # no confidence that new Y sample is closer to X than old Z is
                         gan.decay_ops()
                         print('No improvement in last %d tests. Decreasing learning rate to %f' %
@@ -140,11 +334,12 @@ class Scorer(object):
                         if gan.config.with_scaling:
                             print(' Decreasing scaling amplitude to %f' %
                                   gan.sess.run(gan.sc))
-                        self.three_sample = (self.three_sample + [Y_related_sums])[-nc:]  # reset memorized sums
-                        self.three_sample_chances = 0
+                        state.keep_last(nc - 1)  # reset memorized sums
+                        state.append(Y_related_sums)
+                        state.chances = 0
                     else:
                         print('No improvement in last %d test(s). Keeping learning rate at %f' %
-                              (self.three_sample_chances, gan.sess.run(gan.lr)))
+                              (state.chances, gan.sess.run(gan.lr)))
                         if gan.config.with_scaling:
                             print(' Keeping scaling amplitude to %f' %
                                   gan.sess.run(gan.sc))
@@ -154,22 +349,19 @@ class Scorer(object):
                     if gan.config.with_scaling:
                         print(' Keeping scaling amplitude to %f' %
                               gan.sess.run(gan.sc))
-                    self.three_sample = self.three_sample[1:] + [Y_related_sums]
-                    self.three_sample_chances = 0
+                    state.append(Y_related_sums)  # drops the oldest sums
+                    state.chances = 0
             else:  # add new sums to memory
-                self.three_sample.append(
-                    mmd.np_diff_polynomial_mmd2_and_ratio_with_saving(X, new_Y, None)
-                )
+                state.append(state.get_sums(new_Y))
                 gan.timer(step, "computing stats for 3-sample test finished")
                 print('current learning rate: %f' % gan.sess.run(gan.lr))
                 if gan.config.with_scaling:
                         print(' current scaling amplitude to %f' %
                               gan.sess.run(gan.sc))
-        filepath = os.path.join(gan.sample_dir, 'score%d.npz' % step)
-
-        output['lr'] = np.array([gan.sess.run(gan.lr)])
-        if gan.config.with_scaling:
-            output['sc'] = np.array([gan.sess.run(gan.sc)])
-
-        np.savez(filepath, **output)
-        gan.timer(step, "Scoring end, total time = %.1f s" % (time.time() - tt))
+        sc = float(gan.sess.run(gan.sc)) if gan.config.with_scaling else None
+        self.db.append(self.run, step, output, elapsed=elapsed,
+                       lr=float(gan.sess.run(gan.lr)), sc=sc)
+        if gan.config.keep_top_k > 0:
+            self.keep_top(gan, step, snapshot)
+        gan.profiler.record('scoring', elapsed)
+        gan.timer(step, "Scoring end, total time = %.1f s" % elapsed)
@@ -0,0 +1,68 @@
+"""
+Compares the KID scores logged during training by two runs, e.g. a float16
+run against its float32 baseline:
+
+    python scripts/compare_kid.py $OUTDIR/sample/cifar10..._bn $OUTDIR/sample/cifar10..._bn_float16
+
+The scores are read from the experiment's scores.sqlite, next to the run
+directories; older runs holding `score<step>.npz` files are read from those.
+Exits with status 1 if the final KID of the second run is worse than the
+baseline's by more than --tolerance baseline standard deviations.
+"""
+
+from __future__ import print_function
+import os
+import re
+import sys
+import argparse
+from glob import glob
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gan'))
+from utils.scoredb import ScoreDB
+
+parser = argparse.ArgumentParser(description='Compare KID scores of two training runs.')
+parser.add_argument('baseline', type=str, help='sample directory of the reference run')
+parser.add_argument('candidate', type=str, help='sample directory of the run to compare')
+parser.add_argument('--tolerance', type=float, default=2.,
+                    help='allowed difference of final KIDs, in baseline standard deviations')
+
+
+def load_kid(sample_dir):
+    sample_dir = sample_dir.rstrip('/')
+    db_path = os.path.join(os.path.dirname(sample_dir), 'scores.sqlite')
+    if os.path.exists(db_path):
+        steps, values = ScoreDB(db_path).values(os.path.basename(sample_dir), 'mmd2')
+        if steps:
+            return dict(zip(steps, values))
+    scores = {}
+    for path in glob(os.path.join(sample_dir, 'score*.npz')):
+        step = int(re.match(r'score(\d+)\.npz', os.path.basename(path)).group(1))
+        scores[step] = np.load(path)['mmd2']
+    return scores
+
+
+def main():
+    args = parser.parse_args()
+    base, cand = load_kid(args.baseline), load_kid(args.candidate)
+    steps = sorted(set(base) & set(cand))
+    if not steps:
+        print('No common scoring steps found.')
+        sys.exit(1)
+
+    print('%8s  %22s  %22s' % ('step', 'baseline KID', 'candidate KID'))
+    for step in steps:
+        print('%8d  %.5f (+- %.5f)  %.5f (+- %.5f)' % (
+            step, base[step].mean(), base[step].std(), cand[step].mean(), cand[step].std()))
+
+    last = steps[-1]
+    diff = cand[last].mean() - base[last].mean()
+    print('Final KID difference at step %d: %.5f' % (last, diff))
+    if diff > args.tolerance * base[last].std():
+        print('Candidate KID is worse than the baseline.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()